@@ -0,0 +1,380 @@
+#!/usr/bin/python
+#
+# Benchmarks for the search pipeline in Search.py.
+#
+# We don't ship a big test corpus, and we don't want to go fetching one, so we make our own:  synthetic text built
+# from the lines and vocabulary of searchtest.txt, in as many sizes as you like, and a mix of queries drawn from the
+# same vocabulary.  Everything comes out of a seeded random number generator, so two runs with the same arguments
+# search exactly the same text for exactly the same queries -- which is the whole point, if you want to compare them.
+#
+#   python Benchmark.py [--sizes 256k,1m,4m] [--queries 40] [--repeat 3] [--modes regex,index,...] [--seed 1]
+#                       [--output results.json] [--baseline results.json] [--tolerance 0.2]
+#
+# For each size and mode, we report the throughput (queries a second), the p50/p95/p99 latency, the peak memory,
+# and how the time splits up between the stages of the pipeline.  The results go out as JSON; hand a previous run's
+# results in as the --baseline, and we'll point out anything that got slower than the tolerance allows (and exit
+# with a non-zero status, so you can use it in a script).
+
+import json
+import multiprocessing
+import optparse
+import platform
+import random
+import re
+import resource
+import sys
+import timeit
+from StringIO import StringIO
+
+import Search
+
+MODES         = [ "regex", "index", "prefilter", "auto", "terms", "batch", "ranked", "stream" ]
+DEFAULT_SIZES = "256k,1m,4m"
+QUERY_KINDS   = [ "single", "and", "literal", "synonym", "section" ]
+
+SECTION_RATE  = 0.002   # How often do we drop a section reference ("S168(a)") in place of a word?
+MUTATION_RATE = 0.3     # How often do we swap a word for some other word from the vocabulary?
+
+timer = timeit.default_timer
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class SyntheticCorpus:
+    """
+    Makes up text that looks like searchtest.txt.  We take its lines as templates (so we get the same mix of
+    headings, blank lines and long paragraphs), and swap a share of their words for other words from the file,
+    so the text doesn't just repeat -- the common words stay common, and the rare ones stay rare.  Every so often
+    we drop in a section reference, in one of the forms people write them, so the "s168(a)" queries have
+    something to find.
+    """
+
+    wordPattern = re.compile(r"[A-Za-z][A-Za-z'\-]+")
+
+    def __init__ ( self, seed ):
+        f = open(Search.SEARCH_FILE_NAME, 'r')
+        self.lines = f.read().splitlines()
+        self.words = self.wordPattern.findall( "\n".join(self.lines) )
+        self.seed  = seed
+
+    def generate ( self, size ):
+        """
+        Return size (or a few more) characters of text.  The same size always gets the same text.
+        """
+        generator = random.Random( self.seed * 1000003 + size )
+
+        def mutate ( match ):
+            r = generator.random()
+            if r < SECTION_RATE:
+                return self.sectionReference(generator)
+            if r < MUTATION_RATE:
+                return generator.choice(self.words)
+            return match.group(0)
+
+        pieces = []
+        length = 0
+        while length < size:
+            line = self.wordPattern.sub( mutate, generator.choice(self.lines) ) + "\n"
+            pieces.append(line)
+            length += len(line)
+        return "".join(pieces)
+
+    def sectionReference ( self, generator ):
+        number = generator.randint(1, 200)
+        letter = generator.choice("abcdefgh")
+        return generator.choice( [ "S%d(%s)" % (number, letter), "s. %d(%s)" % (number, letter),
+                                   "sec. %d(%s)" % (number, letter), "section %d" % number ] )
+
+    def queries ( self, count ):
+        """
+        Return count (kind, query) pairs, spread evenly across the QUERY_KINDS.
+        """
+        generator = random.Random( self.seed * 1000003 - 1 )
+        synonyms  = [ line.split("|") for line in open(Search.SYNONYM_FILE_NAME, 'r').read().splitlines() if len(line) > 0 ]
+        queries   = []
+        for i in range(count):
+            kind = QUERY_KINDS[ i % len(QUERY_KINDS) ]
+            if kind == "single":
+                query = generator.choice(self.words)
+            elif kind == "and":
+                query = " ".join( [ generator.choice(self.words) for j in range(generator.randint(2, 3)) ] )
+            elif kind == "literal":
+                line  = self.wordPattern.findall( generator.choice(self.lines) )
+                while len(line) < 2:
+                    line = self.wordPattern.findall( generator.choice(self.lines) )
+                start = generator.randint(0, len(line) - 2)
+                query = '"%s %s"' % (line[start], line[start+1])
+            elif kind == "synonym":
+                query = "%s %s" % ( generator.choice(generator.choice(synonyms)), generator.choice(self.words) )
+            else:
+                query = generator.choice( [ "irc s%d(%s)", "s%d(%s)", "section %d(%s)", "i.r.c. s. %d(%s)" ] ) % \
+                        ( generator.randint(1, 200), generator.choice("abcdefgh") )
+            queries.append( (kind, query) )
+        return queries
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class StageTimer:
+    """
+    Adds up how long each stage of the pipeline takes, across all the queries we run.
+    """
+
+    def __init__ ( self ):
+        self.totals = { }
+        self.last   = timer()
+
+    def start ( self ):
+        self.last = timer()
+
+    def lap ( self, stage ):
+        """
+        Charge the time since the last lap (or start()) to the given stage.
+        """
+        now = timer()
+        self.totals[stage] = self.totals.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+    def milliseconds ( self ):
+        return dict( [ (stage, round(total * 1000.0, 3)) for stage, total in self.totals.items() ] )
+
+class PipelineTotals:
+    """
+    Adds up the SearchStats from each search (see Search.SearchStats), for a finer split of the search time
+    than the StageTimer can see from outside:  finding anchors versus verifying their windows, and so on.
+    Only the modes that run through SearchExecution.executePlan() have these.
+    """
+
+    def __init__ ( self ):
+        self.timings  = dict.fromkeys( Search.SearchStats.stages, 0.0 )
+        self.counters = { "anchors": 0, "verifications": 0, "rejectedWindows": 0, "blocks": 0, "skippedBlocks": 0 }
+
+    def add ( self, stats ):
+        for stage, seconds in stats.timings.items():
+            self.timings[stage] += seconds
+        self.counters["anchors"]         += stats.anchors
+        self.counters["verifications"]   += stats.verifications
+        self.counters["rejectedWindows"] += stats.rejectedWindows
+        self.counters["blocks"]          += stats.blocks
+        self.counters["skippedBlocks"]   += stats.skippedBlocks
+
+    def milliseconds ( self ):
+        return dict( [ (stage, round(total * 1000.0, 3)) for stage, total in self.timings.items() ] )
+
+def percentile ( values, fraction ):
+    """
+    The nearest-rank percentile of some (unsorted) values.
+    """
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank    = int( fraction * len(ordered) + 0.999999 )
+    return ordered[ min( max(rank, 1), len(ordered) ) - 1 ]
+
+def peakMemory ( ):
+    """
+    The most memory this process has ever had resident, in kilobytes (which is what Linux gives us).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# --------------------------------------------------------------------------------------------------------------------
+
+def runMode ( mode, text, queries, repeat ):
+    """
+    Run every query, repeat times, in the given mode, returning a result dictionary.  This runs in a process
+    of its own, so the peak memory is just ours.
+    """
+    memoryBefore = peakMemory()
+    searcher     = Search.Searcher()
+    tokenizer    = Search.Tokenizer()
+    execution    = searcher.searchExecution
+    stages       = StageTimer()
+    latencies    = []
+    hitCount     = 0
+    pipeline     = PipelineTotals()
+
+    # Build whatever the mode runs off up front, and charge it to its own stage ...
+    stages.start()
+    content = Search.Content(text)
+    if mode == "index":
+        content.getIndex()
+    if mode in ("prefilter", "auto", "ranked"):
+        content.getPrefilter()
+    if mode == "terms":
+        content.getTermIndex()
+    content.getSpaces()
+    stages.lap("setup")
+
+    started = timer()
+    for repetition in range(repeat):
+        if mode == "batch":
+            # The batch runs all the queries at once (with one BatchScanner, so it's up against the regex mode), so all
+            # we can say about any one of them is the average.
+            stages.start()
+            searchResults = searcher.searchBatch( [ query for kind, query in queries ], content, False, Search.ENGINE_REGEX )
+            for searchResult in searchResults:
+                hitCount += len(searchResult.hits)
+            stages.lap("search")
+            for searchResult in searchResults:
+                for kwic in searchResult.kwics():
+                    pass
+            stages.lap("kwic")
+            latencies.extend( [ (stages.last - started) / len(queries) ] * len(queries) )
+            started = stages.last
+            continue
+
+        for kind, query in queries:
+            queryStarted = timer()
+            stats = Search.SearchStats(query)
+            stages.start()
+            parseList = tokenizer.tokenize(query)
+            stages.lap("tokenize")
+            plan = execution.compilePlan( parseList, stats )
+            stages.lap("compile")
+
+            if mode == "stream":
+                for hit in searcher.searchStream( query, StringIO(text), Search.STREAM_CHUNK_SIZE, Search.MAX_HITS ):
+                    hitCount += 1
+                stages.lap("stream")
+            elif mode == "ranked":
+                topHits = Search.TopHits()
+                execution.executeRanked( plan, content, topHits )
+                stages.lap("rank")
+                for rankedHit in topHits.rankedHits():
+                    rankedHit.kwic()
+                    hitCount += 1
+                stages.lap("kwic")
+            else:
+                searchResult = execution.executePlan( plan, content, False, mode, None, Search.MAX_HITS, stats )
+                stages.lap("plan")
+                for hit in searchResult:
+                    hitCount += 1
+                stages.lap("hits")
+                for kwic in searchResult.kwics():
+                    pass
+                stages.lap("kwic")
+                pipeline.add(stats)
+
+            latencies.append( timer() - queryStarted )
+
+    elapsed = sum(latencies)
+    return {
+        "mode":         mode,
+        "queries":      len(latencies),
+        "hits":         hitCount,
+        "throughput":   round( len(latencies) / elapsed, 3 ) if elapsed > 0 else None,
+        "latencyMs":    dict( [ (name, round(percentile(latencies, fraction) * 1000.0, 3))
+                                for name, fraction in [ ("p50", 0.50), ("p95", 0.95), ("p99", 0.99) ] ] ),
+        "peakMemoryKb": peakMemory(),
+        "memoryGrowthKb": peakMemory() - memoryBefore,
+        "stageMs":      stages.milliseconds(),
+        "pipelineMs":   pipeline.milliseconds(),
+        "counters":     pipeline.counters,
+    }
+
+def modeWorker ( connection, mode, text, queries, repeat ):
+    connection.send( runMode(mode, text, queries, repeat) )
+    connection.close()
+
+def runIsolated ( mode, text, queries, repeat ):
+    """
+    Run a mode in a fresh process (which gets the text when it forks), so one mode's memory doesn't count
+    against the next one's.
+    """
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process( target = modeWorker, args = (sender, mode, text, queries, repeat) )
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+# --------------------------------------------------------------------------------------------------------------------
+
+def parseSize ( size ):
+    """
+    "256k" --> 262144, "4m" --> 4194304, and so on.
+    """
+    size = size.strip().lower()
+    multiplier = { "k": 1 << 10, "m": 1 << 20, "g": 1 << 30 }.get( size[-1:], 1 )
+    if multiplier != 1:
+        size = size[:-1]
+    return int( float(size) * multiplier )
+
+def runBenchmarks ( sizes, queryCount, repeat, modes, seed, isVerbose = True ):
+    """
+    Run every mode over a corpus of every size, returning everything we found out as one dictionary.
+    """
+    corpus  = SyntheticCorpus(seed)
+    queries = corpus.queries(queryCount)
+    results = []
+    for size in sizes:
+        text = corpus.generate(size)
+        for mode in modes:
+            result = runIsolated( mode, text, queries, repeat )
+            result["size"] = size
+            results.append(result)
+            if isVerbose:
+                print >> sys.stderr, "%9d %-10s %9.1f q/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  peak %7dKB" % ( size, mode,
+                    result["throughput"] or 0, result["latencyMs"]["p50"], result["latencyMs"]["p95"], result["latencyMs"]["p99"], result["peakMemoryKb"] )
+
+    return {
+        "python":   platform.python_version(),
+        "platform": platform.platform(),
+        "seed":     seed,
+        "repeat":   repeat,
+        "queries":  [ { "kind": kind, "query": query } for kind, query in queries ],
+        "results":  results,
+    }
+
+def findRegressions ( baseline, current, tolerance ):
+    """
+    Compare two runs, returning a line of text for each size and mode that got more than tolerance (as a fraction)
+    slower, by throughput or p95 latency.  Sizes and modes that aren't in both runs are left out.
+    """
+    before      = dict( [ ((result["size"], result["mode"]), result) for result in baseline["results"] ] )
+    regressions = []
+    for result in current["results"]:
+        old = before.get( (result["size"], result["mode"]) )
+        if old is None:
+            continue
+        if old["throughput"] and result["throughput"] and result["throughput"] < old["throughput"] * (1.0 - tolerance):
+            regressions.append( "%d %s: throughput %.1f --> %.1f q/s" % (result["size"], result["mode"], old["throughput"], result["throughput"]) )
+        if result["latencyMs"]["p95"] > old["latencyMs"]["p95"] * (1.0 + tolerance):
+            regressions.append( "%d %s: p95 latency %.2f --> %.2fms" % (result["size"], result["mode"], old["latencyMs"]["p95"], result["latencyMs"]["p95"]) )
+    return regressions
+
+def main ( arguments ):
+    parser = optparse.OptionParser( usage = "python Benchmark.py [options]" )
+    parser.add_option( "--sizes",     default = DEFAULT_SIZES, help = "corpus sizes to run, e.g. 256k,1m,4m [%default]" )
+    parser.add_option( "--queries",   default = 40, type = "int", help = "how many queries in the mix [%default]" )
+    parser.add_option( "--repeat",    default = 3, type = "int", help = "how many times to run each query [%default]" )
+    parser.add_option( "--modes",     default = ",".join(MODES), help = "which engines/modes to run [%default]" )
+    parser.add_option( "--seed",      default = 1, type = "int", help = "random seed for the corpus and queries [%default]" )
+    parser.add_option( "--output",    default = None, help = "write the JSON results here, rather than to stdout" )
+    parser.add_option( "--baseline",  default = None, help = "earlier JSON results to check for regressions against" )
+    parser.add_option( "--tolerance", default = 0.2, type = "float", help = "how much slower counts as a regression [%default]" )
+    options, leftovers = parser.parse_args(arguments)
+
+    modes = [ mode.strip() for mode in options.modes.split(",") if len(mode.strip()) > 0 ]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error( "unknown mode %s (try %s)" % (mode, ", ".join(MODES)) )
+
+    results = runBenchmarks( [ parseSize(size) for size in options.sizes.split(",") ], options.queries, options.repeat, modes, options.seed )
+
+    output = json.dumps( results, indent = 2, sort_keys = True, separators = (",", ": ") )
+    if options.output is None:
+        print output
+    else:
+        f = open(options.output, 'w')
+        f.write(output + "\n")
+        f.close()
+
+    if options.baseline is not None:
+        regressions = findRegressions( json.load(open(options.baseline, 'r')), results, options.tolerance )
+        for regression in regressions:
+            print >> sys.stderr, "REGRESSION " + regression
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main(sys.argv[1:]) )
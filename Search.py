@@ -2,7 +2,23 @@
 #
 # Demonstration of simple search using regex as the "engine".
 
+import base64
+import hashlib
+import heapq
+import json
+import marshal
+import math
+import mmap
+import multiprocessing
+import os
 import re
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 
 SEARCH_FILE_NAME  = "searchtest.txt"   # File containing the text we'll search against
 QUERY_FILE_NAME   = "queries.txt"      # File containing the queries to run, one per line
@@ -13,6 +29,36 @@ FOLLOWING_CHARS  =  30    # How many characters after the end of a match to show
 MAX_KWIC_CHARS   = 100    # How much maximim KWIC (KeyWord In Context) text?
 MAX_HITS         =   8    # How many hits to limit to?
 
+ENGINE_REGEX     = "regex"   # Scan the whole content with each clause regex
+ENGINE_INDEX     = "index"   # Answer each clause from a positional inverted index over the content
+ENGINE_PREFILTER = "prefilter"   # Find each clause's literal text with str.find, and only run the regex there
+ENGINE_TERMS     = "terms"       # Compare normalized term ids (see TermAnalyzer), with no regexes at all
+ENGINE_AUTO      = "auto"        # Let the QueryPlanner pick the cheapest matcher for each clause (see chooseMatcher())
+DEFAULT_ENGINE   = ENGINE_AUTO
+
+PLAN_CACHE_SIZE  = 256    # How many compiled query plans will a Searcher hang on to?
+RESULT_CACHE_SIZE = 512   # How many searches' hits will a ResultCache hang on to?
+MAX_OPEN_MAPPINGS    =   64   # How many documents will a MappingPool keep mapped at once?
+STREAM_CHUNK_SIZE    = 1 << 20   # How much do we read at a time when we're streaming?
+STREAM_SLACK         =  256   # Extra overlap between streamed chunks, beyond MATCH_WINDOW, for long matches and KWIC text
+PLANNER_SAMPLES      =   16   # How many slices of the content does the planner count matches in?
+PLANNER_SAMPLE_CHARS = 4096   # ... and how big is each slice?
+BLOCK_CHARS          = 1024   # How big (at least) is each block a BlockFilter keeps a Bloom filter of the terms for?
+BLOCK_BLOOM_BITS     = 1024   # ... and how many bits are in each block's filter?
+MAX_FUZZY_TERMS      =   32   # How many of the content's words (the closest ones) will a fuzzy term match, at most?
+MAX_ALTERNATION      =    8   # How many variants will an AlternationClauseMatcher check one by one, before we'd rather run the regex?
+MAX_CONJUNCTIONS     =   64   # How many AND windows can a query boil down to, before we'd rather turn it away?
+MAX_SCAN_CLAUSES     =   99   # How many clauses will a BatchScanner look for in one scan?  (The re module allows 100 groups)
+CURSOR_VERSION       =    1   # Bump this whenever what's in a SearchCursor changes, and every old token is refused
+INDEX_VERSION        =    2   # Bump this whenever the IndexFile layout changes, and every old file goes stale
+INDEX_SUFFIX         = ".idx"   # The "index" command saves a file's IndexFile next to it, with this on the end
+SEGMENTS_PER_PROCESS =    4   # How many segments does a SegmentedSearcher split a document into, per worker process?
+MIN_SEGMENT_CHARS    = 1 << 16   # ... but none smaller than this
+
+EXACT_WEIGHT         =  1.0   # When ranking, how much is a clause worth if it matched just as the user typed it?
+LEMMA_WEIGHT         =  0.8   # ... or a plural (or singular) of it?
+SYNONYM_WEIGHT       =  0.6   # ... or one of its synonyms?
+
 # --------------------------------------------------------------------------------------------------------------------
 
 class Token:
@@ -27,16 +73,23 @@ class Token:
         self.isLiteral    = False   # Is this token to be literally (exactly) searched?
         self.startSpecial = None    # Did it start specially?  (For us, just double-quote.)
         self.endSpecial   = None    # Did it end specially?  (For us, just double-quote.)
+        self.operator     = None    # Is it a boolean operator (AND, OR or NOT) rather than a term?
+        self.opens        = 0       # How many grouping parentheses open just before it?
+        self.closes       = 0       # ... and how many close just after it?
 
     def __str__ ( self ):
         """
         Return a print-happy string representation of ourselves ...
         """
-        return "%s%s%s%s" % (
+        if self.operator is not None:
+            return "%s<%s>%s" % ( "(" * self.opens, self.operator, ")" * self.closes )
+        return "%s%s%s%s%s%s" % (
+            "(" * self.opens,
             ("", "<LITERAL>")[self.isLiteral],
             ("", "[%s]" % self.startSpecial)[self.startSpecial is not None],
             self.token,
-            ("", "[%s]" % self.endSpecial)[self.endSpecial is not None]
+            ("", "[%s]" % self.endSpecial)[self.endSpecial is not None],
+            ")" * self.closes
             )
 
     def finalizeExtraction ( self, inLiteral ):
@@ -48,10 +101,10 @@ class Token:
 
         1. If the token starts with a parenthesis:
             a.  If it ends with a parenthesis, keep the parens:  (a)(2)
-            b.  Otherwise, remove the parens.
+            b.  Otherwise, remove the parens, and count them as opening a group:  (horse
         2. If the token ends with a parenthesis:
             a.  If there is a start-paren in the word, keep the parens:  168(a)
-            b.  Otherwise, remove the parens.
+            b.  Otherwise, remove the parens, and count them as closing a group:  cow)
         3. If the token starts with a double-quote:
             a.  If it ends with a double-quote, remove the quotes, mark as literal, and stop further processing:  "sec.(192)"
             b.  Otherwise, remove the double-quote and store it as a starting special character.
@@ -59,8 +112,8 @@ class Token:
         5. If the token starts with a period, colon or single-quote, remove.
         6. If the token ends with a period, colon or single-quote, remove.
 
-        If the token is an uppercase OR or AND, assume that the user is trying to use boolean, and throw
-        out the entire token (as the search will default to AND, anyhow).
+        If the token is an uppercase AND, OR or NOT, the user is trying to use boolean, so mark it as an
+        operator (see ParseTree).
         """
 
         if inLiteral:
@@ -84,6 +137,7 @@ class Token:
                         isStillProcessing = False
                     else:
                         self.token = self.token[1:]  # Trim off the first character and keep going ...
+                        self.opens += 1
                         startChar -= 1  # Account for our missing character ...
                 elif self.token[startChar] == '"':
                     if self.token[len(self.token)-1] == '"':
@@ -117,6 +171,7 @@ class Token:
                         isStillProcessing = False
                     else:
                         self.token = self.token[0:endChar]
+                        self.closes += 1
                 elif self.token[endChar] == '"' or removeStartOrEndChars.find( self.token[endChar] ) != -1:
                     # Since we're not currently in a literal, this is just junk.  Remove it.
                     self.token = self.token[0:endChar]
@@ -124,12 +179,9 @@ class Token:
                     isStillProcessing = False
                 endChar -= 1
 
-            # If the user is trying to force a boolean search, rather than mysteriously failing for them
-            # (which it probably would do), just erase the token -- it'll search AND by default, anyhow ...
-            if self.token == "AND":
-                self.token = ""
-            if self.token == "OR":
-                self.token = ""
+            # If the user is trying to force a boolean search, let them ...
+            if not self.isLiteral and self.token in ("AND", "OR", "NOT"):
+                self.operator = self.token
 
 # --------------------------------------------------------------------------------------------------------------------
 
@@ -159,24 +211,153 @@ class Tokenizer:
     ParseTree).  For a more proper implementation, see Aho, Sethi & Ullman.
     """
 
-    spaces = " ,;\n\r\t"
+    spaces       = " ,;\n\r\t"
+    wordPattern  = re.compile( "[^" + spaces + "]+" )   # A run of anything that isn't a space is a word
+    removeStartOrEndChars = "'.:"
+    trimsStart   = '("' + removeStartOrEndChars         # If a word doesn't start with one of these ...
+    trimsEnd     = ')"' + removeStartOrEndChars         # ... or end with one of these, there's nothing to trim
 
     def __init__ ( self ):
         pass
 
     def tokenize ( self, searchExpression ):
         """
-        This is a stupidly simple (and easily optimized on almost any platform) tokenizer.  You could probably do
-        this better with a regex, but kept this for straightforwardness.  Of course, the *right* way to do this is
-        to write an actual, simple state tokenizer.  For all such things, see Aho, Sethi & Ullman.
+        Break a query up into a ParseList in a single pass:  the compiled wordPattern finds where each word
+        starts and ends, and extractToken() works out what's left of it (see Token.finalizeExtraction() for the
+        rules) by moving those two offsets, so the token's text is only ever sliced out once.  We keep track of
+        whether or not we're between double-quotes to handle literal searches.
+        """
+        return self.tokenizeSpans( searchExpression, self.wordPattern.finditer(searchExpression) )
+
+    def tokenizeAll ( self, searchExpressions ):
+        """
+        Break a whole list of queries up into ParseLists (in the same order), for a batch of them.  We run the
+        wordPattern over all of them at once -- joined up with newlines, which are spaces to us, so no word can
+        run from one query into the next -- and deal the words out to the queries they came from.  A query
+        that's in the list more than once is only tokenized once, and shares its ParseList.
+        """
+        distinct = list( OrderedDict.fromkeys(searchExpressions) )
+        if len(distinct) < len(searchExpressions):
+            parseLists = dict( zip( distinct, self.tokenizeAll(distinct) ) )
+            return [ parseLists[searchExpression] for searchExpression in searchExpressions ]
+
+        text       = "\n".join(searchExpressions)
+        parseLists = []
+        spans      = []
+        queryEnd   = len(searchExpressions[0]) if searchExpressions else 0
+        for match in self.wordPattern.finditer(text):
+            while match.start() > queryEnd:
+                parseLists.append( self.tokenizeSpans(text, spans) )
+                spans    = []
+                queryEnd += 1 + len( searchExpressions[len(parseLists)] )
+            spans.append(match)
+        while len(parseLists) < len(searchExpressions):
+            parseLists.append( self.tokenizeSpans(text, spans) )
+            spans = []
+        return parseLists
+
+    def tokenizeSpans ( self, text, spans ):
+        """
+        Build the ParseList for the words at some spans (regex matches) of the text.  A plain word, as almost
+        all of them are, doesn't need extractToken() at all.
+        """
+        parseList  = ParseList()   # New list for us to add tokens to
+        inLiteral  = False         # No double-quote seen yet ...
+        opens      = 0             # Grouping parentheses waiting for a token to go with
+        trimsStart = self.trimsStart
+        trimsEnd   = self.trimsEnd
+
+        for span in spans:
+            start, end = span.span()
+            if not inLiteral and text[start] not in trimsStart and text[end-1] not in trimsEnd:
+                token = Token()
+                token.token = text[start:end]
+                if token.token in ("AND", "OR", "NOT"):
+                    token.operator = token.token
+                opens = self.appendToken( parseList, token, opens )
+                continue
+
+            token = self.extractToken( text, start, end, inLiteral )
+            if token.isLiteral:
+                inLiteral = token.endSpecial != '"'   # If we closed out a literal string, we're out of it
+            else:
+                inLiteral = False
+            opens = self.appendToken( parseList, token, opens )
+
+        return parseList
+
+    def extractToken ( self, text, start, end, inLiteral ):
+        """
+        Make a Token of the word at text[start:end], applying the same rules as Token.finalizeExtraction() --
+        quirks and all -- but by moving start and end rather than slicing the string over and over.
+        """
+        token = Token()
+
+        if inLiteral:
+            token.isLiteral = True
+            if text[end-1] == '"':  # Then we're the end of a literal string
+                token.endSpecial = '"'
+                end -= 1
+        else:
+            # Trim the front of the word.  We always trim its first character, but we look at the one offset
+            # past it -- which is only ever not the first, once we've taken a pair of double-quotes off.
+            offset = 0
+            isStillProcessing = True
+            while isStillProcessing and offset < end - start:
+                char = text[start + offset]
+                if char == "(":
+                    if text[end-1] == ")":
+                        isStillProcessing = False   # Stop processing, and keep the rest of the word
+                    else:
+                        start += 1
+                        token.opens += 1
+                elif char == '"':
+                    token.isLiteral    = True
+                    token.startSpecial = '"'
+                    if text[end-1] == '"':
+                        token.endSpecial = '"'
+                        start  += 1
+                        end     = max( end - 1, start )
+                        offset += 1
+                    else:
+                        start += 1
+                        isStillProcessing = False   # Assume the rest of the whole word is literal ...
+                elif char in self.removeStartOrEndChars:
+                    start += 1
+                else:
+                    isStillProcessing = False
+
+            # Trim the end of the word ...
+            while not token.isLiteral and end > start:
+                char = text[end-1]
+                if char == ")":
+                    if text.find("(", start, end) != -1:   # Then there's an open-parens in the word.  Keep it all.
+                        break
+                    end -= 1
+                    token.closes += 1
+                elif char == '"' or char in self.removeStartOrEndChars:
+                    end -= 1   # Since we're not currently in a literal, this is just junk.
+                else:
+                    break
+
+        token.token = text[start:end]
 
-        Essentially, we scan through the string, starting a new token any time we find non-space characters.  We
-        keep track of whether or not we're between double-quotes to handle literal searches.
+        # If the user is trying to force a boolean search, let them ...
+        if not token.isLiteral and token.token in ("AND", "OR", "NOT"):
+            token.operator = token.token
+        return token
+
+    def tokenizeByCharacter ( self, searchExpression ):
+        """
+        The tokenizer we started out with, which builds each token up a character at a time, and has it trim
+        itself with Token.finalizeExtraction().  We keep it as the reference tokenize() is checked against (see
+        testEquivalence()).
         """
 
         parseList = ParseList()   # New list for us to add tokens to
         currToken = None          # No token started yet ...
         inLiteral = False         # No double-quote seen yet ...
+        opens     = 0             # Grouping parentheses waiting for a token to go with
 
         for char in searchExpression:
 
@@ -190,8 +371,7 @@ class Tokenizer:
                             inLiteral = True
                     else:
                         inLiteral = False
-                    if len(currToken.token) > 0:  # Ensure we have something ... might have also nuked the word in finalization.
-                        parseList.tokens.append(currToken)
+                    opens = self.appendToken( parseList, currToken, opens )
                     currToken = None
                 else:
                     # Keep going and just eat the character ...
@@ -205,26 +385,431 @@ class Tokenizer:
 
         if currToken is not None:  # Then we need to close out the prior word
             currToken.finalizeExtraction(inLiteral)
-            if len(currToken.token) > 0:  # Ensure we have something ... might have also nuked the word in finalization.
-                parseList.tokens.append(currToken)
+            opens = self.appendToken( parseList, currToken, opens )
 
         return parseList
 
+    def appendToken ( self, parseList, token, opens ):
+        """
+        Add a finalized token to the list, returning how many grouping parentheses are still waiting for a token.
+        Ensure we have something ... might have also nuked the word in finalization.  If there's nothing left of it
+        but parentheses (say, a lone "("), its opens go with the next token, and its closes with the last one.
+        """
+        if len(token.token) > 0:
+            token.opens += opens
+            parseList.tokens.append(token)
+            return 0
+        if token.closes > 0 and len(parseList.tokens) > 0:
+            parseList.tokens[len(parseList.tokens)-1].closes += token.closes
+        return opens + token.opens
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class ParseNode:
+    """
+    One node of a ParseTree:  an AND, OR or NOT of its children, or a TERM (a word, or a quoted phrase).
+    """
+
+    def __init__ ( self, kind, children = None, term = None, isLiteral = False ):
+        self.kind      = kind              # "AND", "OR", "NOT" or "TERM"
+        self.children  = children or []
+        self.term      = term              # For a TERM, the word or phrase
+        self.isLiteral = isLiteral         # ... and was it quoted?
+
+    def __str__ ( self ):
+        if self.kind == "TERM":
+            return ( self.term, '"%s"' % self.term )[self.isLiteral]
+        return "%s(%s)" % ( self.kind, ", ".join( [ str(child) for child in self.children ] ) )
+
+class ParseTree:
+    """
+    The proper tree for a query, built from the Tokenizer's ParseList.  The grammar is the usual one:
+
+        query   := and ( OR and )*
+        and     := unary ( [AND] unary )*       (AND is what you get if you don't say anything)
+        unary   := NOT unary | ( query ) | term
+
+    where a term is a word, or a run of quoted (literal) tokens, which make a phrase.  Parentheses only group
+    when the Tokenizer took them off a word ("(horse", "cow)"); ones that are part of a word ("168(a)", "(b)")
+    are just part of the word.  We're forgiving about the rest:  unbalanced parentheses get balanced, and an
+    operator with nothing to operate on gets ignored.
+
+    Since our search is all about windows of text, what we actually run is the tree boiled down to an OR of
+    AND windows (see conjunctions()), with any OR of plain terms kept together as a single clause.
+    """
+
+    def __init__ ( self, parseList ):
+        # Flatten the tokens out into a list of symbols:  "(", ")", "AND", "OR", "NOT", and TERM nodes ...
+        self.symbols = []
+        for token in parseList.tokens:
+            self.symbols.extend( [ "(" ] * token.opens )
+            if token.operator is not None:
+                self.symbols.append( token.operator )
+            elif token.isLiteral and len(self.symbols) > 0 and isinstance(self.symbols[len(self.symbols)-1], ParseNode) and \
+                 self.symbols[len(self.symbols)-1].isLiteral:
+                self.symbols[len(self.symbols)-1].term += " " + token.token   # Run the literal tokens together into a phrase
+            else:
+                self.symbols.append( ParseNode("TERM", None, token.token, token.isLiteral) )
+            self.symbols.extend( [ ")" ] * token.closes )
+
+        # ... and parse them.  Any stray close-parens just get skipped over.
+        self.position = 0
+        nodes = []
+        while self.position < len(self.symbols):
+            node = self.parseOr()
+            if node is not None:
+                nodes.append(node)
+            if self.position < len(self.symbols):
+                self.position += 1
+        self.root = self.simplify( ParseNode("AND", nodes) )
+        del self.symbols
+
+    def __str__ ( self ):
+        return str(self.root)
+
+    def peek ( self ):
+        if self.position < len(self.symbols):
+            return self.symbols[self.position]
+        return None
+
+    def parseOr ( self ):
+        children = [ self.parseAnd() ]
+        while self.peek() == "OR":
+            self.position += 1
+            children.append( self.parseAnd() )
+        return self.simplify( ParseNode("OR", children) )
+
+    def parseAnd ( self ):
+        children = []
+        while self.peek() not in (None, ")", "OR"):
+            if self.peek() == "AND":
+                self.position += 1
+                continue
+            children.append( self.parseUnary() )
+        return self.simplify( ParseNode("AND", children) )
+
+    def parseUnary ( self ):
+        symbol = self.peek()
+        self.position += 1
+        if symbol == "NOT":
+            if self.peek() in (None, ")", "OR", "AND"):   # NOT what?
+                return None
+            child = self.parseUnary()
+            if child is None:
+                return None
+            return ParseNode("NOT", [ child ])
+        if symbol == "(":
+            node = self.parseOr()
+            if self.peek() == ")":
+                self.position += 1
+            return node
+        return symbol
+
+    def simplify ( self, node ):
+        """
+        Drop the empty bits, and don't bother with an AND or OR of just one thing.
+        """
+        node.children = [ child for child in node.children if child is not None ]
+        if len(node.children) == 0:
+            return None
+        if len(node.children) == 1 and node.kind in ("AND", "OR"):
+            return node.children[0]
+        return node
+
+    def conjunctions ( self ):
+        """
+        Boil the tree down to an OR of ANDs (disjunctive normal form), returning a list of (positives, negatives)
+        pairs:  each one an AND window, made of the clauses that must be in it and the ones that mustn't.  Each
+        clause is a tuple of terms, any of which will do.  We push the NOTs down to the terms on the way, and keep
+        an OR of plain terms together as a single clause, which we can then find with a single scan.  A window with
+        nothing that must be in it is no good to us (there's nothing to anchor on), so we leave those out.
+
+        An AND of ORs multiplies out, so a query can ask for an awful lot of windows without being very long; if
+        it comes to more than MAX_CONJUNCTIONS, we give up with a ValueError (see disjunction()).
+        """
+        if self.root is None:
+            return []
+        conjunctions = []
+        seen         = set()
+        for positives, negatives in self.disjunction( self.root, False ):
+            key = ( tuple(positives), tuple(negatives) )
+            if len(positives) > 0 and key not in seen:
+                seen.add(key)
+                conjunctions.append( (positives, negatives) )
+        return conjunctions
+
+    def disjunction ( self, node, isNegated ):
+        """
+        The (positives, negatives) pairs for a node, or for NOT that node.
+        """
+        if node.kind == "TERM":
+            if isNegated:
+                return [ ([], [ (node.term,) ]) ]
+            return [ ([ (node.term,) ], []) ]
+        if node.kind == "NOT":
+            return self.disjunction( node.children[0], not isNegated )
+
+        terms    = tuple( [ child.term for child in node.children if child.kind == "TERM" ] )
+        branches = [ child for child in node.children if child.kind != "TERM" ]
+
+        if (node.kind == "OR") != isNegated:
+            # An OR (or NOT of an AND, which is an OR of NOTs):  the terms all go into one clause, and each other
+            # branch is a window of its own ...
+            result = []
+            if len(terms) > 0:
+                if isNegated:
+                    result.extend( [ ([], [ (term,) ]) for term in terms ] )
+                else:
+                    result.append( ([ terms ], []) )
+            for branch in branches:
+                result.extend( self.disjunction(branch, isNegated) )
+                self.checkWindows( len(result) )
+            return result
+
+        # An AND (or NOT of an OR, which is an AND of NOTs):  every combination of a window from each child.
+        if len(terms) == 0:
+            result = [ ([], []) ]
+        elif isNegated:
+            result = [ ([], [ terms ]) ]      # None of these terms, which is one clause to rule out
+        else:
+            result = [ ([ (term,) for term in terms ], []) ]
+        for branch in branches:
+            branchWindows = self.disjunction(branch, isNegated)
+            self.checkWindows( len(result) * len(branchWindows) )   # (Before we go to the trouble of multiplying them out)
+            result = [ (positives + branchPositives, negatives + branchNegatives)
+                       for positives, negatives in result
+                       for branchPositives, branchNegatives in branchWindows ]
+        return result
+
+    def checkWindows ( self, windowCount ):
+        """
+        Turn the query away if it's come to more than MAX_CONJUNCTIONS windows.
+        """
+        if windowCount > MAX_CONJUNCTIONS:
+            raise ValueError( "query has more than %d AND windows" % MAX_CONJUNCTIONS )
+
 class SearchMatcher:
     """
-    Little helper class to store a regular expression and a matcher for searching ease.
+    Little helper class to store a regular expression and a matcher for searching ease.  We also hang on to the
+    (synonym-expanded) variants the regex was built from, so that other engines can work from the plain terms,
+    and the terms the user actually typed (more than one, if they ORed them) -- and, for a fuzzy clause, the
+    words that still need looking up in the content, with how many edits each allows.
     """
 
-    def __init__ (self, regex, matcher):
+    def __init__ (self, regex, matcher, variants = None, terms = None, fuzzy = ()):
         self.regex = regex
         self.matcher = matcher
+        self.variants = variants
+        self.terms = terms
+        self.fuzzy = fuzzy
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class QueryPlanner:
+    """
+    Decides which clause to anchor the proximity search on, and in what order to check the others.
+
+    We used to just take the longest clause, on the theory that it'd be the rarest.  But that's often wrong:
+    synonym expansion ("irc|i.r.c|code") and the "[s]*" plural suffix can make a long clause very common
+    indeed.  So instead we estimate how many times each clause will match, and go rarest first:  the rarest
+    clause makes for the fewest anchors, and checking the rarest of the rest first means a bracket that's
+    going to fail usually fails on the first clause we look at.
+
+    The estimates come from the content's literal statistics:  how many times the clause's literal core turns
+    up, which the LiteralPrefilter works out (once per clause, per content) with str.find.  For a clause that
+    doesn't have a literal core (or content that doesn't have a prefilter, like a MappedContent), we count regex
+    matches in a handful of evenly spaced samples of the content, and scale up.  Note that the estimates don't
+    depend on which engine we're running -- every engine gets the same plan, and so gives the same hits.
+    """
+
+    def estimateMatches ( self, searchMatcher, content ):
+        """
+        Guess how many times a clause will match the content.
+        """
+        prefilter = content.getPrefilter()
+        if prefilter is not None:
+            literalMatcher = prefilter.getClauseMatcher(searchMatcher)
+            if not literalMatcher.isFallback:
+                return len(literalMatcher.candidates)
+        return self.sampleMatches( searchMatcher.matcher, content.getSearchText() )
+
+    def sampleMatches ( self, matcher, text ):
+        """
+        Count the matches in PLANNER_SAMPLES slices of PLANNER_SAMPLE_CHARS each, spread evenly through the
+        text, and scale that up to the whole thing.  Small texts just get counted outright.
+        """
+        if len(text) <= PLANNER_SAMPLES * PLANNER_SAMPLE_CHARS:
+            samples = [ (0, len(text)) ]
+        else:
+            stride  = len(text) / PLANNER_SAMPLES
+            samples = [ (i * stride, i * stride + PLANNER_SAMPLE_CHARS) for i in range(PLANNER_SAMPLES) ]
+
+        count   = 0
+        sampled = 0
+        for start, end in samples:
+            sampled += end - start
+            match = matcher.search( text, start, end )
+            while match is not None:
+                count += 1
+                match = matcher.search( text, match.start() + 1, end )
+
+        if sampled == 0:
+            return 0
+        return count * len(text) / sampled
+
+    def orderClauses ( self, searchClauses, andClauses, content ):
+        """
+        Estimate each clause, and return a list of ClauseEstimates, rarest first.  The first one is our anchor.
+        Python's sort is stable, so ties stay in their compiled (longest-first) order.
+        """
+        clausePlan = [ ClauseEstimate( andClause, clause, self.estimateMatches(clause, content) )
+                       for andClause, clause in zip(andClauses, searchClauses) ]
+        clausePlan.sort( lambda x, y: cmp(x.estimated, y.estimated) )
+        return clausePlan
+
+    def chooseMatcher ( self, searchMatcher, content ):
+        """
+        Pick the cheapest way to find a clause in the content, returning its name and the matcher.  A clause with
+        just the one variant (a plain word, say) is a LiteralClauseMatcher; a short list of them (a word and its
+        synonyms) is an AlternationClauseMatcher; and either way, we never run the regex at all.  Anything with
+        a variant that doesn't have a literal core, or more variants than MAX_ALTERNATION (where one regex match
+        beats checking each of them in Python), gets the prefiltered regex -- or, for content with no prefilter,
+        the plain regex.  They all find exactly the same matches.
+        """
+        prefilter = content.getPrefilter()
+        if prefilter is None:
+            return "regex", searchMatcher.matcher
+        if len(searchMatcher.variants) <= MAX_ALTERNATION:
+            literalMatcher = prefilter.getLiteralMatcher(searchMatcher)
+            if literalMatcher is not None:
+                return literalMatcher.backend, literalMatcher
+        literalMatcher = prefilter.getClauseMatcher(searchMatcher)
+        if literalMatcher.isFallback:
+            return "regex", searchMatcher.matcher
+        return "prefilter", literalMatcher
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class ClauseEstimate:
+    """
+    One line of a search plan:  a clause, how many matches the QueryPlanner expected it to have, and (once
+    we've searched) the MatchStream that found the real ones.
+    """
+
+    def __init__ ( self, clause, searchMatcher, estimated ):
+        self.clause        = clause          # The clause text, as the user gave it
+        self.searchMatcher = searchMatcher
+        self.estimated     = estimated
+        self.stream        = None
+        self.backend       = None            # Which matcher the QueryPlanner chose for it, if it had the choice
+
+    def startStream ( self, matcher, text, startAt = 0 ):
+        """
+        Create (and remember) the MatchStream for this clause, using whichever engine's matcher we were given.
+        """
+        self.stream = MatchStream( matcher, text, startAt )
+        return self.stream
+
+    def actual ( self ):
+        """
+        How many matches we actually found, as a string.  If we stopped early (e.g., we hit MAX_HITS), we only
+        know a lower bound.
+        """
+        if self.stream is None:
+            return "-"
+        if self.stream.isExhausted:
+            return "%d" % len(self.stream)
+        return ">=%d" % len(self.stream)
+
+    def __str__ ( self ):
+        line = "plan: %-30s estimated %6d  actual %6s" % ( '"%s"' % self.clause, self.estimated, self.actual() )
+        if self.backend is not None:
+            line += "  (%s)" % self.backend
+        return line
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class MatchStream:
+    """
+    All the matches for one clause, in order of where they start, collected lazily as the proximity search
+    works its way through the content.  Each match is found exactly once, no matter how many anchors'
+    brackets it falls into.
+
+    We find every position a clause matches at (not just the non-overlapping ones), by searching again from
+    one past the start of the last match.  The matcher can be anything with a compiled regex's search().  If
+    we're picking a search up part way through (see SearchCursor), we don't look before startAt at all.
+    """
+
+    def __init__ ( self, matcher, text, startAt = 0 ):
+        self.matcher     = matcher
+        self.text        = text
+        self.startAt     = startAt
+        self.starts      = []      # Where each match starts ...
+        self.ends        = []      # ... and ends
+        self.maxLength   = 0       # The longest match we've seen so far
+        self.isExhausted = False   # Have we found them all?
+
+    def __len__ ( self ):
+        return len(self.starts)
+
+    def fetchNext ( self ):
+        """
+        Find one more match, returning False if there aren't any.
+        """
+        if self.isExhausted:
+            return False
+        if len(self.starts) == 0:
+            nextStart = self.startAt
+        else:
+            nextStart = self.starts[len(self.starts)-1] + 1
+        match = self.matcher.search( self.text, nextStart )
+        if match is None:
+            self.isExhausted = True
+            return False
+        self.starts.append(match.start())
+        self.ends.append(match.end())
+        self.maxLength = max( self.maxLength, match.end() - match.start() )
+        return True
+
+    def fetch ( self, i ):
+        """
+        Make sure we've found the i'th match, returning False if there isn't one.
+        """
+        while len(self.starts) <= i:
+            if not self.fetchNext():
+                return False
+        return True
+
+    def fill ( self, position ):
+        """
+        Make sure we've found every match that starts before the given position.
+        """
+        while len(self.starts) == 0 or self.starts[len(self.starts)-1] < position:
+            if not self.fetchNext():
+                return
+
+    def extend ( self, starts, ends ):
+        """
+        Add matches that somebody else found (see SegmentedSearcher), in order, after the ones we have.  A
+        stream that's fed this way never goes looking for matches itself, so it counts as exhausted -- it
+        only knows as much of the text as it's been told about.
+        """
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+        for start, end in zip(starts, ends):
+            if end - start > self.maxLength:
+                self.maxLength = end - start
+        self.isExhausted = True
 
 # --------------------------------------------------------------------------------------------------------------------
 
-class HitPosition:
+class HitPosition(object):
     """
-    Little helper class to start start and end of a match.
+    Little helper class to start start and end of a match.  There's one of these for every highlight of every
+    hit, so we keep them small.
     """
+    __slots__ = ( "start", "end" )
+
     def __init__(self, start, end):
         self.start = start  # First part of hit
         self.end   = end    # Last part of hit
@@ -275,48 +860,210 @@ class Synonyms:
     this fairly easily to handle common cases.
 
     NOTE:  Because we do synonyms before we do lemma expansion, you MUST include all variants in the list
-    in order to get good matches.  This is cheap and sleazy.  You should fix this processing!
+    in order to get good matches.  This is cheap and sleazy.  You should fix this processing!  (The terms engine
+    does:  see TermAnalyzer.)
 
     Also, be sure to put things in the list in the form that they'll match tokenized terms.  E.g., remove the trailing period.
     """
 
     def __init__ ( self ) :
         """
-        Load up from an equivalencies file with each equivalency separated by a pipe.
+        The synonyms all come out of the process-wide SynonymTable, so we don't read the file again.
         """
-        self.dictionary = { }
-        f = open(SYNONYM_FILE_NAME, "r")
-        equivalencies = f.read().splitlines()
-        for equivalency in equivalencies:
-            # Each synonym on the line is separated by a pipe
-            synonymList = equivalency.split("|")
-            # Throw them in a dictionary for easier retrieval ...
-            for synonym in synonymList:
-                self.dictionary[synonym] = synonymList
+        self.table = getSynonymTable()
 
     def expandTerm ( self, term ):
         """
         Return either the term, or a list of terms.
         """
-        if term in self.dictionary:
-            return self.dictionary[term]
+        if term in self.table.words:
+            return list( self.table.groups[ self.table.words[term] ] )
         else:
             return [ term ]
 
 # --------------------------------------------------------------------------------------------------------------------
 
+class SynonymTable:
+    """
+    The synonyms file, loaded once per process (see getSynonymTable()) and shared by everybody.
+
+    There are two ways in.  The words are the file as written:  each synonym maps to the id of its group (its
+    line -- the last one, if it's on more than one), and groups[id] is the line's synonyms.  That's all
+    Synonyms.expandTerm() needs.  The trie is for the TermAnalyzer:  each synonym is broken into tokens and
+    normalized just like the content is, and filed in nested dictionaries, one level per token, so a synonym
+    that's more than one token in the content ("i.r.c") can still be found.  Each trie node is a pair:  the group
+    id if a synonym ends there (or None), and the node's children.
+    """
+
+    def __init__ ( self, fileName = SYNONYM_FILE_NAME ):
+        self.groups    = []   # Group id --> tuple of synonyms
+        self.words     = {}   # Synonym --> group id
+        self.trie      = {}   # Token key --> [ group id or None, { next token key --> ... } ]
+        self.maxTokens = 1    # Longest synonym, in tokens
+
+        f = open(fileName, "r")
+        for equivalency in f.read().splitlines():
+            groupId     = len(self.groups)
+            synonymList = tuple( equivalency.split("|") )   # Each synonym on the line is separated by a pipe
+            self.groups.append( synonymList )
+            for synonym in synonymList:
+                self.words[synonym] = groupId
+                keys = TermAnalyzer.tokenKeys(synonym)
+                if len(keys) > 0:
+                    self.addKeys( keys, groupId )
+        f.close()
+
+    def addKeys ( self, keys, groupId ):
+        """
+        File a synonym's token keys in the trie.
+        """
+        children = self.trie
+        for key in keys[:-1]:
+            children = children.setdefault( key, [ None, {} ] )[1]
+        children.setdefault( keys[-1], [ None, {} ] )[0] = groupId
+        self.maxTokens = max( self.maxTokens, len(keys) )
+
+    def lookup ( self, keys ):
+        """
+        Return the group id for a whole run of token keys, or None if it isn't a synonym.
+        """
+        node     = None
+        children = self.trie
+        for key in keys:
+            node = children.get(key)
+            if node is None:
+                return None
+            children = node[1]
+        return node[0]
+
+    def longestPhrase ( self, keys, first ):
+        """
+        Find the longest synonym of more than one token starting at keys[first], returning its group id and
+        how many tokens it runs to -- or (None, 0), if there isn't one.
+        """
+        groupId  = None
+        length   = 0
+        children = self.trie
+        for i in range( first, min(first + self.maxTokens, len(keys)) ):
+            node = children.get( keys[i] )
+            if node is None:
+                break
+            if node[0] is not None and i > first:
+                groupId = node[0]
+                length  = i - first + 1
+            children = node[1]
+        return groupId, length
+
+synonymTable = None
+
+def getSynonymTable ( ):
+    """
+    Return the process-wide SynonymTable, loading the synonyms file the first time through.
+    """
+    global synonymTable
+    if synonymTable is None:
+        synonymTable = SynonymTable()
+    return synonymTable
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class TermAnalyzer:
+    """
+    Boils content tokens and query terms down to the same canonical keys, so matching a term is just comparing
+    integers -- no regex, and no need to list every variant of every synonym by hand.  A key is:
+
+        - the token, lowercased,
+        - with a section (or paragraph) symbol in front of a number folded to an "s" (or "p"),
+        - and any trailing "s"es stripped off (the same sloppy plurals as the Lemmatizer's "[s]*").
+
+    We break terms up into tokens exactly the way the PositionalIndex breaks up the content.  Each distinct key
+    gets an integer id, except that every key of a single-token synonym gets its group's id instead.  The group
+    ids come first (they're the SynonymTable's), and everything else is numbered after them, as we see it.
+    Hang on to the analyzer you indexed the content with, since the ids only mean anything to it.
+    """
+
+    sectionSymbol   = "\xc2\xa7"   # In UTF-8, like the content
+    paragraphSymbol = "\xc2\xb6"
+
+    def __init__ ( self, table = None ):
+        if table is None:
+            table = getSynonymTable()
+        self.table  = table
+        self.keyIds = {}   # Key --> id, for everything that isn't a single-token synonym
+
+    @staticmethod
+    def normalize ( token ):
+        """
+        Fold a token down to its key.  The PositionalIndex files its tokens under the same keys (see
+        PositionalIndex.termKey()), so the two engines agree on which tokens are the same -- a lone "s" included,
+        which folds away to nothing, just like "ss" does.
+        """
+        token = token.lower()
+        if token[2:3].isdigit():
+            if token.startswith(TermAnalyzer.sectionSymbol):
+                token = "s" + token[2:]
+            elif token.startswith(TermAnalyzer.paragraphSymbol):
+                token = "p" + token[2:]
+        return token.rstrip("s")
+
+    @staticmethod
+    def tokenKeys ( term ):
+        """
+        Break a term up into tokens, the same way the content is, and normalize each one.
+        """
+        return [ TermAnalyzer.normalize(token) for token in PositionalIndex.tokenPattern.findall(term) ]
+
+    def keyId ( self, key ):
+        """
+        Return the id for a key, giving it a new one if we haven't seen it before.
+        """
+        node = self.table.trie.get(key)
+        if node is not None and node[0] is not None:
+            return node[0]
+        keyId = self.keyIds.get(key)
+        if keyId is None:
+            keyId = self.keyIds[key] = len(self.table.groups) + len(self.keyIds)
+        return keyId
+
+    def findId ( self, key ):
+        """
+        Return the id for a key, or None if we've never seen it (in which case it can't match anything).
+        """
+        node = self.table.trie.get(key)
+        if node is not None and node[0] is not None:
+            return node[0]
+        return self.keyIds.get(key)
+
+    def termIds ( self, term ):
+        """
+        Analyze a query term, returning its group id as a one-element list if the whole thing is a synonym, or
+        else the id of each of its tokens.  If any of them is a key we've never seen, we return None.
+        """
+        keys = self.tokenKeys(term)
+        if len(keys) == 0:
+            return []
+        groupId = self.table.lookup(keys)
+        if groupId is not None:
+            return [ groupId ]
+        ids = [ self.findId(key) for key in keys ]
+        if None in ids:
+            return None
+        return ids
+
+# --------------------------------------------------------------------------------------------------------------------
+
 class SearchExecution:
     """
     The SearchExecution class takes a ParseList (or properly, a ParseTree) and executes the search, generating
     a SearchResult
 
-    Note that because we're working with a very simplified structure (i.e., a ParseList rather than a proper
-    ParseTree), we are just doing our Analysis() step in place here (e.g., lemmatization, synonyms, etc.).
-    Properly, that should be done in an earlier step on the ParseTree, and we'd walk the parse-tree in in-fix
-    order here (but that's also very difficult when generating a regex).
+    Note that we are just doing our Analysis() step in place here (e.g., lemmatization, synonyms, etc.).
+    Properly, that should be done in an earlier step on the ParseTree.  Rather than walk the parse-tree in
+    in-fix order here (which is very difficult when generating a regex), we boil it down to a list of AND
+    windows (see ParseTree.conjunctions()) -- almost always just the one.
 
-    First, we create a list of all our AND clauses -- specifically, to merge together any literal
-    strings of tokens.  Then we turn each one into a word-match regex.
+    For each window, we take its list of AND clauses (the ParseTree has already merged together any literal
+    strings of tokens).  Then we turn each one into a word-match regex.
 
     I tried just creating all the permutations, and stringing them together into a big OR clause ... but that
     turned out to really slow down with longer searches.  So, to speed it up, sort the list in order of the longest
@@ -327,264 +1074,3150 @@ class SearchExecution:
 
     """
 
-    wordBoundaries = r'[ .,:;\n\r\t\(\)\[\]]'
+    wordBoundaries    = r'[ .,:;\n\r\t\(\)\[\]]'
+    wordBoundaryChars = " .,:;\n\r\t()[]"   # The same thing, for str.strip()
 
     def __init__ (self ) :
         self.lemmatizer = Lemmatizer()
         self.synonyms   = Synonyms()
+        self.planner    = QueryPlanner()
 
 
-    def executeSearch (self, parseList, content, isVerbose ):
+    def executeSearch (self, parseList, content, isVerbose, engine = DEFAULT_ENGINE ):
+        """
+        Compile the ParseList and run it in one go.  If you're going to run the same query again, hang on to
+        a Searcher instead, which keeps the compiled plans around.
+        """
+        return self.executePlan( self.compilePlan(parseList), content, isVerbose, engine )
 
-        searchResult = SearchResult(content)
+    def compilePlan ( self, parseList, stats = None ):
+        """
+        Do all the work that doesn't depend on the content:  build the ParseTree (which consolidates the literals),
+        boil it down to AND windows, order the clauses, expand the synonyms and lemmas, and compile the regexes.
+        The QueryPlan we hand back can be run any number of times.  If you hand us a SearchStats, we time the
+        synonym and lemma expansion, and the compiles.
+        """
 
-        andClauses = []
+        parseTree    = ParseTree(parseList)
+        compiled     = { }    # Each clause's SearchMatcher, so a clause that's in more than one window is only compiled once
+        conjunctions = []
 
-        # First, collect all the tokens into "literal" strings (i.e., consolidate the literal clauses)
-        currentClause = ""
-        for token in parseList.tokens:
-            if token.isLiteral:
-                if len(currentClause) > 0:  # Then we're the second+ word in the clause ...
-                    currentClause += " "
-                currentClause += token.token
-            else:
-                if len(currentClause) > 0:   # Then we just walked off the end of a literal ...
-                    andClauses.append(currentClause)  # Add the prior literal ...
-                    currentClause = ""                # And "zero it out"
-                andClauses.append(token.token) # Then store our word
-            # Take care of any trailing literal ...
-        if len(currentClause) > 0:
-            andClauses.append(currentClause)
-
-        # Sort the clauses into a "longest-first" order, to (presumably) search on the lowest matches first.
-        # This is just Python syntax for a reverse length string sort on an array ...
-        andClauses.sort(  lambda x, y: cmp(len(y), len(x)) )
-
-        # Now, turn each one into a word-matching regex
-        searchClauses = []
-        for clause in andClauses:
-            isFirst = True
-            regex = ""
-            for synonym in self.synonyms.expandTerm(clause.lower()):
-                # Note that we escape the term BEFORE passing it to the lemmatizer, as the lemmatizer is going
-                # to add regular expression markup to it.  Be careful when you do this, and what you expect to
-                # happen afterwards.
-                lemmatized = self.lemmatizer.expandEquivalencies( re.escape(synonym))
-                if isFirst:
-                    isFirst = False
-                else:
-                    regex += "|"
-                regex += "(^|" + self.wordBoundaries + ")" + lemmatized + "($|" + self.wordBoundaries + ")"  # Escape it to capture any regex metacharacters in there (e.g., parens).
-            if isVerbose:
-                print regex
-            searchClauses.append( SearchMatcher(regex, re.compile(regex, re.IGNORECASE|re.DOTALL)))  # Cache a copy of the regex, and a compiled matcher
+        for positives, negatives in parseTree.conjunctions():
+            # Sort the clauses into a "longest-first" order.  The QueryPlanner picks the actual search order once it
+            # sees the content, but this is its tie-breaker.  This is just Python syntax for a reverse length string
+            # sort on an array ...
+            positives = list(positives)
+            positives.sort(  lambda x, y: cmp(len(self.clauseText(y)), len(self.clauseText(x))) )
 
-        # Just test for an edge case ... if no search clauses, no search!
-        if len(searchClauses) < 1 :
-            return searchResult
+            # Now, turn each one into a word-matching regex
+            searchClauses   = [ self.compileClause(terms, compiled, stats) for terms in positives ]
+            excludedClauses = [ self.compileClause(terms, compiled, stats) for terms in negatives ]
+            conjunctions.append( Conjunction( [ self.clauseText(terms) for terms in positives ], searchClauses, excludedClauses ) )
 
-        # Now, we look for decent AND matches.  We define an AND match as all the words co-occuring within some
-        # given distance.  We arbitrarily select "about" 500 characters (could be more).  To do this, we:
-        #   1. Regex match to find the first word
-        #   2. Establish a bracket before and after the match we found
-        #   3. Search for *all* the rest of the words within that zone, and for each one, take the match closest to
-        #      the first word we found (for highlighting purposes).
-        #   4. If we find all the words in that zone, record the closest ones, and save it as a search hit.
+        return QueryPlan(parseList, conjunctions, parseTree)
 
-        scanStart = 0
+    def clauseText ( self, terms ):
+        """
+        How we show a clause:  its term, or its terms ORed together.
+        """
+        return " OR ".join(terms)
 
-        while scanStart < len(content.content) and len(searchResult.hits) < MAX_HITS:  # While we're not exhausted ...
+    def compileClause ( self, terms, compiled, stats ):
+        """
+        Turn a clause -- any one of some terms -- into a SearchMatcher, unless we already have.  Each term gets
+        expanded into its synonyms, each of those into its lemma regex, and the lot ORed together into one regex,
+        so however many terms there are, it's one scan.
 
-            highlights = []
+        A word with a "~" on the end ("acounting~", or "acounting~2") is fuzzy:  it also matches the words in the
+        content within that many edits of it (one, if it doesn't say).  Which words those are depends on the
+        content, so all we can do here is make a note of it on the SearchMatcher -- see expandFuzzy().
+        """
+        if terms in compiled:
+            return compiled[terms]
 
-            match = searchClauses[0].matcher.search( content.content, scanStart )
+        if stats is not None:
+            started = time.time()
+        variants = []
+        words    = []
+        fuzzy    = []
+        for term in terms:
+            word, distance = self.fuzzyTerm(term)
+            words.append(word)
+            if distance > 0:
+                fuzzy.append( (word.lower(), distance) )
+            for synonym in self.synonyms.expandTerm(word.lower()):
+                if synonym not in variants:
+                    variants.append(synonym)
+        if stats is not None:
+            stats.timings["synonyms"] += time.time() - started
+        compiled[terms] = self.compileVariants( variants, tuple(words), stats )
+        compiled[terms].fuzzy = tuple(fuzzy)
+        return compiled[terms]
 
-            if match is None:   # Then we're done!
-                break
+    fuzzyPattern = re.compile( "^([^" + wordBoundaries[1:] + "+?)~([12]?)$" )   # A single word, then "~", "~1" or "~2"
 
-            # OK, we found a match.
-            # Save the highlight
-            hitPosition = HitPosition(match.start(), match.end())
-            # Trim the bits we matched before and after off the hit, as our regex includes the space characters.
-            if hitPosition.start != 0:
-                hitPosition.start += 1
-            if hitPosition.end != len(content.content) - 1:
-                hitPosition.end -= 1
-            highlights.append(hitPosition)
+    def fuzzyTerm ( self, term ):
+        """
+        Split a term into its word and how many edits it allows (0, if it isn't fuzzy).  Only a single word can
+        be fuzzy; anything else with a "~" on the end is just looked for as it is.
+        """
+        match = self.fuzzyPattern.match(term)
+        if match is None:
+            return term, 0
+        return match.group(1), int( match.group(2) or "1" )
 
-            # Now see if the rest of our words are within the bracket.  If you had something
-            # useful like page markers, you might want to limit by page boundaries, rather than a window.
-            startBracket = match.start() - MATCH_WINDOW
-            endBracket   = match.end()   + MATCH_WINDOW
-            if startBracket < 0:
-                startBracket = 0
-            if startBracket < scanStart:  # Be sure we don't go back to a previous occurance ...
-                startBracket = scanStart
-            if endBracket >= len(content.content):  # And be sure we don't walk off the end of the content ...
-                endBracket = len(content.content)
-
-            skipFirst    = True
-            failed       = False
-            lastPosition = match.end()
-
-            for clause in searchClauses:
-                if skipFirst:  # Skip over the first one, we already did it.
-                    skipFirst = False
-                else:
-                    nextStart   = startBracket
-                    bestMatch   = None
-                    minDistance = 999999
+    def compileVariants ( self, variants, terms, stats = None ):
+        """
+        Build the regex for a clause's variants -- each one's lemma regex, between word boundaries, all ORed
+        together -- and compile it into a SearchMatcher.
+        """
+        isFirst = True
+        regex = ""
+        if stats is not None:
+            started = time.time()
+        for synonym in variants:
+            # Note that we escape the term BEFORE passing it to the lemmatizer, as the lemmatizer is going
+            # to add regular expression markup to it.  Be careful when you do this, and what you expect to
+            # happen afterwards.
+            lemmatized = self.lemmatizer.expandEquivalencies( re.escape(synonym))
+            if isFirst:
+                isFirst = False
+            else:
+                regex += "|"
+            regex += "(^|" + self.wordBoundaries + ")" + lemmatized + "($|" + self.wordBoundaries + ")"  # Escape it to capture any regex metacharacters in there (e.g., parens).
+        if stats is not None:
+            stats.timings["lemmas"] += time.time() - started
+            started = time.time()
+        searchMatcher = SearchMatcher(regex, re.compile(regex, re.IGNORECASE|re.DOTALL), variants, terms)  # Cache a copy of the regex, and a compiled matcher
+        if stats is not None:
+            stats.timings["compile"] += time.time() - started
+        return searchMatcher
 
-                    # Loop through matches until we find one that's closest to our first match word
-                    while True:
+    def expandFuzzy ( self, plan, content ):
+        """
+        Return the plan with each fuzzy clause's words looked up in the content's TermVocabulary, and the
+        words within reach of them added to the clause as variants of their own -- or the plan just as it was, if
+        it doesn't have any fuzzy clauses.  Content without a vocabulary (a MappedContent) just gets the words
+        as they were typed, and so do streamed and segmented searches, which never see all the content at once.
+        We hang on to the expanded clauses with the vocabulary, since they only depend on it.
+        """
+        if not any( clause.fuzzy for conjunction in plan.conjunctions for clause in conjunction.searchClauses + conjunction.excludedClauses ):
+            return plan
+        vocabulary = content.getVocabulary()
+        if vocabulary is None:
+            return plan
 
-                        otherMatch = clause.matcher.search( content.content, nextStart, endBracket )
-                        if otherMatch is None:  # No more matches on this word ... quit
-                            break
-                        else:
-                            # Find the distance between us and the original match.
-                            if otherMatch.start() < match.start():  # Then distance is end to start
-                                ourDistance = match.start() - otherMatch.end()
-                            else:
-                                ourDistance = otherMatch.start() - match.end()
-
-                            if ourDistance < minDistance:  # First match makes it our best match, or our distance could be better
-                                bestMatch = otherMatch
-                                minDistance = ourDistance
-
-                            nextStart = otherMatch.end() + 1
-
-                    if bestMatch is None:   # Then we didn't find any matches ... failure!
-                        failed = True
-                        break   # Quit
-
-                    # Save our hit ...
-                    hitPosition = HitPosition(bestMatch.start(), bestMatch.end())
-                    # Trim the bits we matched before and after off the hit, as our regex includes the space characters.
-                    if hitPosition.start != 0:
-                        hitPosition.start += 1
-                    if hitPosition.end != len(content.content) - 1:
-                        hitPosition.end -= 1
-
-                    highlights.append(hitPosition)
-
-                    # And check to see if we've extended the scan range from which to start our next scan ...
-                    if bestMatch.end() > lastPosition:
-                        lastPosition = bestMatch.end()
-
-            # OK.  By the time we get here, we either failed, or we found all our terms.
-            if failed:  # Well, no matches!  Quit.
-                break
+        def expanded ( clause ):
+            if not clause.fuzzy:
+                return clause
+            key = ( clause.regex, clause.fuzzy )
+            if key not in vocabulary.clauses:
+                variants = list(clause.variants)
+                terms    = list(clause.terms)
+                for word, distance in clause.fuzzy:
+                    for similar in vocabulary.lookup( word, distance ):
+                        if similar not in variants:
+                            variants.append(similar)
+                            terms.append(similar)
+                vocabulary.clauses[key] = self.compileVariants( variants, tuple(terms) )
+            return vocabulary.clauses[key]
 
-            # So, we now have highlights for all our matched words.  Let's record the hit, and start our
-            # next scan following our last location.
+        conjunctions = [ Conjunction( conjunction.andClauses, [ expanded(clause) for clause in conjunction.searchClauses ],
+                                      [ expanded(clause) for clause in conjunction.excludedClauses ] ) for conjunction in plan.conjunctions ]
+        return QueryPlan( plan.parseList, conjunctions, plan.parseTree )
 
-            # First, sort the hits into match order, for simplicity in calculating the KWIC text ...
-            # Again, this is just funky Python syntax for sorting a list of matches in order of match start ...
-            highlights.sort( lambda x, y: cmp(x.start, y.start))
+    def executePlan ( self, plan, content, isVerbose, engine = DEFAULT_ENGINE, index = None, maxHits = MAX_HITS, stats = None, scanState = None ):
+        """
+        Run a compiled QueryPlan against some content, generating a SearchResult with up to maxHits hits (or
+        all of them, if maxHits is None).  If you hand us an index (anything with a getClauseMatcher(), like a
+        BatchScanner), every clause runs off that, whatever the engine (see Searcher.searchBatch()).  If you hand
+        us a SearchStats, it ends up as the SearchResult's .stats, and we keep it up to date as we go.
 
-            searchResult.hits.append( highlights )
-            scanStart = lastPosition + 1  # Move past our current match to keep going ...
+        If you hand us a ScanState, we pick up the search where it says (none of the clauses even look at the
+        text before that), and keep it up to date as we hand out hits -- see Searcher.searchPage().
+        """
 
-        return searchResult
+        plan          = self.expandFuzzy( plan, content )
+        searchResult  = SearchResult(content)
+        searchResult.stats = stats
+        if scanState is None:
+            scanState = ScanState( len(plan.conjunctions) )
 
-# --------------------------------------------------------------------------------------------------------------------
+        if isVerbose:
+            for conjunction in plan.conjunctions:
+                for clause in conjunction.searchClauses:
+                    print clause.regex
+                for clause in conjunction.excludedClauses:
+                    print "NOT " + clause.regex
 
-class SearchResult:
-    """
-    The results of a search.  Each hit consists of a set of HitPositions indicating the word hits.  We use
-    that for highlighting.
+        # Now, we look for decent AND matches.  We define an AND match as all the words co-occuring within some
+        # given distance.  We arbitrarily select "about" 500 characters (could be more).  See proximityHits() for
+        # how we find them -- for each of the plan's windows, if it has more than one.
+        # We don't actually look for them until somebody asks for them, though (see SearchResult).
+        text       = content.getSearchText()
+        windows    = []   # ( MatchStreams, excluded matchers ) for each window
+        allClauses = []
+        for conjunction, scanStart in zip( plan.conjunctions, scanState.scanStarts ):
+            clausePlan, searchClauses, excludedClauses = self.planClauses( conjunction, content, engine, index )
+            searchResult.clausePlan.extend( clausePlan )
+            searchClauses = self.skipBlocks( searchClauses, content, engine, stats )
+            allClauses.extend( searchClauses + excludedClauses )
+            streams = [ estimate.startStream(clause.matcher, text, scanStart) for estimate, clause in zip(clausePlan, searchClauses) ]
+            windows.append( (streams, [ clause.matcher for clause in excludedClauses ]) )
+        countsBefore = self.candidateCounts(allClauses)
 
-    It's a little sleazy, but we store a reference to the content we searched to simplify the syntax for
-    printing out the results (so we can just directly fetch the KWIC text) ...
-    """
+        # Just test for an edge case ... if no search clauses, no search!
+        if len(windows) < 1 :
+            if stats is not None:
+                stats.finish(searchResult)
+            return searchResult
 
-    def __init__ (self, content ):
-        self.hits = []   # Our hits keywords in context ...
-        self.content = content.content  # Just save the actual string.  Sleazy, I know ...
+        searchResult.hitSource = self.resultHits( searchResult, windows, len(text), maxHits, allClauses, countsBefore, scanState )
 
-    def calculateKWIC ( self, hit ):
+        if isVerbose:
+            searchResult.hits   # Run the whole search now, so we can show how the plan panned out
+            for estimate in searchResult.clausePlan:
+                print estimate
+            if engine == ENGINE_PREFILTER:
+                print "prefilter: %d candidates, %d rejected by the full regex" % (searchResult.candidatesTried, searchResult.candidatesRejected)
+            elif engine == ENGINE_AUTO:
+                print "auto: %d candidates, %d rejected" % (searchResult.candidatesTried, searchResult.candidatesRejected)
+
+        return searchResult
+
+    def skipBlocks ( self, searchClauses, content, engine, stats = None ):
         """
-        Given a hit (list of matches), calculate the KWIC (keyword in context) text for it ...
+        Ask the content's BlockFilter which parts of it a window's clauses (anchor first) could make a hit in,
+        and if that leaves any blocks out, wrap their matchers so they don't look there.  Only for the engines that
+        are out to beat the plain scan (the index, prefilter and auto engines):  the regex engine is the plain scan
+        everything else gets checked against, so it doesn't get any help, and the terms engine doesn't match the
+        clause regexes' literal cores.  Not for content that doesn't have a BlockFilter, either.
         """
-        kwicText = ""
+        if engine not in (ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO):
+            return searchClauses
+        blockFilter = content.getBlockFilter()
+        if blockFilter is None:
+            return searchClauses
 
-        startKWIC  = hit[0].start - PRECEDING_CHARS
-        # Now move backwards until we find a space ...
-        while startKWIC > 0 and self.content[startKWIC-1] != " ":
-            startKWIC -= 1
+        ranges, skipped = blockFilter.viableRanges( searchClauses, len(content.getSearchText()) )
+        if stats is not None:
+            stats.blocks        += len(blockFilter.starts)
+            stats.skippedBlocks += skipped
+        if ranges is None:
+            return searchClauses
+        reach = max( [ len(variant) for clause in searchClauses for variant in clause.variants ] ) + STREAM_SLACK
+        return [ SearchMatcher(clause.regex, BlockSkippingMatcher(clause.matcher, ranges, reach), clause.variants, clause.terms)
+                 for clause in searchClauses ]
 
-        # OK, now move forward, building up the text, until we run out of matches, or we exceed
-        # our maximum KWIC text length ...
-        for highlight in hit:  # For each match in our list of matches ...
+    def planClauses ( self, conjunction, content, engine = DEFAULT_ENGINE, index = None ):
+        """
+        Let the planner decide which of a window's clauses to anchor on, and what order to check the rest in,
+        returning its ClauseEstimates along with a SearchMatcher for each clause (in the same order) for the given
+        engine -- and one for each of the window's excluded clauses, too.
+        """
+        clausePlan      = self.planner.orderClauses( conjunction.searchClauses, conjunction.andClauses, content )
+        searchClauses   = [ estimate.searchMatcher for estimate in clausePlan ]
+        excludedClauses = conjunction.excludedClauses
 
-            start = highlight.start
-            end   = highlight.end
-            if start > startKWIC:
-                kwicText += self.content[ startKWIC : start ]   # Add the text before our match
-            kwicText += "<<"    # Start highlight
-            kwicText += self.content[ start : end ]  # Add in the matched text
-            kwicText += ">>"    # End highlight
+        # If we're running off an index (or a batch's BatchScanner), swap each regex matcher for one that only
+        # tries the regex where the index says the clause could start.  Everything else works exactly the same
+        # either way.
+        if index is None and engine == ENGINE_INDEX:
+            index = content.getIndex()   # (None for a MappedContent, which sticks to the regexes)
+        if index is not None:
+            searchClauses  = [ SearchMatcher(clause.regex, index.getClauseMatcher(clause), clause.variants, clause.terms) for clause in searchClauses ]
+            excludedClauses = [ SearchMatcher(clause.regex, index.getClauseMatcher(clause), clause.variants, clause.terms) for clause in excludedClauses ]
+        elif engine == ENGINE_PREFILTER and content.getPrefilter() is not None:   # (Not for a MappedContent)
+            prefilter = content.getPrefilter()
+            searchClauses   = [ SearchMatcher(clause.regex, prefilter.getClauseMatcher(clause), clause.variants, clause.terms) for clause in searchClauses ]
+            excludedClauses = [ SearchMatcher(clause.regex, prefilter.getClauseMatcher(clause), clause.variants, clause.terms) for clause in excludedClauses ]
+        elif engine == ENGINE_AUTO:
+            searchClauses = []
+            for estimate in clausePlan:
+                clause = estimate.searchMatcher
+                estimate.backend, matcher = self.planner.chooseMatcher( clause, content )
+                searchClauses.append( SearchMatcher(clause.regex, matcher, clause.variants, clause.terms) )
+            excludedClauses = [ SearchMatcher(clause.regex, self.planner.chooseMatcher(clause, content)[1], clause.variants, clause.terms) for clause in excludedClauses ]
+        elif engine == ENGINE_TERMS and content.getTermIndex() is not None:   # (Otherwise, it's the regexes after all)
+            termIndex = content.getTermIndex()
+            searchClauses   = [ SearchMatcher(clause.regex, termIndex.getClauseMatcher(clause), clause.variants, clause.terms) for clause in searchClauses ]
+            excludedClauses = [ SearchMatcher(clause.regex, termIndex.getClauseMatcher(clause), clause.variants, clause.terms) for clause in excludedClauses ]
 
-            startKWIC = end
+        return clausePlan, searchClauses, excludedClauses
 
-            if len(kwicText) > MAX_KWIC_CHARS:  # OK, too long ... no more highlights
+    def resultHits ( self, searchResult, windows, contentLength, maxHits, searchClauses, countsBefore, scanState = None ):
+        """
+        Generate up to maxHits hits (or all of them, if maxHits is None) for a SearchResult, as it asks for them.
+        Once we've run out, we note how many of the prefilter's candidates turned out to be duds.
+        """
+        hitCount = 0
+        hits     = self.windowHits( windows, contentLength, searchResult.stats, scanState )
+        while maxHits is None or hitCount < maxHits:   # (Before we go looking for the next one, which moves the ScanState on)
+            highlights = next( hits, None )
+            if highlights is None:
                 break
+            yield highlights
+            hitCount += 1
 
-        # Now, take some text off the end ...
-        endKWIC = startKWIC + FOLLOWING_CHARS
-
-        # Really, we ought to not add additional end text if we've already exceeded our max length, but
-        # it's getting close to dinner time ... so that's left as an exercise for the reader ... <g>
+        countsAfter = self.candidateCounts(searchClauses)
+        searchResult.candidatesTried    = countsAfter[0] - countsBefore[0]
+        searchResult.candidatesRejected = countsAfter[1] - countsBefore[1]
+        if searchResult.stats is not None:
+            searchResult.stats.finish(searchResult)
 
-        while endKWIC < len(self.content) and self.content[endKWIC] != " ":
-            endKWIC += 1
+    def windowHits ( self, windows, contentLength, stats = None, scanState = None ):
+        """
+        Generate the hits for each of a plan's windows (each a list of MatchStreams, and the matchers for the clauses
+        that mustn't be in it), all together in document order.  Where hits for different windows overlap, the
+        first one wins.
 
-        kwicText += self.content[startKWIC:endKWIC]
+        The ScanState says where each window picks up (and the end of the last hit we handed out), and we move
+        it along as we go.  A window's scanStart is where the next hit's bracket can begin, which is also the
+        first anchor that can make one (see proximityHits()), so it's all we need to carry on from exactly where
+        we were.  When we're merging, a window's scanStart only moves on when its hit comes out of the merge,
+        so a hit that's been found but not handed out yet gets found again next time.
+        """
+        if scanState is None:
+            scanState = ScanState( len(windows) )
 
-        return kwicText
+        if len(windows) == 1:
+            streams, excluded = windows[0]
+            scanStart = scanState.scanStarts[0]
+            for highlights, scanStart in self.proximityHits( streams, contentLength, scanStart, scanStart, None, stats, excluded ):
+                scanState.scanStarts[0] = scanStart
+                yield highlights
+            return
 
+        keyed = [ self.keyedHits( i, self.proximityHits(streams, contentLength, scanStart, scanStart, None, stats, excluded) )
+                  for i, ((streams, excluded), scanStart) in enumerate( zip(windows, scanState.scanStarts) ) ]
+        for start, i, scanStart, highlights in heapq.merge( *keyed ):
+            scanState.scanStarts[i] = scanStart
+            if start <= scanState.lastEnd:   # Overlaps the last hit ... skip it
+                continue
+            scanState.lastEnd = max( [ highlight.end for highlight in highlights ] )
+            yield highlights
 
-    def __str__ ( self ):
+    def keyedHits ( self, window, hits ):
         """
-        Produce a string for simple printing of results ...
+        Tag a window's hits for merging:  where they start, then which window they're from (and where it'll
+        carry on from).
         """
-        output = ""
-        for hit in self.hits:
-            output += "\n---\n"
-            output += self.calculateKWIC(hit)
-        return output
+        for highlights, scanStart in hits:
+            yield highlights[0].start, window, scanStart, highlights
+
+    def isExcluded ( self, excluded, text, startBracket, endBracket, contentLength ):
+        """
+        Does one of the clauses that mustn't be in a window start inside its bracket?  We only ever look inside the
+        brackets of windows that have everything else they need.  (We search a little past the end of the bracket,
+        so a word that runs over the end isn't mistaken for a shorter one.)
+        """
+        for matcher in excluded:
+            match = matcher.search( text, startBracket, min(endBracket + STREAM_SLACK, contentLength) )
+            if match is not None and match.start() < endBracket:
+                return True
+        return False
+
+    def proximityHits ( self, streams, contentLength, scanStart = 0, anchorFrom = 0, anchorTo = None, stats = None, excluded = None ):
+        """
+        Generate the AND hits for a set of clause MatchStreams, in document order, as (highlights, scanStart)
+        pairs -- the scanStart being where the next hit's bracket can begin.  The first stream is our anchor.
+        If you're only searching part of the text (see Searcher.searchStream(), or SegmentedSearcher), you can
+        tell us where the last hit left off, and which anchors to consider.  For each anchor match, we:
+          1. Establish a bracket of MATCH_WINDOW characters before and after it
+          2. For each of the other clauses, take its match closest to the anchor within that bracket (for
+             highlighting purposes)
+          3. If every clause has one, that's a hit.  Otherwise, just move on to the next anchor match.
+
+        We used to re-run each clause's regex across the whole bracket for every anchor, which scanned the
+        same text over and over with common terms.  Now each clause's matches are only ever found once (by its
+        MatchStream), and since both the anchors and their brackets only move forward, we can keep a pair of
+        pointers into each stream that only move forward, too.  Finding the closest match is then just a
+        matter of looking on either side of where the anchor falls.
+
+        If you hand us a SearchStats, we count the anchors, the clause verifications and the windows that don't
+        pan out, and time finding the anchors separately from verifying their windows.
+
+        If there are clauses that mustn't be in the window (a NOT), hand us their matchers, and we check them in
+        the bracket of each window that would otherwise be a hit.  And since it's an AND, if any clause doesn't
+        match anywhere at all, we don't bother looking at a single anchor.  The clauses are in rarest-first order,
+        so the one that's most likely not to be there is the first one we look for.
+        """
+
+        for stream in streams:
+            if not stream.fetch(0):
+                return
+
+        anchors  = streams[0]
+        others   = streams[1:]
+        nearests = [ 0 ] * len(others)   # For each other stream, the first match that's not before the anchor ...
+
+        # ... and the first match that's not before the bracket.  No bracket can start before the last hit left
+        # off, or before MATCH_WINDOW ahead of the first anchor we're looking at, so when we're picking up part
+        # way through the text, we can skip straight past the matches that are behind us.
+        firstBracket = max( scanStart, anchorFrom - MATCH_WINDOW )
+        lowers       = [ bisect_left(stream.starts, firstBracket) for stream in others ]
+
+        anchors.fill(anchorFrom)
+        anchor = bisect_left(anchors.starts, anchorFrom)
+
+        while self.fetchAnchor(anchors, anchor, stats) and scanStart < contentLength:
+
+            anchorStart = anchors.starts[anchor]
+            anchorEnd   = anchors.ends[anchor]
+            anchor += 1
+            if anchorTo is not None and anchorStart >= anchorTo:   # Past the part we're supposed to be searching
+                break
+            if anchorStart < scanStart:   # Inside our last hit ... keep going
+                continue
+            if stats is not None:
+                stats.anchors += 1
+                started = time.time()
+
+            # Now see if the rest of our words are within the bracket.  If you had something
+            # useful like page markers, you might want to limit by page boundaries, rather than a window.
+            startBracket = max( anchorStart - MATCH_WINDOW, scanStart, 0 )   # Be sure we don't go back to a previous occurance ...
+            endBracket   = min( anchorEnd + MATCH_WINDOW, contentLength )    # And be sure we don't walk off the end of the content ...
+
+            highlights   = [ self.trimmedHit(anchorStart, anchorEnd, contentLength) ]
+            lastPosition = anchorEnd
+
+            for i in range(len(others)):
+                stream = others[i]
+                stream.fill(endBracket)
+                while lowers[i] < len(stream) and stream.starts[lowers[i]] < startBracket:
+                    lowers[i] += 1
+                nearests[i] = max( nearests[i], lowers[i] )
+                while nearests[i] < len(stream) and stream.starts[nearests[i]] < anchorStart:
+                    nearests[i] += 1
+
+                best = self.closestMatch( stream, lowers[i], nearests[i], anchorStart, anchorEnd, endBracket )
+                if stats is not None:
+                    stats.verifications += 1
+                if best is None:   # Then we didn't find any matches ... on to the next anchor
+                    highlights = None
+                    break
+
+                # Save our hit, and check to see if we've extended the scan range from which to start our next scan ...
+                highlights.append( self.trimmedHit(stream.starts[best], stream.ends[best], contentLength) )
+                if stream.ends[best] > lastPosition:
+                    lastPosition = stream.ends[best]
+
+            if highlights is not None and excluded:
+                if stats is not None:
+                    stats.verifications += len(excluded)
+                if self.isExcluded( excluded, anchors.text, startBracket, endBracket, contentLength ):
+                    highlights = None
+
+            if stats is not None:
+                stats.timings["verification"] += time.time() - started
+            if highlights is None:
+                if stats is not None:
+                    stats.rejectedWindows += 1
+                continue
+
+            # So, we now have highlights for all our matched words.  Sort the hits into match order, for simplicity
+            # in calculating the KWIC text, and start our next scan following our last location.
+            highlights.sort( lambda x, y: cmp(x.start, y.start))
+            scanStart = lastPosition + 1  # Move past our current match to keep going ...
+            yield highlights, scanStart
+
+    def executeRanked ( self, plan, content, topHits, isVerbose = False, engine = DEFAULT_ENGINE, isPruning = True ):
+        """
+        Score every candidate window in the content, and offer them to a TopHits, which keeps the best ones.
+
+        Unlike proximityHits(), every anchor gets a window -- a hit doesn't stop the next anchor from looking
+        back into it -- since an earlier, worse window mustn't crowd out a better one next to it.  (TopHits
+        sorts out windows that overlap.)  A window's score is:
+
+            proximity * sum( rarity * weight ) over the clauses
+
+        where the proximity is MATCH_WINDOW / (MATCH_WINDOW + spread), the spread being how far the highlights
+        reach beyond the anchor; the rarity of a clause is log(1 + content length / estimated matches), from
+        the QueryPlanner's estimate; and the weight is EXACT_WEIGHT, LEMMA_WEIGHT or SYNONYM_WEIGHT, depending
+        on what the clause matched (see matchWeight()).
+
+        No window can score more than the sum of the rarities, so once the TopHits is full, we can skip any
+        content whose sum isn't more than the worst score it's holding.  And that goes for each window, too
+        (this is the "max-score" trick):  we check the clauses rarest-first, and as soon as what we've found so
+        far, at the proximity we've got so far, plus the best the rest could possibly add, can't beat the
+        worst of the TopHits, we give up on the window.  None of this changes which windows we keep -- turn
+        off isPruning if you don't believe it.
+
+        If the plan has more than one window (an OR of ANDs), each gets scored on its own, into the same TopHits.
+        """
+        clausePlan = []
+        for conjunction in self.expandFuzzy( plan, content ).conjunctions:
+            clausePlan.extend( self.rankWindows(conjunction, content, topHits, engine, isPruning) )
+
+        if isVerbose:
+            for estimate in clausePlan:
+                print estimate
+            print topHits
+
+        return clausePlan
+
+    def rankWindows ( self, conjunction, content, topHits, engine = DEFAULT_ENGINE, isPruning = True ):
+        """
+        Score the candidate windows for one of a plan's conjunctions (see executeRanked()), returning its clause
+        plan.  A window with one of the conjunction's excluded clauses in its bracket doesn't get offered at all.
+        """
+        clausePlan, searchClauses, excludedClauses = self.planClauses( conjunction, content, engine )
+        if len(searchClauses) < 1:
+            return clausePlan
+
+        text          = content.getSearchText()
+        contentLength = len(text)
+        rarities      = [ math.log( 1.0 + float(contentLength) / (1 + estimate.estimated) ) for estimate in clausePlan ]
+        clauses       = [ estimate.searchMatcher.terms for estimate in clausePlan ]
+        excluded      = [ clause.matcher for clause in excludedClauses ]
+        if isPruning and topHits.isFull() and sum(rarities) <= topHits.threshold():
+            topHits.documentsSkipped += 1
+            return clausePlan
+
+        streams  = [ estimate.startStream(clause.matcher, text) for estimate, clause in zip(clausePlan, searchClauses) ]
+        for stream in streams:   # It's an AND, so if a clause isn't anywhere, neither is a window
+            if not stream.fetch(0):
+                return clausePlan
+        anchors  = streams[0]
+        others   = streams[1:]
+        lowers   = [ 0 ] * len(others)   # For each other stream, the first match that's not before the bracket
+        nearests = [ 0 ] * len(others)   # ... and the first match that's not before the anchor
+        anchor   = 0
+
+        while anchors.fetch(anchor):
+
+            anchorStart = anchors.starts[anchor]
+            anchorEnd   = anchors.ends[anchor]
+            anchor += 1
+
+            highlight  = self.trimmedHit(anchorStart, anchorEnd, contentLength)
+            found      = rarities[0] * self.matchWeight( text[highlight.start:highlight.end], clauses[0] )
+            remaining  = sum(rarities[1:])
+            if isPruning and topHits.isFull() and found + remaining <= topHits.threshold():
+                topHits.windowsSkipped += 1
+                continue
+
+            startBracket = max( anchorStart - MATCH_WINDOW, 0 )
+            endBracket   = min( anchorEnd + MATCH_WINDOW, contentLength )
+            highlights   = [ highlight ]
+            spanStart    = highlight.start
+            spanEnd      = highlight.end
+            proximity    = 1.0
+
+            for i in range(len(others)):
+                stream = others[i]
+                stream.fill(endBracket)
+                while lowers[i] < len(stream) and stream.starts[lowers[i]] < startBracket:
+                    lowers[i] += 1
+                nearests[i] = max( nearests[i], lowers[i] )
+                while nearests[i] < len(stream) and stream.starts[nearests[i]] < anchorStart:
+                    nearests[i] += 1
+
+                best = self.closestMatch( stream, lowers[i], nearests[i], anchorStart, anchorEnd, endBracket )
+                if best is None:   # Then this anchor doesn't make a window at all
+                    highlights = None
+                    break
+
+                highlight  = self.trimmedHit(stream.starts[best], stream.ends[best], contentLength)
+                highlights.append( highlight )
+                found     += rarities[i+1] * self.matchWeight( text[highlight.start:highlight.end], clauses[i+1] )
+                remaining -= rarities[i+1]
+                spanStart  = min( spanStart, highlight.start )
+                spanEnd    = max( spanEnd, highlight.end )
+                proximity  = float(MATCH_WINDOW) / ( MATCH_WINDOW + (spanEnd - spanStart) - (highlights[0].end - highlights[0].start) )
+                if isPruning and topHits.isFull() and proximity * (found + remaining) <= topHits.threshold():
+                    topHits.windowsSkipped += 1
+                    highlights = None
+                    break
+
+            if highlights is None:
+                continue
+            if excluded and self.isExcluded( excluded, text, startBracket, endBracket, contentLength ):
+                continue
+
+            highlights.sort( lambda x, y: cmp(x.start, y.start))
+            topHits.windowsScored += 1
+            topHits.offer( proximity * found, content, spanStart, spanEnd, highlights )
+
+        return clausePlan
+
+    def matchWeight ( self, matched, terms ):
+        """
+        How much is a clause's match worth?  The most if it's just what the user typed (give or take case and
+        spacing) for any of the clause's terms, a bit less if it's the same word bar a trailing "s" (that's all
+        the Lemmatizer does), and less again if it's a synonym.
+        """
+        matched = " ".join( matched.strip(self.wordBoundaryChars).lower().split() )
+        terms   = [ " ".join( term.lower().split() ) for term in terms ]
+        if matched in terms:
+            return EXACT_WEIGHT
+        for term in terms:
+            if matched.rstrip("s") == term.rstrip("s"):
+                return LEMMA_WEIGHT
+        return SYNONYM_WEIGHT
+
+    def fetchAnchor ( self, anchors, anchor, stats ):
+        """
+        anchors.fetch(anchor), timed if we're keeping stats.
+        """
+        if stats is None:
+            return anchors.fetch(anchor)
+        started = time.time()
+        isFound = anchors.fetch(anchor)
+        stats.timings["anchor scan"] += time.time() - started
+        return isFound
+
+    def closestMatch ( self, stream, lower, nearest, anchorStart, anchorEnd, endBracket ):
+        """
+        Return the index of the stream's match closest to the anchor, and inside the bracket, or None.  The
+        matches in [lower, nearest) start before the anchor, and the ones from nearest on start at or after it.
+        If two are equally close, the earlier one wins.
+        """
+        best        = None
+        minDistance = 999999
+
+        # Before the anchor, the distance is from their end to our start.  Their ends aren't necessarily in
+        # order, but no match is longer than the stream's longest, so we can stop once they can't get any closer.
+        i = nearest - 1
+        while i >= lower and anchorStart - stream.starts[i] - stream.maxLength <= minDistance:
+            distance = anchorStart - stream.ends[i]
+            if distance <= minDistance and stream.ends[i] <= endBracket:
+                best        = i
+                minDistance = distance
+            i -= 1
+
+        # After the anchor, the distance is from our end to their start, which only gets bigger, so the first
+        # one that fits in the bracket is the closest.
+        i = nearest
+        while i < len(stream) and stream.starts[i] < endBracket:
+            if stream.ends[i] <= endBracket:
+                if stream.starts[i] - anchorEnd < minDistance:
+                    best = i
+                break
+            i += 1
+
+        return best
+
+    def trimmedHit ( self, start, end, contentLength ):
+        """
+        Make a HitPosition out of a clause match, trimming the bits we matched before and after off the hit, as
+        our regex includes the space characters.
+        """
+        hitPosition = HitPosition(start, end)
+        if hitPosition.start != 0:
+            hitPosition.start += 1
+        if hitPosition.end != contentLength - 1:
+            hitPosition.end -= 1
+        return hitPosition
+
+    def candidateCounts ( self, searchClauses ):
+        """
+        Total up how many candidates the clause matchers have tried with the full regex, and how many of those
+        it rejected.  Only the prefilter keeps count; plain regexes don't have candidates.
+        """
+        tried    = 0
+        rejected = 0
+        for clause in searchClauses:
+            tried    += getattr(clause.matcher, "candidatesTried", 0)
+            rejected += getattr(clause.matcher, "candidatesRejected", 0)
+        return tried, rejected
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class SearchStats:
+    """
+    Where one search's time went, and how much work it did.  An instrumented Searcher hangs one of these on
+    every SearchResult; nobody else bothers keeping track, so it costs nothing when you don't want it.
+
+    The timings (in seconds) are for each of the stages:  tokenizing the query, expanding the synonyms and then
+    the lemmas, compiling the regexes (all of which only happen when the plan wasn't already in the cache --
+    see isPlanCached), finding anchor matches, verifying the other clauses in each anchor's window, and working
+    out the KWIC text.  The counts are the anchors we looked at, the clause verifications we made, the windows
+    that didn't make a hit, and the blocks a BlockFilter let us skip (out of how many each window had).
+
+    Since the hits are found lazily, so are the stats:  they're complete once the SearchResult has found all its
+    hits, which is when we call the hook (if there is one).  The KWIC time keeps adding up as you ask for it.
+    """
+
+    stages = [ "tokenize", "synonyms", "lemmas", "compile", "anchor scan", "verification", "kwic" ]
+
+    def __init__ ( self, searchExpression, hook = None ):
+        self.searchExpression = searchExpression
+        self.hook             = hook
+        self.timings          = dict.fromkeys( self.stages, 0.0 )
+        self.isPlanCached     = False
+        self.isResultCached   = False
+        self.anchors          = 0   # How many anchor matches did we look at?
+        self.verifications    = 0   # ... how many times did we look for another clause in an anchor's window?
+        self.rejectedWindows  = 0   # ... and how many windows didn't make a hit?
+        self.blocks           = 0   # How many BlockFilter blocks were there (for each window)?
+        self.skippedBlocks    = 0   # ... and how many of them did we skip?
+        self.hits             = 0
+
+    def total ( self ):
+        """
+        Total time over all the stages.
+        """
+        return sum( self.timings.values() )
+
+    def finish ( self, searchResult ):
+        """
+        The search has found all its hits:  note how many, and let the hook know.
+        """
+        self.hits = len(searchResult.foundHits)
+        if self.hook is not None:
+            self.hook(searchResult)
+
+    def __str__ ( self ):
+        timings = ", ".join( [ "%s %.3fms" % (stage, self.timings[stage] * 1000.0) for stage in self.stages ] )
+        return "stats: %s%s; %d anchors, %d verifications, %d rejected windows, %d of %d blocks skipped, %d hits" % ( timings,
+            (" (plan cached)" if self.isPlanCached else "") + (" (result cached)" if self.isResultCached else ""), self.anchors, self.verifications, self.rejectedWindows,
+            self.skippedBlocks, self.blocks, self.hits )
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class Conjunction:
+    """
+    One AND window of a query:  the clauses that must all be in it (in compiled order), and the ones that mustn't.
+    """
+
+    def __init__ ( self, andClauses, searchClauses, excludedClauses ):
+        self.andClauses      = andClauses        # The clause text, as the user gave it
+        self.searchClauses   = searchClauses     # ... and a compiled SearchMatcher for each
+        self.excludedClauses = excludedClauses   # SearchMatchers for the clauses that mustn't be in the window
+
+class QueryPlan:
+    """
+    Everything SearchExecution.compilePlan() works out for a query before it ever looks at the content:  the
+    AND windows (Conjunctions) to look for, and a compiled SearchMatcher for each of their clauses.  Almost every
+    query is a single window, so the plan's own andClauses, searchClauses and excludedClauses are just the first
+    window's.  We also keep the ParseList and ParseTree around, mostly so verbose mode has something to print.
+    """
+
+    def __init__ ( self, parseList, conjunctions, parseTree = None ):
+        self.parseList       = parseList
+        self.parseTree       = parseTree
+        self.conjunctions    = conjunctions
+        first = (conjunctions or [ Conjunction([], [], []) ])[0]
+        self.andClauses      = first.andClauses
+        self.searchClauses   = first.searchClauses
+        self.excludedClauses = first.excludedClauses
+
+    def isSingleWindow ( self ):
+        """
+        Is this plan no more than one AND window?  Only those can be streamed, or split into segments.
+        """
+        return len(self.conjunctions) <= 1
+
+    def signature ( self ):
+        """
+        Everything about the plan that decides which hits it finds:  each window's clause regexes (in the order
+        the planner gets them, which breaks its ties) and its excluded ones, along with how fuzzy they are.  Two
+        queries that are spelled differently but compile the same -- "dog AND horse" and "dog horse" -- have the
+        same signature.
+        """
+        return tuple( [ ( tuple( [ (clause.regex, clause.fuzzy) for clause in conjunction.searchClauses ] ),
+                          tuple( [ (clause.regex, clause.fuzzy) for clause in conjunction.excludedClauses ] ) ) for conjunction in self.conjunctions ] )
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class ScanState:
+    """
+    How far a search has got:  for each of the plan's windows, where its next hit's bracket can begin (see
+    SearchExecution.windowHits()), and the end of the last hit we handed out.
+    """
+
+    def __init__ ( self, windowCount, scanStarts = None, lastEnd = -1 ):
+        self.scanStarts = scanStarts or [ 0 ] * windowCount
+        self.lastEnd    = lastEnd
+
+class SearchCursor:
+    """
+    Packs a ScanState into an opaque token (and back), so a page of hits can be followed by the next one without
+    searching the text before it again.  The token also carries a hash of the plan's signature, the engine and
+    a hash of the content's fingerprint, so a token can't be used to carry on a different search (or the same
+    one over content that's changed since):  that's a ValueError.
+    """
+
+    @staticmethod
+    def identity ( plan, content, engine ):
+        return "%s:%s:%s" % ( hashlib.sha1( repr(plan.signature()) ).hexdigest()[:16], engine,
+                              content.getFingerprint().encode("hex")[:16] )
+
+    @staticmethod
+    def encode ( plan, content, engine, scanState, hitCount ):
+        """
+        Return the token for a search that's handed out hitCount hits so far, and got to scanState.
+        """
+        state = [ CURSOR_VERSION, SearchCursor.identity(plan, content, engine), scanState.scanStarts, scanState.lastEnd, hitCount ]
+        return base64.urlsafe_b64encode( json.dumps(state, separators = (",", ":")) )
+
+    @staticmethod
+    def decode ( token, plan, content, engine ):
+        """
+        Unpack a token, returning its ( ScanState, hit count ).
+        """
+        try:
+            version, identity, scanStarts, lastEnd, hitCount = json.loads( base64.urlsafe_b64decode( str(token) ) )
+        except (TypeError, ValueError):
+            raise ValueError( "not a search cursor: %r" % token )
+        if version != CURSOR_VERSION or identity != SearchCursor.identity(plan, content, engine) or len(scanStarts) != len(plan.conjunctions):
+            raise ValueError( "the cursor is for a different search (or the content has changed)" )
+        return ScanState( len(scanStarts), scanStarts, lastEnd ), hitCount
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class QueryPlanCache:
+    """
+    A bounded LRU cache of QueryPlans, keyed by the normalized query string.  An OrderedDict keeps the entries in
+    least- to most-recently used order, so the one to throw out is always at the front.
+    """
+
+    def __init__ ( self, maxSize = PLAN_CACHE_SIZE ):
+        self.maxSize   = maxSize
+        self.plans     = OrderedDict()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def __len__ ( self ):
+        return len(self.plans)
+
+    def __str__ ( self ):
+        return "plans: %d/%d  hits: %d  misses: %d  evictions: %d" % (
+            len(self.plans), self.maxSize, self.hits, self.misses, self.evictions )
+
+    def get ( self, key ):
+        """
+        Return the cached plan for the key (and mark it as recently used), or None.
+        """
+        plan = self.plans.pop(key, None)
+        if plan is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.plans[key] = plan   # Re-inserting puts it at the most-recently-used end
+        return plan
+
+    def put ( self, key, plan ):
+        """
+        Add a plan, throwing out the least recently used ones if we're over our limit.
+        """
+        self.plans.pop(key, None)
+        self.plans[key] = plan
+        while len(self.plans) > self.maxSize:
+            self.plans.popitem(last = False)
+            self.evictions += 1
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class ResultCache:
+    """
+    A bounded LRU cache of search results -- just the hit offsets, never the KWIC text, which is cheap to work
+    out again from the content.  The key is the plan's signature (see QueryPlan.signature()), whether the terms
+    engine is doing the matching (it's the only one that finds different hits), and the content's fingerprint.
+    Since the fingerprint is a hash of the content itself, a document that changes can never be answered from
+    its old hits; and when we see the fingerprint of a document (a file, in a Corpus) change, we throw out
+    everything we had for its old one, rather than waiting for it to age out.
+
+    Each entry remembers how many hits it was asked for, so it can answer any search for that many or fewer --
+    or any search at all, if it found them all.
+
+    If you give us a spillDirectory, an entry we evict gets written there (with marshal) instead of being
+    forgotten, and a miss checks there before giving up.  The spill is bounded too, at maxSpilled files, and since
+    its files are named for their keys, a new process can pick them up where the last one left off.
+    """
+
+    def __init__ ( self, maxSize = RESULT_CACHE_SIZE, spillDirectory = None, maxSpilled = None ):
+        self.maxSize        = maxSize
+        self.spillDirectory = spillDirectory
+        self.maxSpilled     = maxSpilled or 8 * maxSize
+        self.results        = OrderedDict()   # Key --> ( hit limit, hits ), least recently used first
+        self.spilled        = OrderedDict()   # Key --> spill file path, oldest first
+        self.fingerprints   = {}              # Document path --> the fingerprint we last saw for it
+        self.hits           = 0
+        self.misses         = 0
+        self.spillHits      = 0               # (Also counted in the hits)
+        self.evictions      = 0
+        self.invalidations  = 0
+
+    def __len__ ( self ):
+        return len(self.results)
+
+    def __str__ ( self ):
+        return "results: %d/%d  hits: %d (%d spilled)  misses: %d  hit rate: %.1f%%  evictions: %d  invalidations: %d" % (
+            len(self.results), self.maxSize, self.hits, self.spillHits, self.misses, self.hitRate() * 100,
+            self.evictions, self.invalidations )
+
+    def hitRate ( self ):
+        """
+        The fraction of lookups we could answer.
+        """
+        if self.hits + self.misses == 0:
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+    def key ( self, plan, content, engine ):
+        """
+        Work out the key for a plan over some content, noticing (and dropping the old results) if the content
+        is a document we've seen before with a different fingerprint.
+        """
+        fingerprint = content.getFingerprint()
+        path        = getattr(content, "path", None)
+        if path is not None:
+            previous = self.fingerprints.get(path)
+            if previous is not None and previous != fingerprint:
+                self.invalidate(previous)
+            self.fingerprints[path] = fingerprint
+        return ( plan.signature(), engine == ENGINE_TERMS, fingerprint )
+
+    def get ( self, key, maxHits ):
+        """
+        Return the cached hits for the key (as lists of (start, end) pairs), if we have enough of them for
+        maxHits, or None.
+        """
+        entry = self.results.pop(key, None)
+        if entry is None:
+            entry = self.unspill(key)
+        if entry is None or not self.isEnough(entry, maxHits):
+            self.misses += 1
+            if entry is not None:
+                self.results[key] = entry
+            return None
+        self.hits += 1
+        self.results[key] = entry   # Re-inserting puts it at the most-recently-used end
+        limit, hits = entry
+        if maxHits is not None:
+            hits = hits[:maxHits]
+        return hits
+
+    def isEnough ( self, entry, maxHits ):
+        limit, hits = entry
+        return limit is None or len(hits) < limit or (maxHits is not None and maxHits <= limit)
+
+    def put ( self, key, maxHits, hits ):
+        """
+        Add the hits a search found (it found them all, or stopped at maxHits), throwing out the least recently
+        used entries if we're over our limit.
+        """
+        self.results.pop(key, None)
+        self.results[key] = ( maxHits, [ tuple( [ (highlight.start, highlight.end) for highlight in hit ] ) for hit in hits ] )
+        while len(self.results) > self.maxSize:
+            oldKey, oldEntry = self.results.popitem(last = False)
+            self.evictions += 1
+            self.spill( oldKey, oldEntry )
+
+    def invalidate ( self, fingerprint ):
+        """
+        Throw out everything we have for content with the given fingerprint, in memory and spilled.
+        """
+        for key in [ key for key in self.results if key[2] == fingerprint ]:
+            del self.results[key]
+            self.invalidations += 1
+        for key in [ key for key in self.spilled if key[2] == fingerprint ]:
+            self.removeSpilled(key)
+            self.invalidations += 1
+
+    def spillPath ( self, key ):
+        return os.path.join( self.spillDirectory, hashlib.sha1( repr(key) ).hexdigest() + ".hits" )
+
+    def spill ( self, key, entry ):
+        """
+        Write an evicted entry to the spill directory (if we have one), making room there if we need to.
+        """
+        if self.spillDirectory is None:
+            return
+        path = self.spillPath(key)
+        try:
+            f = open(path, "wb")
+            marshal.dump( (key, entry), f )
+            f.close()
+        except (IOError, OSError, ValueError):   # A full disk (or an unmarshalable key) just means it's forgotten
+            return
+        self.spilled.pop(key, None)
+        self.spilled[key] = path
+        while len(self.spilled) > self.maxSpilled:
+            self.removeSpilled( self.spilled.keys()[0] )
+
+    def unspill ( self, key ):
+        """
+        Read an entry back in from the spill directory, or return None if it isn't there.
+        """
+        if self.spillDirectory is None:
+            return None
+        path = self.spillPath(key)
+        try:
+            f = open(path, "rb")
+            spilledKey, entry = marshal.load(f)
+            f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if spilledKey != key:   # A hash collision, or somebody else's file
+            return None
+        self.removeSpilled(key)
+        self.spillHits += 1
+        return entry
+
+    def removeSpilled ( self, key ):
+        path = self.spilled.pop( key, None ) or self.spillPath(key)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class Searcher:
+    """
+    A long-lived front end for running lots of queries.  It loads the synonyms and lemmatizer once (by way of a
+    single SearchExecution), and keeps the compiled QueryPlans in a QueryPlanCache, so running a query we've
+    seen before skips the tokenizing, the synonym and lemma expansion and the regex compiles altogether.
+    """
+
+    whitespace = re.compile( "[ \n\r\t]+" )   # The whitespace the Tokenizer treats as a space
+
+    def __init__ ( self, planCacheSize = PLAN_CACHE_SIZE, isInstrumented = False, hook = None, resultCache = None ):
+        """
+        If you want to know where the time goes, make us instrumented:  every SearchResult we produce then has a
+        SearchStats in its .stats (otherwise it's None, and we don't spend any time keeping track).  If you hand
+        us a hook, we're instrumented whether you asked or not, and we call it with each SearchResult once we've
+        found all its hits -- say, to log the slow queries.
+
+        If you hand us a ResultCache, search() answers from it whenever it can, and fills it with every search
+        that runs to the end (or to its maxHits).  Verbose searches always run, since the point is to watch them.
+        """
+        self.tokenizer       = Tokenizer()
+        self.searchExecution = SearchExecution()
+        self.planCache       = QueryPlanCache(planCacheSize)
+        self.resultCache     = resultCache
+        self.hook            = hook
+        self.isInstrumented  = isInstrumented or hook is not None
+
+    def newStats ( self, searchExpression ):
+        """
+        Return a fresh SearchStats for a query, or None if we're not instrumented.
+        """
+        if not self.isInstrumented:
+            return None
+        return SearchStats( searchExpression, self.hook )
+
+    def normalizeQuery ( self, searchExpression ):
+        """
+        Collapse the whitespace in a query, so trivially different spellings of a query share a plan.  We
+        leave the case alone, since an uppercase AND or OR means something different to the tokenizer.
+        """
+        return " ".join( self.whitespace.split(searchExpression) ).strip()
+
+    def getPlan ( self, searchExpression, stats = None ):
+        """
+        Return the compiled plan for a query, from the cache if we can.  If we have to compile it, and you
+        hand us a SearchStats, we time the tokenizing and compiling.
+        """
+        key  = self.normalizeQuery(searchExpression)
+        plan = self.planCache.get(key)
+        if plan is None:
+            if stats is None:
+                plan = self.searchExecution.compilePlan( self.tokenizer.tokenize(key) )
+            else:
+                started   = time.time()
+                parseList = self.tokenizer.tokenize(key)
+                stats.timings["tokenize"] += time.time() - started
+                plan = self.searchExecution.compilePlan( parseList, stats )
+            self.planCache.put(key, plan)
+        elif stats is not None:
+            stats.isPlanCached = True
+        return plan
+
+    def getPlans ( self, searchExpressions, statses = None ):
+        """
+        getPlan() for a whole list of queries at once, returning their plans in the same order.  The ones that
+        aren't in the cache all get tokenized together (see Tokenizer.tokenizeAll()), and each distinct one is
+        compiled once.  The tokenizing is shared, so it doesn't show up in anybody's SearchStats.
+        """
+        if statses is None:
+            statses = [ None ] * len(searchExpressions)
+        keys       = [ self.normalizeQuery(searchExpression) for searchExpression in searchExpressions ]
+        firstStats = dict( reversed( zip(keys, statses) ) )   # The SearchStats for the first time each query turns up
+        plans      = {}
+        compiled   = []
+        for key in OrderedDict.fromkeys(keys):   # (One lookup for each distinct query)
+            plan = self.planCache.get(key)
+            if plan is None:
+                compiled.append(key)
+            else:
+                plans[key] = plan
+        cached = set(plans)
+        for key, parseList in zip( compiled, self.tokenizer.tokenizeAll(compiled) ):
+            plans[key] = self.searchExecution.compilePlan( parseList, firstStats[key] )
+            self.planCache.put( key, plans[key] )
+
+        for key, stats in zip(keys, statses):
+            if stats is not None and (key in cached or stats is not firstStats[key]):
+                stats.isPlanCached = True   # (In the cache already, or compiled for an earlier copy of the query)
+        return [ plans[key] for key in keys ]
+
+    def search ( self, searchExpression, content, isVerbose = False, engine = DEFAULT_ENGINE, maxHits = MAX_HITS ):
+        """
+        Run a query against some content, generating a SearchResult.
+        """
+        stats = self.newStats(searchExpression)
+        plan  = self.getVerbosePlan( searchExpression, isVerbose, stats )
+        if self.resultCache is None or isVerbose:
+            return self.searchExecution.executePlan( plan, content, isVerbose, engine, None, maxHits, stats )
+
+        key    = self.resultCache.key( plan, content, engine )
+        cached = self.resultCache.get( key, maxHits )
+        if cached is not None:
+            searchResult       = SearchResult(content)
+            searchResult.hits  = [ [ HitPosition(start, end) for start, end in hit ] for hit in cached ]
+            searchResult.stats = stats
+            if stats is not None:
+                stats.isResultCached = True
+                stats.finish(searchResult)
+            return searchResult
+
+        searchResult = self.searchExecution.executePlan( plan, content, isVerbose, engine, None, maxHits, stats )
+        if searchResult.hitSource is None:
+            self.resultCache.put( key, maxHits, searchResult.foundHits )
+        else:
+            searchResult.hitSource = self.cachingHits( searchResult, searchResult.hitSource, key, maxHits )
+        return searchResult
+
+    def cachingHits ( self, searchResult, hitSource, key, maxHits ):
+        """
+        Pass the hits through as they're found, and once there aren't any more, put them in the ResultCache.
+        (If nobody asks for the last one, they never get cached -- we don't know we've got them all.)
+        """
+        for highlights in hitSource:
+            yield highlights
+        self.resultCache.put( key, maxHits, searchResult.foundHits )
+
+    def searchPage ( self, searchExpression, content, pageSize = MAX_HITS, cursor = None, engine = DEFAULT_ENGINE ):
+        """
+        Return a SearchResult with the next pageSize hits:  the first ones, or the ones after the page the cursor
+        came with.  Its .cursor is the token for the page after it -- or None, if this page wasn't full, in which
+        case there aren't any more.  (A full page always gets a cursor, even if the next page turns out to be
+        empty:  we don't look past the hits we hand out.)
+
+        Carrying on from a cursor doesn't search the text before it again; none of the clauses even starts
+        looking until where the last page left off.  The hits are exactly the ones search() would have given
+        you with a big enough maxHits.
+        """
+        stats = self.newStats(searchExpression)
+        plan  = self.getPlan( searchExpression, stats )
+        if cursor is None:
+            scanState = ScanState( len(plan.conjunctions) )
+            hitCount  = 0
+        else:
+            scanState, hitCount = SearchCursor.decode( cursor, plan, content, engine )
+
+        searchResult = self.searchExecution.executePlan( plan, content, False, engine, None, pageSize, stats, scanState )
+        hitCount += len(searchResult.hits)   # (The whole page, so the ScanState is where it ended)
+        if pageSize > 0 and len(searchResult.hits) >= pageSize:   # (An empty page would just send you back here)
+            searchResult.cursor = SearchCursor.encode( plan, content, engine, scanState, hitCount )
+        return searchResult
+
+    def searchRanked ( self, searchExpression, content, k = MAX_HITS, isVerbose = False, engine = DEFAULT_ENGINE ):
+        """
+        Find the k best hits, rather than the first MAX_HITS, returning a SearchResult with them best-first
+        (and their scores in .scores).  See SearchExecution.executeRanked() for how we score them.
+        """
+        plan         = self.getVerbosePlan( searchExpression, isVerbose )
+        topHits      = TopHits(k)
+        searchResult = SearchResult(content)
+        searchResult.clausePlan = self.searchExecution.executeRanked( plan, content, topHits, isVerbose, engine )
+        rankedHits   = topHits.rankedHits()
+        searchResult.hits   = [ rankedHit.highlights for rankedHit in rankedHits ]
+        searchResult.scores = [ rankedHit.score for rankedHit in rankedHits ]
+        return searchResult
+
+    def searchBatch ( self, searchExpressions, content, isVerbose = False, engine = DEFAULT_ENGINE, maxHits = MAX_HITS ):
+        """
+        Run a whole list of queries against the same content, and return a list of SearchResults in the same
+        order.  This gives exactly the same hits as calling search() for each one with the same engine and
+        maxHits, but the plans are compiled together (see getPlans()), and the text isn't scanned once per query.
+
+        For the regex engine (and the index engine, on content that has no index, like a MappedContent), that's
+        a BatchScanner:  we pool the distinct clauses from all the queries and walk the text once for the lot
+        of them, and each query then checks its AND-window condition from those shared match lists.  The other
+        engines already run off structures the content builds once and shares between queries, so we just use
+        those.
+        """
+        statses = [ self.newStats(searchExpression) for searchExpression in searchExpressions ]
+        plans   = self.getPlans( searchExpressions, statses )
+        plans   = [ self.searchExecution.expandFuzzy(plan, content) for plan in plans ]   # (So the scanner has their words, too)
+
+        scanner = None
+        if engine == ENGINE_REGEX or (engine == ENGINE_INDEX and content.getIndex() is None):
+            scanner = BatchScanner( content.getSearchText(), [ clause for plan in plans for conjunction in plan.conjunctions
+                                                               for clause in conjunction.searchClauses + conjunction.excludedClauses ] )
+
+        searchResults = []
+        for searchExpression, plan, stats in zip(searchExpressions, plans, statses):
+            if isVerbose:
+                print "-->%s<--" % searchExpression
+                print plan.parseList
+            searchResults.append( self.searchExecution.executePlan( plan, content, isVerbose, engine, scanner, maxHits, stats ) )
+        return searchResults
+
+    def searchStream ( self, searchExpression, source, chunkSize = STREAM_CHUNK_SIZE, maxHits = None, clausePlan = None ):
+        """
+        Search a file-like object (a huge log file, or stdin) without ever holding the whole thing in memory,
+        generating StreamHits -- with their KWIC text already worked out -- as we find them.
+
+        We read chunkSize characters at a time, and only search for anchors we know we can decide:  ones far
+        enough from the end of what we've read that their whole bracket (plus a little STREAM_SLACK) is there.
+        The rest of the chunk gets carried over to the next pass, along with MATCH_WINDOW (and the slack) before
+        it, so a hit that straddles two chunks is still found, and found once.  All the offsets in the hits are
+        relative to the start of the source, not the chunk.
+
+        The clause order is planned from the first chunk we read, since we never get to see the rest of it all
+        at once, and then stuck to -- unless you pass in a clausePlan (say, from a SearchResult over similar
+        content), in which case we use its order.  Unlike search(), we don't stop at MAX_HITS unless you ask us to.
+        Only queries that come down to a single window (no OR between ANDs) can be streamed.
+        """
+        plan = self.getPlan(searchExpression)
+        if not plan.isSingleWindow():
+            raise ValueError( "can't stream a query with more than one window: %s" % searchExpression )
+        if len(plan.searchClauses) < 1 or (maxHits is not None and maxHits <= 0):
+            return
+        excluded = [ clause.matcher for clause in plan.excludedClauses ]
+
+        overlap     = MATCH_WINDOW + STREAM_SLACK
+        buffer      = ""      # What we've read and still need
+        bufferStart = 0       # Where the buffer starts in the source
+        anchorFrom  = 0       # Anchors before here have already been searched
+        scanStart   = 0       # Where the last hit left off
+        hitCount    = 0
+        isLast      = False
+
+        while not isLast:
+            chunk  = source.read(chunkSize)
+            isLast = len(chunk) == 0
+            buffer += chunk
+            bufferEnd = bufferStart + len(buffer)
+
+            if isLast:
+                anchorTo = bufferEnd
+            else:
+                anchorTo = bufferEnd - overlap
+                if anchorTo <= anchorFrom:   # Not enough to go on yet ... read some more
+                    continue
+
+            content = Content(buffer)
+            if clausePlan is None:
+                clausePlan = self.searchExecution.planner.orderClauses( plan.searchClauses, plan.andClauses, content )
+            streams     = [ MatchStream(estimate.searchMatcher.matcher, buffer) for estimate in clausePlan ]
+            chunkResult = SearchResult(content)
+
+            for highlights, nextScanStart in self.searchExecution.proximityHits( streams, len(buffer),
+                    max(scanStart - bufferStart, 0), anchorFrom - bufferStart, anchorTo - bufferStart, None, excluded ):
+                scanStart = nextScanStart + bufferStart
+                yield StreamHit( [ HitPosition(highlight.start + bufferStart, highlight.end + bufferStart) for highlight in highlights ],
+                                 chunkResult.calculateKWIC(highlights) )
+                hitCount += 1
+                if maxHits is not None and hitCount >= maxHits:
+                    return
+
+            # Keep what the next pass needs:  everything from one bracket (and the slack) before the next anchor on.
+            anchorFrom = anchorTo
+            keepFrom   = max( anchorFrom - overlap, bufferStart )
+            buffer      = buffer[ keepFrom - bufferStart : ]
+            bufferStart = keepFrom
+
+    def getVerbosePlan ( self, searchExpression, isVerbose, stats = None ):
+        """
+        getPlan(), printing the query and its ParseList along the way if we're being verbose.
+        """
+        if isVerbose:
+            print "-->%s<--" % searchExpression
+        plan = self.getPlan( searchExpression, stats )
+        if isVerbose:
+            print plan.parseList
+        return plan
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class SearchResult(object):
+    """
+    The results of a search.  Each hit consists of a set of HitPositions indicating the word hits.  We use
+    that for highlighting.
+
+    The hits are found lazily:  iterating over a SearchResult runs the search just far enough to hand you the
+    next hit, and a caller that stops after the first few never pays for finding the rest.  (Asking for .hits
+    gets you all of them, in a list.)  Likewise, the KWIC text is only worked out for the hits you ask for it
+    for -- see kwics() -- so if all you want is counts or offsets, that's all you pay for.
+
+    It's a little sleazy, but we store a reference to the content we searched to simplify the syntax for
+    printing out the results (so we can just directly fetch the KWIC text) ...
+    """
+
+    def __init__ (self, content, hitSource = None ):
+        self.foundHits  = []          # The hits we've found so far ...
+        self.hitSource  = hitSource   # ... and where the rest come from (None once we've got them all)
+        self.documentId = getattr(content, "documentId", None)   # Which document in a Corpus, if it came from one
+        self.candidatesTried    = 0   # How many prefilter candidates did we try the full regex on?  (Once we've got all the hits ...)
+        self.candidatesRejected = 0   # ... and how many of those didn't pan out?
+        self.clausePlan = []          # The ClauseEstimates, in the order we searched the clauses
+        self.scores     = []          # If the hits were ranked (see Searcher.searchRanked()), their scores
+        self.stats      = None        # A SearchStats, if the Searcher was instrumented
+        self.cursor     = None        # If it's one page of hits (see Searcher.searchPage()), the token for the next page
+        self.source  = content          # For the KWIC text ...
+        self.content = content.content  # Just save the actual string.  Sleazy, I know ...
+
+    def fetchHit ( self ):
+        """
+        Find one more hit, returning False if there aren't any.
+        """
+        if self.hitSource is None:
+            return False
+        try:
+            self.foundHits.append( self.hitSource.next() )
+            return True
+        except StopIteration:
+            self.hitSource = None
+            return False
+
+    def __iter__ ( self ):
+        i = 0
+        while i < len(self.foundHits) or self.fetchHit():
+            yield self.foundHits[i]
+            i += 1
+
+    def getHits ( self ):
+        while self.fetchHit():
+            pass
+        return self.foundHits
+
+    def setHits ( self, hits ):
+        self.foundHits = hits
+        self.hitSource = None
+
+    hits = property( getHits, setHits )   # Our hits keywords in context ...
+
+    def kwics ( self ):
+        """
+        Generate the KWIC text for each hit, as we get to it.
+        """
+        for hit in self:
+            if self.stats is None:
+                yield self.calculateKWIC(hit)
+            else:
+                started = time.time()
+                kwic    = self.calculateKWIC(hit)
+                self.stats.timings["kwic"] += time.time() - started
+                yield kwic
+
+    def calculateKWIC ( self, hit ):
+        """
+        Given a hit (list of matches), calculate the KWIC (keyword in context) text for it ...
+
+        We start PRECEDING_CHARS before the first match -- backed up to the start of its word -- and run
+        to FOLLOWING_CHARS past the last match we show, out to the end of its word.  The content can tell
+        us where all its spaces are, so finding the ends of those words is just a bisect.
+        """
+        spaces = self.source.getSpaces()
+        text   = self.source.getSearchText()
+        pieces = []
+        length = 0
+
+        startKWIC = hit[0].start - PRECEDING_CHARS
+        if startKWIC > 0:   # Now move backwards until we find a space ...
+            if spaces is not None:
+                i = bisect_left(spaces, startKWIC) - 1
+                startKWIC = spaces[i] + 1 if i >= 0 else 0
+            else:
+                startKWIC = text.rfind(" ", 0, startKWIC) + 1
+
+        # OK, now move forward, building up the text, until we run out of matches, or we exceed
+        # our maximum KWIC text length ...
+        for highlight in hit:  # For each match in our list of matches ...
+
+            start = highlight.start
+            end   = highlight.end
+            if start > startKWIC:
+                before = self.content[ startKWIC : start ]   # Add the text before our match
+                pieces.append( before )
+                length += len(before)
+            matched = self.content[ start : end ]
+            pieces.extend( [ "<<", matched, ">>" ] )   # Add in the matched text, highlighted
+            length += len(matched) + 4
+
+            startKWIC = end
+
+            if length > MAX_KWIC_CHARS:  # OK, too long ... no more highlights
+                break
+
+        # Now, take some text off the end ...
+        endKWIC = startKWIC + FOLLOWING_CHARS
+
+        # Really, we ought to not add additional end text if we've already exceeded our max length, but
+        # it's getting close to dinner time ... so that's left as an exercise for the reader ... <g>
+
+        if endKWIC < len(self.content):
+            if spaces is not None:
+                i = bisect_left(spaces, endKWIC)
+                endKWIC = spaces[i] if i < len(spaces) else len(self.content)
+            else:
+                endKWIC = text.find(" ", endKWIC)
+                if endKWIC < 0:
+                    endKWIC = len(self.content)
+
+        pieces.append( self.content[startKWIC:endKWIC] )
+
+        return "".join(pieces)
+
+
+    def __str__ ( self ):
+        """
+        Produce a string for simple printing of results ...
+        """
+        return "".join( [ "\n---\n" + kwic for kwic in self.kwics() ] )
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class StreamHit:
+    """
+    A hit found by Searcher.searchStream().  By the time you get it, the text it was found in may be long gone,
+    so we carry the KWIC text along with the (absolute) highlight positions.
+    """
+
+    def __init__ ( self, highlights, kwic ):
+        self.highlights = highlights
+        self.kwic       = kwic
+
+    def __str__ ( self ):
+        return self.kwic
+
+class RankedHit(object):
+    """
+    One of the hits a TopHits is holding on to:  its score, and where (and in what) it was found.
+    """
+    __slots__ = ( "score", "sequence", "content", "documentId", "spanStart", "spanEnd", "highlights" )
+
+    def __init__ ( self, score, sequence, content, spanStart, spanEnd, highlights ):
+        self.score      = score
+        self.sequence   = sequence    # The order it was found in, for breaking ties
+        self.content    = content
+        self.documentId = getattr(content, "documentId", None)
+        self.spanStart  = spanStart
+        self.spanEnd    = spanEnd
+        self.highlights = highlights
+
+    def kwic ( self ):
+        return SearchResult(self.content).calculateKWIC(self.highlights)
+
+    def __str__ ( self ):
+        return self.kwic()
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class TopHits:
+    """
+    Keeps the k best-scoring windows offered to it (see SearchExecution.executeRanked()), in a min-heap, so
+    the worst of them -- the one a new window has to beat -- is always right on top.
+
+    Windows from nearby anchors usually overlap, and they're usually all about as good as each other, so we
+    don't let overlapping windows (from the same content) both in:  a new window only gets in if it beats
+    every one it overlaps, and then it replaces them.  Ties go to whichever was found first.
+    """
+
+    def __init__ ( self, k = MAX_HITS ):
+        self.k        = k
+        self.heap     = []   # [ score, -sequence, RankedHit ] lists
+        self.sequence = 0
+        self.windowsScored    = 0   # How many windows did we work out a score for?
+        self.windowsSkipped   = 0   # ... and how many did we give up on because they couldn't make it in?
+        self.documentsSkipped = 0   # How many whole documents couldn't make it in?
+
+    def __len__ ( self ):
+        return len(self.heap)
+
+    def __str__ ( self ):
+        return "ranked: %d windows scored, %d skipped, %d documents skipped" % ( self.windowsScored, self.windowsSkipped, self.documentsSkipped )
+
+    def isFull ( self ):
+        return len(self.heap) >= self.k
+
+    def threshold ( self ):
+        """
+        The score a window has to beat to get in, once we're full.
+        """
+        return self.heap[0][0]
+
+    def offer ( self, score, content, spanStart, spanEnd, highlights ):
+        """
+        Consider a window, returning True if we kept it.
+        """
+        self.sequence += 1
+        overlapping = [ entry for entry in self.heap
+                        if entry[2].content is content and entry[2].spanStart < spanEnd and spanStart < entry[2].spanEnd ]
+        for entry in overlapping:
+            if entry[0] >= score:
+                return False
+        if self.isFull() and len(overlapping) == 0 and score <= self.threshold():
+            return False
+
+        if len(overlapping) > 0:
+            self.heap = [ entry for entry in self.heap if entry not in overlapping ]
+            heapq.heapify(self.heap)
+        heapq.heappush( self.heap, [ score, -self.sequence, RankedHit(score, self.sequence, content, spanStart, spanEnd, highlights) ] )
+        if len(self.heap) > self.k:
+            heapq.heappop(self.heap)
+        return True
+
+    def rankedHits ( self ):
+        """
+        Return the RankedHits we kept, best first.
+        """
+        rankedHits = [ entry[2] for entry in self.heap ]
+        rankedHits.sort( lambda x, y: cmp(y.score, x.score) or cmp(x.sequence, y.sequence) )
+        return rankedHits
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class Content:
+    """
+    This is just what we're going to search against.  For testing purposes, we just read the SEARCH_FILE_NAME
+    and run our search against that (unless you hand us the text yourself).
+
+    If you give us an indexPath, the positional index comes out of that IndexFile (see loadIndex()), which is
+    built the first time, and rebuilt whenever the content changes -- so only the first run pays for it.  And
+    if you say it isn't isBlockFiltered, every search looks at every block of it (see BlockFilter).
+    """
+
+    spacePattern = re.compile(" ")
+
+    def __init__ (self, text = None, indexPath = None, isBlockFiltered = True):
+        if text is None:
+            f = open(SEARCH_FILE_NAME, 'r')
+            text = f.read()    # Load the contents of the file ...
+        self.content   = text
+        self.indexPath = indexPath
+        self.isBlockFiltered = isBlockFiltered
+        self.index     = None      # Built the first time somebody asks for it
+        self.prefilter = None      # Ditto
+        self.termIndex = None      # Ditto
+        self.blockFilter = None    # Ditto
+        self.vocabulary  = None    # Ditto
+        self.spaces    = None      # Ditto
+        self.fingerprint = None    # Ditto
+
+    def getSearchText ( self ):
+        """
+        Return the text the matchers should run over.  For us, that's just the string.
+        """
+        return self.content
+
+    def getIndex ( self ):
+        """
+        Return the positional index over our content, building it if this is the first time through.
+        """
+        if self.index is None:
+            if self.indexPath is None:
+                self.index = PositionalIndex(self.content)
+            else:
+                self.index = loadIndex( self.content, self.indexPath )
+        return self.index
+
+    def getPrefilter ( self ):
+        """
+        Return the literal prefilter over our content, building it if this is the first time through.
+        """
+        if self.prefilter is None:
+            self.prefilter = LiteralPrefilter(self.content)
+        return self.prefilter
+
+    def getBlockFilter ( self ):
+        """
+        Return the per-block term filters over our content, building them if this is the first time through.
+        """
+        if not self.isBlockFiltered:
+            return None
+        if self.blockFilter is None:
+            self.blockFilter = BlockFilter( self.getPrefilter().folded )
+        return self.blockFilter
+
+    def getVocabulary ( self ):
+        """
+        Return the TermVocabulary of our content, building it if this is the first time through.
+        """
+        if self.vocabulary is None:
+            self.vocabulary = TermVocabulary( self.getPrefilter().folded )
+        return self.vocabulary
+
+    def getTermIndex ( self ):
+        """
+        Return the analyzed terms of our content, analyzing them if this is the first time through.
+        """
+        if self.termIndex is None:
+            self.termIndex = TermIndex(self.content)
+        return self.termIndex
+
+    def getFingerprint ( self ):
+        """
+        Return a hash of our content (see IndexFile.fingerprint()), working it out if this is the first time through.
+        """
+        if self.fingerprint is None:
+            self.fingerprint = IndexFile.fingerprint(self.content)
+        return self.fingerprint
+
+    def getSpaces ( self ):
+        """
+        Return the (ascending) offsets of every space in our content, for the KWIC text, finding them if this
+        is the first time through.
+        """
+        if self.spaces is None:
+            self.spaces = array( 'l', [ match.start() for match in self.spacePattern.finditer(self.content) ] )
+        return self.spaces
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class MappingPool:
+    """
+    Keeps a bounded number of files memory-mapped.  Every open mapping holds on to a file descriptor, so if
+    we mapped a directory of thousands of documents all at once we'd run out.  Instead, we keep the most
+    recently used maxOpen of them mapped (in an OrderedDict, least recently used first), and unmap the oldest
+    when we need room.  Asking for one that's been unmapped just maps it again.
+
+    This isn't thread-safe:  don't share a pool between threads.
+    """
+
+    def __init__ ( self, maxOpen = MAX_OPEN_MAPPINGS ):
+        self.maxOpen   = maxOpen
+        self.mappings  = OrderedDict()   # Path --> mmap
+        self.fingerprints = {}           # Path --> ( (size, modification time), fingerprint ), for MappedContent
+        self.opens     = 0
+        self.evictions = 0
+
+    def acquire ( self, path ):
+        """
+        Return a read-only mapping of the file (mapping it if need be), and mark it as recently used.
+        An empty file can't be mapped, so we just hand back an empty string for those.
+        """
+        mapping = self.mappings.pop(path, None)
+        if mapping is None:
+            f = open(path, 'rb')
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    mapping = ""
+                else:
+                    mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            finally:
+                f.close()   # The mapping keeps its own descriptor
+            self.opens += 1
+        self.mappings[path] = mapping
+
+        while len(self.mappings) > self.maxOpen:
+            oldest = self.mappings.popitem(last = False)[1]
+            if not isinstance(oldest, str):
+                oldest.close()
+            self.evictions += 1
+
+        return mapping
+
+    def close ( self ):
+        """
+        Unmap everything.
+        """
+        while len(self.mappings) > 0:
+            mapping = self.mappings.popitem()[1]
+            if not isinstance(mapping, str):
+                mapping.close()
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class MappedText:
+    """
+    Looks enough like a string (len(), indexing and slicing) for a SearchResult to work out its KWIC text,
+    but goes through the MappingPool every time, so it doesn't matter if the document has been unmapped in the
+    meantime.  Slicing a mapping only copies out the slice, so we never pull the whole document into a string.
+    """
+
+    def __init__ ( self, pool, path, length ):
+        self.pool   = pool
+        self.path   = path
+        self.length = length
+
+    def __len__ ( self ):
+        return self.length
+
+    def __getitem__ ( self, key ):
+        return self.pool.acquire(self.path)[key]
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class MappedContent:
+    """
+    One document in a Corpus.  It can stand in for a Content anywhere we search, but the matchers run straight
+    over the memory-mapped file:  the clause regexes are byte-string patterns, which re is happy to run over
+    an mmap.  We don't build a prefilter or an index for these, since both would mean copying the document.
+    """
+
+    def __init__ ( self, pool, path, documentId ):
+        self.pool       = pool
+        self.path       = path
+        self.documentId = documentId
+        self.content    = MappedText( pool, path, len(pool.acquire(path)) )   # For the SearchResult
+
+    def getSearchText ( self ):
+        """
+        Return the mapping itself, for the matchers to run over.
+        """
+        return self.pool.acquire(self.path)
+
+    def getPrefilter ( self ):
+        return None
+
+    def getBlockFilter ( self ):
+        return None
+
+    def getVocabulary ( self ):
+        return None
+
+    def getIndex ( self ):
+        return None
+
+    def getTermIndex ( self ):
+        return None
+
+    def getFingerprint ( self ):
+        """
+        Return a hash of the document.  Hashing means reading the whole thing, so the pool remembers it for as
+        long as the file's size and modification time stay the same.
+        """
+        status = os.stat(self.path)
+        stamp  = ( status.st_size, status.st_mtime )
+        cached = self.pool.fingerprints.get(self.path)
+        if cached is None or cached[0] != stamp:
+            cached = self.pool.fingerprints[self.path] = ( stamp, IndexFile.fingerprint( self.getSearchText() ) )
+        return cached[1]
+
+    def getSpaces ( self ):
+        return None   # The KWIC text can just look for them in the mapping
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class Corpus:
+    """
+    A directory (or list) of documents to search, memory-mapped through a shared MappingPool.  The document id
+    is the path relative to the directory, and each SearchResult we produce is tagged with it.
+    """
+
+    def __init__ ( self, paths, maxOpen = MAX_OPEN_MAPPINGS ):
+        """
+        Take either a directory (which we walk, in sorted order), or a list of file paths.
+        """
+        self.pool      = MappingPool(maxOpen)
+        self.documents = []   # (Document id, path) pairs
+
+        if isinstance(paths, str):
+            for directory, subdirectories, fileNames in os.walk(paths):
+                subdirectories.sort()
+                for fileName in sorted(fileNames):
+                    path = os.path.join(directory, fileName)
+                    self.documents.append( (os.path.relpath(path, paths), path) )
+        else:
+            for path in paths:
+                self.documents.append( (path, path) )
+
+    def __len__ ( self ):
+        return len(self.documents)
+
+    def getContent ( self, documentId ):
+        """
+        Return a MappedContent for one of our documents.
+        """
+        for candidateId, path in self.documents:
+            if candidateId == documentId:
+                return MappedContent( self.pool, path, documentId )
+        raise KeyError(documentId)
+
+    def search ( self, searchExpression, isVerbose = False, searcher = None, maxHits = MAX_HITS ):
+        """
+        Run a query against every document, and return a SearchResult (tagged with its documentId) for each one
+        that had any hits, in document order.  The maxHits limit is per document; see ParallelSearcher for
+        an overall limit.
+        """
+        if searcher is None:
+            searcher = getDefaultSearcher()
+        searchResults = []
+        for documentId, path in self.documents:
+            if isVerbose:
+                print "=== %s ===" % documentId
+            searchResult = searcher.search( searchExpression, MappedContent(self.pool, path, documentId), isVerbose, ENGINE_REGEX, maxHits )
+            if len(searchResult.hits) > 0:
+                searchResults.append(searchResult)
+        return searchResults
+
+    def searchRanked ( self, searchExpression, k = MAX_HITS, isVerbose = False, searcher = None, isPruning = True ):
+        """
+        Find the k best hits across all the documents, returning them as RankedHits, best first.  The documents
+        all feed one TopHits, so the better the hits we've already got, the more windows (and whole documents)
+        we can skip in the ones after.
+        """
+        if searcher is None:
+            searcher = getDefaultSearcher()
+        plan    = searcher.getPlan(searchExpression)
+        topHits = TopHits(k)
+        for documentId, path in self.documents:
+            if isVerbose:
+                print "=== %s ===" % documentId
+            searcher.searchExecution.executeRanked( plan, MappedContent(self.pool, path, documentId), topHits, isVerbose, ENGINE_REGEX, isPruning )
+        return topHits.rankedHits()
+
+    def close ( self ):
+        self.pool.close()
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class ParallelSearcher:
+    """
+    Searches the documents of a Corpus in a pool of worker processes.  re holds the GIL while it matches, so
+    threads wouldn't buy us anything -- but separate processes can each keep a core busy.
+
+    Each worker sets itself up once, when the pool starts (see initSearchWorker()):  it gets its own Searcher
+    (so it reads the synonyms once), compiles the plans for any queries we were told about up front, and opens
+    its own MappingPool.  After that a task is just "search this document", and the worker sends back the hit
+    offsets, which are cheap to ship between processes.  We put the SearchResults back together in document
+    order, so the results are the same however the work got scheduled.
+
+    With a maxHits limit, we stop as soon as the documents we've collected (in order) add up to enough hits,
+    and tell the workers to skip whatever tasks are still queued for that search.
+    """
+
+    def __init__ ( self, corpus, processes = None, queries = () ):
+        self.corpus     = corpus
+        self.generation = 0                                   # Which search we're on
+        self.cancelled  = multiprocessing.Value('i', 0)      # Searches up to this one have been cancelled
+        self.pool       = multiprocessing.Pool( processes, initSearchWorker, (list(queries), self.cancelled) )
+
+    def search ( self, searchExpression, maxHits = MAX_HITS ):
+        """
+        Run a query against every document, and return a SearchResult (tagged with its documentId) for each one
+        that had any hits, in document order, with no more than maxHits hits in total (or all of them, if
+        maxHits is None).
+        """
+        if maxHits is not None and maxHits <= 0:
+            return []
+        self.generation += 1
+        tasks = [ (self.generation, searchExpression, maxHits, documentId, path) for documentId, path in self.corpus.documents ]
+
+        searchResults = []
+        hitCount      = 0
+        for documentId, path, offsets in self.pool.imap( searchDocumentTask, tasks ):
+            if len(offsets) == 0:
+                continue
+            if maxHits is not None:
+                offsets = offsets[ : maxHits - hitCount ]
+            searchResult = SearchResult( MappedContent(self.corpus.pool, path, documentId) )
+            searchResult.hits = [ [ HitPosition(start, end) for start, end in hit ] for hit in offsets ]
+            searchResults.append(searchResult)
+            hitCount += len(offsets)
+            if maxHits is not None and hitCount >= maxHits:
+                self.cancelled.value = self.generation   # Anything still queued for this search can be skipped
+                break
+
+        return searchResults
+
+    def close ( self ):
+        self.pool.close()
+        self.pool.join()
+
+# Each worker process's warm state, set up by initSearchWorker() ...
+workerSearcher    = None
+workerMappingPool = None
+workerCancelled   = None
+
+def initSearchWorker ( queries, cancelled ):
+    """
+    Get a ParallelSearcher worker process ready:  load the synonyms, compile the plans we know we'll need,
+    and open a MappingPool.
+    """
+    global workerSearcher, workerMappingPool, workerCancelled
+    workerSearcher    = Searcher()
+    workerMappingPool = MappingPool()
+    workerCancelled   = cancelled
+    workerSearcher.getPlans(queries)
+
+def searchDocumentTask ( task ):
+    """
+    Search one document in a worker process, returning its hits as lists of (start, end) offsets.
+    """
+    generation, searchExpression, maxHits, documentId, path = task
+    if generation <= workerCancelled.value:   # We already have enough hits for this search
+        return documentId, path, []
+    content      = MappedContent( workerMappingPool, path, documentId )
+    searchResult = workerSearcher.search( searchExpression, content, False, ENGINE_REGEX, maxHits )
+    return documentId, path, hitOffsets(searchResult)
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class SegmentedSearcher:
+    """
+    Searches one big document in a pool of worker processes -- the ParallelSearcher doesn't help when all
+    the text is in a single file.
+
+    The document is split into segments, and each worker finds every clause's matches that start in the
+    segments it's given.  A worker searches a little past the end of its segment (twice MATCH_WINDOW), so
+    the segments overlap, but a match only belongs to the segment it starts in, so nothing is found twice.
+    All the offsets are into the whole document.
+
+    Nobody copies the text:  the workers read it out of shared memory.  If the content is already memory-
+    mapped (a MappedContent), they use that mapping; otherwise we copy it once into an anonymous shared
+    mapping, and the workers get it when the pool forks.  (So create the SegmentedSearcher before the content
+    gets any bigger ...)
+
+    The proximity search itself stays in this process.  Where each hit's bracket can start depends on where
+    the last one left off, so there's no splitting it up without getting different hits at the seams -- but
+    it's only walking through lists of offsets, which is cheap next to running the regexes over the text.
+    We run it on each segment as soon as the segments before it are in, the same way Searcher.searchStream()
+    runs on chunks, so with a maxHits limit we can stop (and tell the workers to skip the rest) early.  The
+    clause order comes from the QueryPlanner, exactly as for Searcher.search() on the same content, so we
+    give exactly the same hits.
+    """
+
+    def __init__ ( self, content, processes = None, segmentChars = None, queries = () ):
+        self.content    = content
+        self.searcher   = Searcher()
+        self.generation = 0                                   # Which search we're on
+        self.cancelled  = multiprocessing.Value('i', 0)      # Searches up to this one have been cancelled
+
+        text = content.getSearchText()
+        self.length = len(text)
+        if isinstance(text, mmap.mmap):
+            self.sharedText = text
+        else:
+            self.sharedText = mmap.mmap( -1, max(self.length, 1) )   # Can't map nothing at all ...
+            self.sharedText.write(text)
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if segmentChars is None:
+            segmentChars = max( self.length / (processes * SEGMENTS_PER_PROCESS) + 1, MIN_SEGMENT_CHARS )
+        self.segments = [ (start, min(start + segmentChars, self.length)) for start in range(0, self.length, segmentChars) ]
+
+        self.pool = multiprocessing.Pool( processes, initSegmentWorker, (self.sharedText, list(queries), self.cancelled) )
+
+    def search ( self, searchExpression, maxHits = MAX_HITS ):
+        """
+        Run a query against the document, returning a SearchResult with up to maxHits hits (or all of them, if
+        maxHits is None).  Like Searcher.searchStream(), we only do queries that come down to a single window.
+        """
+        execution    = self.searcher.searchExecution
+        plan         = self.searcher.getPlan(searchExpression)
+        searchResult = SearchResult(self.content)
+        if not plan.isSingleWindow():
+            raise ValueError( "can't segment a query with more than one window: %s" % searchExpression )
+        if len(plan.searchClauses) < 1 or (maxHits is not None and maxHits <= 0):
+            return searchResult
+        excluded = [ clause.matcher for clause in plan.excludedClauses ]   # These we check here, in the bracket
+
+        clausePlan = execution.planner.orderClauses( plan.searchClauses, plan.andClauses, self.content )
+        streams    = [ estimate.startStream(None, self.sharedText) for estimate in clausePlan ]
+        order      = [ plan.searchClauses.index(estimate.searchMatcher) for estimate in clausePlan ]   # The workers send them in compiled order
+        searchResult.clausePlan = clausePlan
+
+        self.generation += 1
+        overlap = 2 * MATCH_WINDOW
+        tasks   = [ (self.generation, searchExpression, start, end, min(end + overlap, self.length)) for start, end in self.segments ]
+
+        anchorFrom = 0   # Anchors before here have already been searched
+        scanStart  = 0   # Where the last hit left off
+        for (start, end), segmentMatches in zip( self.segments, self.pool.imap(scanSegmentTask, tasks) ):
+            for stream, clause in zip(streams, order):
+                stream.extend( *segmentMatches[clause] )
+
+            # Only search the anchors whose whole bracket we've got the matches for (see Searcher.searchStream()) ...
+            if end == self.length:
+                anchorTo = end
+            else:
+                anchorTo = end - MATCH_WINDOW - STREAM_SLACK
+                if anchorTo <= anchorFrom:
+                    continue
+
+            for highlights, scanStart in execution.proximityHits( streams, self.length, scanStart, anchorFrom, anchorTo, None, excluded ):
+                searchResult.hits.append( highlights )
+                if maxHits is not None and len(searchResult.hits) >= maxHits:
+                    self.cancelled.value = self.generation   # Anything still queued for this search can be skipped
+                    return searchResult
+            anchorFrom = anchorTo
+
+        return searchResult
+
+    def close ( self ):
+        self.pool.close()
+        self.pool.join()
+
+# ... and a SegmentedSearcher worker's view of the document.
+workerSharedText = None
+
+def initSegmentWorker ( sharedText, queries, cancelled ):
+    """
+    Get a SegmentedSearcher worker process ready:  everything a ParallelSearcher worker needs, plus the text.
+    """
+    global workerSharedText
+    initSearchWorker( queries, cancelled )
+    workerSharedText = sharedText
+
+def scanSegmentTask ( task ):
+    """
+    Find every match of every clause (in compiled order) that starts in one segment of the shared text,
+    returning a (starts, ends) pair of arrays for each.  We don't search past scanEnd, so a match that runs
+    up to it might have been cut short:  we check any of those against the whole text.
+    """
+    generation, searchExpression, start, end, scanEnd = task
+    plan    = workerSearcher.getPlan(searchExpression)
+    matches = []
+    for clause in plan.searchClauses:
+        starts = array('l')
+        ends   = array('l')
+        if generation > workerCancelled.value:
+            match = clause.matcher.search( workerSharedText, start, scanEnd )
+            while match is not None and match.start() < end:
+                matchStart = match.start()
+                if match.end() >= scanEnd - 1 and scanEnd < len(workerSharedText):
+                    match = clause.matcher.match( workerSharedText, matchStart )
+                if match is not None:
+                    starts.append( match.start() )
+                    ends.append( match.end() )
+                match = clause.matcher.search( workerSharedText, matchStart + 1, scanEnd )
+        matches.append( (starts, ends) )
+    return matches
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class PositionalIndex:
+    """
+    A positional inverted index over some text.  We tokenize the text exactly once, using the same boundary
+    characters the clause regexes use (SearchExecution.wordBoundaries), and remember where every token starts
+    and ends.  The postings map each token key to the (ascending) list of token ordinals where it occurs.
+
+    The key is the TermAnalyzer's:  the lowercased token (with a section symbol in front of a number folded to an
+    "s") with any trailing "s"es stripped off.  That's deliberately sloppy: it's the same folding the Lemmatizer's
+    "[s]*" suffix does, so "horse", "horses" and "horsess" all land in the
+    same posting list, and we never miss a token the regex would have matched.  It also means that a posting is
+    only a *candidate* -- the clause regex still gets the final say.
+
+    If you give us a vocabulary (a set of token keys), we only keep postings for those keys.  That's a lot
+    cheaper to build when you already know which terms you're going to look up.
+    """
+
+    tokenPattern = re.compile( "[^" + SearchExecution.wordBoundaries[1:] + "+" )   # Runs of anything that isn't a boundary
+
+    def __init__ ( self, text, vocabulary = None ):
+        self.tokenStarts = []   # Character offset where each token starts
+        self.tokenEnds   = []   # ... and where it ends
+        self.postings    = {}   # Token key --> list of token ordinals
+        self.clauseMatchers = {}   # Clause regex --> IndexedClauseMatcher, since they only depend on us
+
+        ordinal = 0
+        for match in self.tokenPattern.finditer(text):
+            self.tokenStarts.append(match.start())
+            self.tokenEnds.append(match.end())
+            key = self.termKey(match.group())
+            if vocabulary is None or key in vocabulary:
+                self.postings.setdefault( key, [] ).append(ordinal)
+            ordinal += 1
+
+    @staticmethod
+    def termKey ( term ):
+        """
+        Fold a term (or token) down to the key we file it under:  the TermAnalyzer's key for it.
+        """
+        return TermAnalyzer.normalize(term)
+
+    @staticmethod
+    def splitTerm ( term ):
+        """
+        Break a query term up the same way we broke up the content.  Returns the number of boundary
+        characters in front of the first token, and the list of tokens.  E.g., "(a)" is (1, ["a"]), and
+        "i.r.c" is (0, ["i", "r", "c"]).
+        """
+        tokens  = []
+        leading = len(term)
+        for match in PositionalIndex.tokenPattern.finditer(term):
+            if len(tokens) == 0:
+                leading = match.start()
+            tokens.append(match.group())
+        return leading, tokens
+
+    def getClauseMatcher ( self, searchMatcher ):
+        """
+        Return an IndexedClauseMatcher for a clause, reusing the one we built last time if we've seen it.
+        """
+        if searchMatcher.regex not in self.clauseMatchers:
+            self.clauseMatchers[searchMatcher.regex] = IndexedClauseMatcher(self, searchMatcher)
+        return self.clauseMatchers[searchMatcher.regex]
+
+    def phraseOrdinals ( self, tokens ):
+        """
+        Merge the postings for a run of tokens, returning the ordinals where the whole run occurs in order.
+        """
+        ordinals = self.postings.get( self.termKey(tokens[0]), [] )
+        for offset in range(1, len(tokens)):
+            following = set( self.postings.get( self.termKey(tokens[offset]), [] ) )
+            ordinals = [ ordinal for ordinal in ordinals if ordinal + offset in following ]
+        return ordinals
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class IndexedClauseMatcher:
+    """
+    Stands in for a compiled clause regex, but only tries the regex at the offsets where the PositionalIndex
+    says the clause could start.  Since it has the same search() signature as a compiled regex, executeSearch
+    doesn't need to know which one it's holding.
+
+    Each clause regex looks like "(^|boundary)term($|boundary)", so a match always starts on the boundary
+    character just before the term (or at the very start of the text).  We merge the postings for each synonym
+    to get the token where the term would start, back up over any leading punctuation in the term (e.g., the
+    "(" in "(a)"), and one more for the boundary character.  Those are our candidates.
+
+    The one wrinkle is a search with an endpos:  the regex treats endpos as the end of the string, so "$" can
+    match there, and "horse" will match the front half of "horsefly" if the window happens to cut it.  The
+    index can't know about that, so we also try the handful of tokens right in front of endpos.
+    """
+
+    def __init__ ( self, index, searchMatcher ):
+        self.index     = index
+        self.matcher   = searchMatcher.matcher   # The regex still gets the final say
+        self.verified  = {}                      # Candidate offset --> match (or None) against the full text
+        self.leadings  = set()                   # All the distinct leading-punctuation lengths of our terms
+        self.maxTokens = 1                       # Longest term, in tokens
+        self.isFallback = False                  # Couldn't index a term?  Then just use the regex.
+
+        candidates = set()
+        for variant in searchMatcher.variants:
+            leading, tokens = index.splitTerm(variant)
+            if len(tokens) == 0:   # All punctuation ... nothing to look up, so we'll have to scan for it.
+                self.isFallback = True
+                break
+            self.leadings.add(leading)
+            self.maxTokens = max(self.maxTokens, len(tokens))
+            for ordinal in index.phraseOrdinals(tokens):
+                candidate = self.candidateFor(ordinal, leading)
+                if candidate is not None:
+                    candidates.add(candidate)
+
+        self.candidates = sorted(candidates)
+
+    def candidateFor ( self, ordinal, leading ):
+        """
+        Where would a match for a term start, if its first token is at the given ordinal?
+        """
+        candidate = self.index.tokenStarts[ordinal] - leading - 1
+        if candidate < -1:   # Not enough room in front of the token for the leading punctuation
+            return None
+        return max(candidate, 0)   # -1 means the term starts the text, and the regex matches "^" at 0
+
+    def search ( self, text, pos = 0, endpos = None ):
+        """
+        Same as a compiled regex's search(), but driven off our candidates.
+        """
+        if endpos is None or endpos > len(text):
+            endpos = len(text)
+
+        if self.isFallback:
+            return self.matcher.search( text, pos, endpos )
+
+        # Everything before edgeStart is far enough away from endpos that truncating the text can't change
+        # whether (or how) it matches.  Anything after it has to be tried against the truncated text.  (There
+        # are only ever a handful of those, so we don't copy the rest of the candidates to add them in.)
+        edgeStart      = endpos
+        edgeCandidates = []
+        candidates     = self.candidates
+        if endpos < len(text):
+            tokenStarts = self.index.tokenStarts
+            lastToken   = bisect_left(tokenStarts, endpos) - 1
+            firstToken  = max(lastToken - self.maxTokens, 0)
+            if lastToken >= 0:
+                edgeStart = max( tokenStarts[firstToken] - max(self.leadings) - 1, 0 )
+                edge      = set( candidates[ bisect_left(candidates, edgeStart) : bisect_left(candidates, endpos) ] )
+                for ordinal in range(firstToken, lastToken + 1):
+                    for leading in self.leadings:
+                        candidate = self.candidateFor(ordinal, leading)
+                        if candidate is not None:
+                            edge.add(candidate)
+                edgeCandidates = sorted(edge)
+
+        for i in range( bisect_left(candidates, pos), bisect_left(candidates, min(edgeStart, endpos)) ):
+            candidate = candidates[i]
+            if candidate not in self.verified:
+                self.verified[candidate] = self.matcher.match( text, candidate )
+            match = self.verified[candidate]
+            if match is not None:
+                return match
+
+        for candidate in edgeCandidates:
+            if candidate < pos:
+                continue
+            if candidate >= endpos:
+                break
+            match = self.matcher.match( text, candidate, endpos )
+            if match is not None:
+                return match
+
+        return None
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class BatchScanner:
+    """
+    The combined scanner for a batch of queries (see Searcher.searchBatch()):  every distinct clause regex in
+    the batch, walked over the text together, so the text gets scanned once rather than once per clause.
+
+    Each clause goes into one big regex twice.  Up front, they're ORed together in a lookahead, so the regex only
+    stops at positions where at least one of them matches (and only tries that at the start of the text or on a
+    boundary character, where every clause match starts).  After that, each one gets an optional lookahead
+    with a group of its own, so the match tells us every clause that matches there, and where that match ends --
+    an alternation on its own would only tell us about the first.  None of it uses up any text, so the overlapping
+    matches are all still there.  The re module won't take more than 100 groups in a pattern, so it's really
+    one scan per MAX_SCAN_CLAUSES clauses, which is still a lot fewer than one per clause.
+    """
+
+    groupPattern = re.compile( r"\\.|\[(?:\\.|[^\]])*\]|\((?!\?)" )   # An escape, a character class, or a capturing "("
+
+    def __init__ ( self, text, searchClauses ):
+        self.text    = text
+        self.matches = {}   # Clause regex --> ( starts, ends ) of every match of it, in order
+        clauses      = OrderedDict( (clause.regex, clause) for clause in searchClauses )
+
+        regexes = list(clauses)
+        for first in range(0, len(regexes), MAX_SCAN_CLAUSES):
+            chunk    = regexes[ first : first + MAX_SCAN_CLAUSES ]
+            cores    = [ self.nonCapturing(regex) for regex in chunk ]
+            combined = re.compile( r"(?:\A|(?=" + SearchExecution.wordBoundaries + "))(?=" + "|".join(cores) + ")" +
+                                   "".join( [ "(?=(" + core + ")?)" for core in cores ] ), re.IGNORECASE|re.DOTALL )
+            found    = [ ( array('l'), array('l') ) for regex in chunk ]
+            for match in combined.finditer(text):
+                for group, (starts, ends) in enumerate(found):
+                    if match.start(group + 1) >= 0:
+                        starts.append( match.start(group + 1) )
+                        ends.append( match.end(group + 1) )
+            self.matches.update( zip(chunk, found) )
+
+    @staticmethod
+    def nonCapturing ( regex ):
+        """
+        Turn every capturing group in a clause regex into a non-capturing one (wrapping the lot in one, so its
+        alternatives stay together), so they don't use up our groups.  Escaped parens, and the ones in a
+        character class, are left alone.
+        """
+        def replace ( match ):
+            return "(?:" if match.group() == "(" else match.group()
+        return "(?:" + BatchScanner.groupPattern.sub( replace, regex ) + ")"
+
+    def getClauseMatcher ( self, searchMatcher ):
+        """
+        Return a BatchClauseMatcher for one of the batch's clauses.
+        """
+        starts, ends = self.matches[searchMatcher.regex]
+        return BatchClauseMatcher( searchMatcher.matcher, starts, ends )
+
+class BatchClauseMatcher:
+    """
+    Stands in for a compiled clause regex, with the same search() signature, but answers from the matches a
+    BatchScanner already found for it.  A search that stops short of the end of the text just runs the regex:
+    a match that runs into endpos can come out differently (see IndexedClauseMatcher), and those searches are
+    only ever a bracket long (see SearchExecution.isExcluded()).
+    """
+
+    def __init__ ( self, matcher, starts, ends ):
+        self.matcher = matcher
+        self.starts  = starts
+        self.ends    = ends
+
+    def search ( self, text, pos = 0, endpos = None ):
+        if endpos is not None and endpos < len(text):
+            return self.matcher.search( text, pos, endpos )
+        i = bisect_left( self.starts, pos )
+        if i < len(self.starts):
+            return TermMatch( self.starts[i], self.ends[i] )
+        return None
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class IndexFile:
+    """
+    Saves a PositionalIndex to disk, and opens it again (as a MappedIndex) without reading it all back in.
+    Everything is little-endian.  The file is:
+
+        header        magic, version, content length and fingerprint (SHA-1), token and key counts, and
+                      where each of the sections below starts
+        dictionary    one fixed-size entry per key, in sorted order:  where the key is in the key text, its
+                      length, and where its postings are and how many there are
+        key text      all the keys, run together
+        postings      each key's token ordinals, as varint deltas from the one before
+        token starts  the character offset of every token, 4 bytes each
+        token ends    ... and where every token ends
+
+    The token offsets are fixed-width, rather than varints, because the clause matchers bisect them and index
+    straight into them.  Everything else is only ever read a key at a time.  If the fingerprint doesn't match
+    the content we're handed (or the version isn't ours), the file is stale, and open() says so by returning None.
+    """
+
+    magic      = "RXINDEX\0"
+    header     = struct.Struct( "<8sIQ20sIIQQQQQ" )
+    entry      = struct.Struct( "<IIQI" )   # Key offset, key length, postings offset, postings count
+    offsetSize = 4
+
+    @staticmethod
+    def fingerprint ( text ):
+        """
+        Return the fingerprint of some content (a string, or anything else hashlib can read, like an mmap).
+        """
+        return hashlib.sha1(text).digest()
+
+    @staticmethod
+    def encodeVarint ( value, out ):
+        """
+        Append a non-negative integer to a list of bytes, seven bits at a time, low bits first.
+        """
+        while value >= 0x80:
+            out.append( chr( (value & 0x7f) | 0x80 ) )
+            value >>= 7
+        out.append( chr(value) )
+
+    @staticmethod
+    def write ( index, text, path ):
+        """
+        Save a (full) PositionalIndex over the given text.  We write to a temporary file and rename it, so
+        nobody ever opens half an index.
+        """
+        keys       = sorted( index.postings )
+        entries    = []
+        keyText    = []
+        postings   = []
+        keyOffset  = 0
+        for key in keys:
+            postingsOffset = len(postings)
+            previous = 0
+            for ordinal in index.postings[key]:
+                IndexFile.encodeVarint( ordinal - previous, postings )
+                previous = ordinal
+            entries.append( IndexFile.entry.pack( keyOffset, len(key), postingsOffset, len(index.postings[key]) ) )
+            keyText.append( key )
+            keyOffset += len(key)
+
+        dictionary   = "".join(entries)
+        keyText      = "".join(keyText)
+        postings     = "".join(postings)
+        tokenStarts  = array( 'I', index.tokenStarts )
+        tokenEnds    = array( 'I', index.tokenEnds )
+        if sys.byteorder != "little":
+            tokenStarts.byteswap()
+            tokenEnds.byteswap()
+
+        dictionaryAt  = IndexFile.header.size
+        keyTextAt     = dictionaryAt + len(dictionary)
+        postingsAt    = keyTextAt + len(keyText)
+        tokenStartsAt = postingsAt + len(postings)
+        tokenEndsAt   = tokenStartsAt + len(tokenStarts) * IndexFile.offsetSize
+
+        temporaryPath = path + ".tmp"
+        f = open(temporaryPath, "wb")
+        f.write( IndexFile.header.pack( IndexFile.magic, INDEX_VERSION, len(text), IndexFile.fingerprint(text),
+                                        len(index.tokenStarts), len(keys),
+                                        dictionaryAt, keyTextAt, postingsAt, tokenStartsAt, tokenEndsAt ) )
+        f.write( dictionary )
+        f.write( keyText )
+        f.write( postings )
+        f.write( tokenStarts.tostring() )
+        f.write( tokenEnds.tostring() )
+        f.close()
+        os.rename( temporaryPath, path )
+
+    @staticmethod
+    def open ( path, text ):
+        """
+        Map an index file, returning a MappedIndex -- or None if there's no such file, or it's not for this
+        content, or it's not one we can read.
+        """
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            mapping = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+        except (ValueError, mmap.error):   # An empty file can't be mapped
+            f.close()
+            return None
+        f.close()   # The mapping has a handle of its own
+
+        if len(mapping) < IndexFile.header.size:
+            mapping.close()
+            return None
+        fields = IndexFile.header.unpack_from( mapping, 0 )
+        magic, version, length, fingerprint = fields[:4]
+        if magic != IndexFile.magic or version != INDEX_VERSION or length != len(text) or fingerprint != IndexFile.fingerprint(text):
+            mapping.close()
+            return None
+        return MappedIndex( mapping, *fields[4:] )
+
+def loadIndex ( text, path ):
+    """
+    Return the index for some content from its index file, (re)building the file first if it's missing or
+    stale.  If we can't write it (say, a read-only directory), you just get the index in memory.
+    """
+    index = IndexFile.open( path, text )
+    if index is None:
+        built = PositionalIndex(text)
+        try:
+            IndexFile.write( built, text, path )
+        except (IOError, OSError):
+            return built
+        index = IndexFile.open( path, text )
+    return index
 
 # --------------------------------------------------------------------------------------------------------------------
 
-class Content:
+class MappedArray(object):
     """
-    This is just what we're going to search against.  For testing purposes, we just read the SEARCH_FILE_NAME
-    and run our search against that.
+    A read-only array of fixed-width offsets in a mapped index file.  It's enough of a sequence for bisect.
     """
 
-    def __init__ (self):
-        f = open(SEARCH_FILE_NAME, 'r')
-        self.content = f.read()    # Load the contents of the file ...
+    __slots__ = ( "mapping", "offset", "count" )
+
+    def __init__ ( self, mapping, offset, count ):
+        self.mapping = mapping
+        self.offset  = offset
+        self.count   = count
+
+    def __len__ ( self ):
+        return self.count
+
+    def __getitem__ ( self, i ):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return struct.unpack_from( "<I", self.mapping, self.offset + i * IndexFile.offsetSize )[0]
+
+class MappedPostings:
+    """
+    A mapped index file's postings, with just enough of a dictionary's interface for a PositionalIndex:  get()
+    binary-searches the key dictionary and decodes that one key's postings.
+    """
+
+    def __init__ ( self, mapping, keyCount, dictionaryAt, keyTextAt, postingsAt ):
+        self.mapping      = mapping
+        self.keyCount     = keyCount
+        self.dictionaryAt = dictionaryAt
+        self.keyTextAt    = keyTextAt
+        self.postingsAt   = postingsAt
+
+    def entry ( self, i ):
+        """
+        Return the i'th dictionary entry:  ( key, postings offset, postings count ).
+        """
+        keyOffset, keyLength, postingsOffset, count = IndexFile.entry.unpack_from( self.mapping, self.dictionaryAt + i * IndexFile.entry.size )
+        start = self.keyTextAt + keyOffset
+        return self.mapping[ start : start + keyLength ], postingsOffset, count
+
+    def get ( self, key, default = None ):
+        low  = 0
+        high = self.keyCount
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.keyCount:
+            return default
+        found, postingsOffset, count = self.entry(low)
+        if found != key:
+            return default
+
+        ordinals = []
+        mapping  = self.mapping
+        position = self.postingsAt + postingsOffset
+        ordinal  = 0
+        for i in range(count):
+            delta = 0
+            shift = 0
+            while True:
+                byte = ord( mapping[position] )
+                position += 1
+                delta |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            ordinal += delta
+            ordinals.append(ordinal)
+        return ordinals
+
+    def __contains__ ( self, key ):
+        return self.get(key) is not None
+
+class MappedIndex(PositionalIndex):
+    """
+    A PositionalIndex that lives in a mapped IndexFile.  Opening one is just reading the header, so it costs
+    next to nothing however big the content is:  the token offsets are read straight out of the mapping, and a
+    key's postings are only decoded when a clause asks for them.
+    """
+
+    def __init__ ( self, mapping, tokenCount, keyCount, dictionaryAt, keyTextAt, postingsAt, tokenStartsAt, tokenEndsAt ):
+        self.mapping        = mapping
+        self.tokenStarts    = MappedArray( mapping, tokenStartsAt, tokenCount )
+        self.tokenEnds      = MappedArray( mapping, tokenEndsAt, tokenCount )
+        self.postings       = MappedPostings( mapping, keyCount, dictionaryAt, keyTextAt, postingsAt )
+        self.clauseMatchers = {}
+
+    def close ( self ):
+        self.clauseMatchers = {}
+        self.mapping.close()
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class LiteralPrefilter:
+    """
+    Every clause regex starts with "(^|boundary)", and that leading alternation keeps re from using its
+    literal-prefix fast path -- so it tries a match at every single character offset in the content.  But
+    underneath the markup, every term has a plain literal core that *has* to be there for the regex to match:
+    "horse[s]*" needs "horse", "i\\.r\\.c" needs "i.r.c", and so on.
+
+    So we keep a lowercased copy of the content (made once), find each core in it with str.find (which is about
+    as fast as searching gets in Python), and hand the offsets to a PrefilteredClauseMatcher to try the real
+    regex at.  We hang on to the clause matchers, since they only depend on the content.
+    """
+
+    def __init__ ( self, text ):
+        self.folded         = text.lower()   # Case-folded copy, to match the regexes' IGNORECASE
+        self.clauseMatchers = {}             # Clause regex --> PrefilteredClauseMatcher
+        self.literalMatchers = {}            # Clause regex --> LiteralClauseMatcher (or AlternationClauseMatcher, or None)
+
+    def getClauseMatcher ( self, searchMatcher ):
+        """
+        Return a PrefilteredClauseMatcher for a clause, reusing the one we built last time if we've seen it.
+        """
+        if searchMatcher.regex not in self.clauseMatchers:
+            self.clauseMatchers[searchMatcher.regex] = PrefilteredClauseMatcher(self, searchMatcher)
+        return self.clauseMatchers[searchMatcher.regex]
+
+    def getLiteralMatcher ( self, searchMatcher ):
+        """
+        Return a LiteralClauseMatcher for a clause with one variant, or an AlternationClauseMatcher for one with
+        several -- or None, if any of them doesn't come down to a plain literal.  Again, we hang on to them.
+        """
+        if searchMatcher.regex not in self.literalMatchers:
+            variants = searchMatcher.variants
+            if not all( self.literalCore(variant) for variant in variants ):
+                self.literalMatchers[searchMatcher.regex] = None
+            elif len(variants) == 1:
+                self.literalMatchers[searchMatcher.regex] = LiteralClauseMatcher( self, variants[0] )
+            else:
+                self.literalMatchers[searchMatcher.regex] = AlternationClauseMatcher( self, variants )
+        return self.literalMatchers[searchMatcher.regex]
+
+    @staticmethod
+    def literalForm ( variant ):
+        """
+        Work out what a variant's regex comes down to, given what the Lemmatizer is going to do to it:  the
+        literal text it requires, and whether that can be followed by any number of "s"s.  Returns None if the
+        match doesn't start with a fixed literal, in which case we can't prefilter it.
+        """
+        escaped = re.escape(variant)   # The Lemmatizer works on the escaped term, so we have to ask the same questions
+        if len(escaped) < 2:
+            return variant, False
+        if escaped[0] in "sp" and escaped[1].isdigit():   # It'll get a section/paragraph symbol alternative in front
+            return None
+        if escaped[len(escaped)-1] == "s":   # It'll get its "s" replaced with "[s]*"
+            return variant[0:len(variant)-1], True
+        return variant, escaped[len(escaped)-1].isalpha()
+
+    @staticmethod
+    def literalCore ( variant ):
+        """
+        Work out the literal text a variant's regex requires (see literalForm()), or None if there isn't any.
+        It's case-folded, like the copy of the content we look for it in -- a synonym can be in any case.
+        """
+        form = LiteralPrefilter.literalForm(variant)
+        if form is None:
+            return None
+        return form[0].lower()
+
+    def candidates ( self, variant ):
+        """
+        Return the offsets where a variant's regex could match:  the boundary character just before each
+        occurrence of its core (or the start of the text, where the regex matches "^").
+        """
+        core = self.literalCore(variant)
+        if core is None or len(core) == 0:
+            return None
+        offsets = []
+        found   = self.folded.find(core)
+        while found != -1:
+            offsets.append( max(found - 1, 0) )
+            found = self.folded.find(core, found + 1)
+        return offsets
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class PrefilteredClauseMatcher:
+    """
+    Stands in for a compiled clause regex, with the same search() signature, but only tries the regex at the
+    offsets the LiteralPrefilter found for the clause's variants.  Since the core has to appear in full
+    before the end of any match, those offsets are a superset of where the regex can match -- even when a
+    window's endpos cuts the text short -- so we give exactly the same answers as the regex would.
+
+    We count how many candidates we try the regex on, and how many it turns down.  If a clause's rejection
+    count is high, its core is too common to be much of a filter.
+    """
+
+    def __init__ ( self, prefilter, searchMatcher ):
+        self.matcher  = searchMatcher.matcher
+        self.verified = {}          # Candidate offset --> match (or None) against the full text
+        self.candidatesTried    = 0
+        self.candidatesRejected = 0
+        self.isFallback = False     # A variant we can't prefilter?  Then just use the regex.
+
+        candidates = set()
+        for variant in searchMatcher.variants:
+            offsets = prefilter.candidates(variant)
+            if offsets is None:
+                self.isFallback = True
+                break
+            candidates.update(offsets)
+        self.candidates = sorted(candidates)
+
+    def search ( self, text, pos = 0, endpos = None ):
+        """
+        Same as a compiled regex's search(), but only trying the regex at our candidates.
+        """
+        if endpos is None or endpos > len(text):
+            endpos = len(text)
+
+        if self.isFallback:
+            return self.matcher.search( text, pos, endpos )
+
+        isTruncated = endpos < len(text)
+        candidates  = self.candidates
+        for i in range( bisect_left(candidates, pos), len(candidates) ):
+            candidate = candidates[i]
+            if candidate >= endpos:
+                break
+            if not isTruncated and candidate in self.verified:
+                match = self.verified[candidate]
+            else:
+                if isTruncated:   # The regex treats endpos as the end of the text, so we can't reuse a full-text answer
+                    match = self.matcher.match( text, candidate, endpos )
+                else:
+                    match = self.matcher.match( text, candidate )
+                    self.verified[candidate] = match
+                self.candidatesTried += 1
+                if match is None:
+                    self.candidatesRejected += 1
+            if match is not None:
+                return match
+
+        return None
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class LiteralClauseMatcher:
+    """
+    Stands in for the compiled regex of a clause with just the one variant, without running the regex at all.
+    Underneath the markup, that regex is only "(^|boundary)core[s]*($|boundary)", so once the LiteralPrefilter's
+    str.find has turned up the core, the rest is a few character comparisons in its case-folded copy of the
+    content.  We match just where the regex would, right down to its quirks:  "^" is only the very start of the
+    text, "$" is the end (or endpos), or just before a newline that's the last character, and where it could go
+    either way, the regex tries "^" before a boundary character in front, and "$" before one behind.
+    """
+
+    boundaries = " .,:;\n\r\t()[]"   # Just what SearchExecution.wordBoundaries matches
+    backend    = "literal"
+
+    def __init__ ( self, prefilter, variant ):
+        core, isPlural = LiteralPrefilter.literalForm(variant)
+        self.folded   = prefilter.folded
+        self.core     = core.lower()
+        self.isPlural = isPlural    # Can the core be followed by "s"s?
+        self.verified = {}          # Candidate offset --> match end (or -1) against the full text
+        self.candidatesTried    = 0
+        self.candidatesRejected = 0
+        self.candidates = prefilter.candidates(variant)
+
+    def matchEnd ( self, start, endpos ):
+        """
+        Return where a match starting at start ends, if there is one there (before endpos), or -1.
+        """
+        if start == 0:
+            end = self.coreEnd( 0, endpos )   # The regex tries "^" first ...
+            if end != -1:
+                return end
+        if start < endpos and self.folded[start] in self.boundaries:   # ... and then a boundary character
+            return self.coreEnd( start + 1, endpos )
+        return -1
+
+    def coreEnd ( self, at, endpos ):
+        """
+        Return where a match ends, if the core (and whatever "s"s it takes) starts at at, and is followed by the
+        end of the text or a boundary character, or -1 if it isn't.  There's no point backing off any of the
+        "s"s, since an "s" is never a boundary.
+        """
+        folded = self.folded
+        end    = at + len(self.core)
+        if end > endpos or not folded.startswith( self.core, at ):
+            return -1
+        if self.isPlural:
+            while end < endpos and folded[end] == "s":
+                end += 1
+        if end == endpos or ( end == endpos - 1 and folded[end] == "\n" ):   # "$" takes a newline at the very end, too
+            return end
+        if folded[end] in self.boundaries:
+            return end + 1
+        return -1
+
+    def search ( self, text, pos = 0, endpos = None ):
+        """
+        Same as a compiled regex's search(), but only checking our candidates.  Like the regex, we treat endpos as
+        the end of the text, so a truncated search can't reuse what we worked out for the full text.
+        """
+        if endpos is None or endpos > len(text):
+            endpos = len(text)
+
+        isTruncated = endpos < len(text)
+        candidates  = self.candidates
+        for i in range( bisect_left(candidates, pos), len(candidates) ):
+            candidate = candidates[i]
+            if candidate >= endpos:
+                break
+            if not isTruncated and candidate in self.verified:
+                end = self.verified[candidate]
+            else:
+                end = self.matchEnd( candidate, endpos )
+                if not isTruncated:
+                    self.verified[candidate] = end
+                self.candidatesTried += 1
+                if end == -1:
+                    self.candidatesRejected += 1
+            if end != -1:
+                return TermMatch( candidate, end )
+
+        return None
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class AlternationClauseMatcher(LiteralClauseMatcher):
+    """
+    A LiteralClauseMatcher for a clause with a few variants -- a word and its synonyms, say.  Each variant gets
+    a LiteralClauseMatcher of its own, and we try them at every candidate any of them has, in the clause's order.
+    That's the regex's order, too, and like the regex, the first one to match wins (even if a later one would
+    have matched more).
+    """
+
+    backend = "alternation"
+
+    def __init__ ( self, prefilter, variants ):
+        self.variantMatchers = [ LiteralClauseMatcher(prefilter, variant) for variant in variants ]
+        self.verified = {}
+        self.candidatesTried    = 0
+        self.candidatesRejected = 0
+
+        candidates = set()
+        for variantMatcher in self.variantMatchers:
+            candidates.update( variantMatcher.candidates )
+        self.candidates = sorted(candidates)
+
+    def matchEnd ( self, start, endpos ):
+        for variantMatcher in self.variantMatchers:
+            end = variantMatcher.matchEnd( start, endpos )
+            if end != -1:
+                return end
+        return -1
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class BlockFilter:
+    """
+    The content cut up into blocks of (at least) BLOCK_CHARS characters -- each one ending just after a boundary
+    character, so no token straddles two -- with a little Bloom filter of the terms in each.  A term goes in with
+    its trailing "s"s stripped, so "horse", "horses" and "horsess" all set the same bits.
+
+    That's enough to tell (never wrongly, though sometimes too hopefully) that a clause can't start in a block:
+    every token of a variant's literal core has to turn up, whole, in its match (the last one maybe with some
+    "s"s on), so if one of them isn't in the block -- or the next one, since a match can start with the last
+    character of a block -- the variant isn't there.  A clause we can't say that about (its core is all
+    boundaries, or it doesn't have one) might be anywhere.
+
+    For an AND window, an anchor can only make a hit in a block where the anchor clause might be, and where every
+    other clause might be close enough to fit in its bracket.  Everything else -- apart from the blocks close
+    enough to those to have matches their brackets need -- we can skip:  see viableRanges().
+    """
+
+    boundaryPattern = re.compile( SearchExecution.wordBoundaries )
+
+    def __init__ ( self, folded ):
+        self.starts = array('l')   # Where each block starts
+        self.blooms = []           # ... and the Bloom filter of its terms (as a Python long)
+        self.clauseBlocks = {}     # Clause regex --> which blocks it might start in
+
+        start = 0
+        while start < len(folded):
+            end   = start + BLOCK_CHARS
+            match = self.boundaryPattern.search( folded, end ) if end < len(folded) else None
+            end   = match.end() if match is not None else len(folded)
+            bloom = 0
+            for token in set( PositionalIndex.tokenPattern.findall(folded, start, end) ):
+                bloom |= self.termBits(token)
+            self.starts.append(start)
+            self.blooms.append(bloom)
+            start = end
+
+        # A clause might start in a block if it's in that block and the next, taken together.
+        self.pairs = [ self.blooms[i] | (self.blooms[i+1] if i + 1 < len(self.blooms) else 0) for i in range(len(self.blooms)) ]
+
+    @staticmethod
+    def termBits ( token ):
+        """
+        The two bits a term sets in a block's Bloom filter.
+        """
+        hashed = hash( token.rstrip("s") )
+        return (1 << (hashed % BLOCK_BLOOM_BITS)) | (1 << ((hashed >> 16) % BLOCK_BLOOM_BITS))
+
+    def getClauseBlocks ( self, searchMatcher ):
+        """
+        Return which blocks a clause might start in (as a list of booleans), working it out the first time we
+        see the clause:  the ones where the filters have all the bits for every token of any of its variants.
+        """
+        if searchMatcher.regex not in self.clauseBlocks:
+            masks = []
+            for variant in searchMatcher.variants:
+                form   = LiteralPrefilter.literalForm(variant)
+                tokens = PositionalIndex.tokenPattern.findall( form[0].lower() ) if form is not None else []
+                if not tokens:   # Then it could be anywhere
+                    masks = None
+                    break
+                mask = 0
+                for token in tokens:
+                    mask |= self.termBits(token)
+                masks.append(mask)
+            if masks is None:
+                self.clauseBlocks[searchMatcher.regex] = [ True ] * len(self.pairs)
+            else:
+                self.clauseBlocks[searchMatcher.regex] = [ any( pair & mask == mask for mask in masks ) for pair in self.pairs ]
+        return self.clauseBlocks[searchMatcher.regex]
+
+    def spread ( self, blocks ):
+        """
+        Given which blocks something might be in, return which blocks are close enough to one of them to be in
+        the same bracket.  Blocks are at least BLOCK_CHARS long, so a bracket's MATCH_WINDOW either side of its
+        anchor can't reach past that many, plus one for where the anchor starts in its block, and one more for
+        how long it is.
+        """
+        reach  = MATCH_WINDOW / BLOCK_CHARS + 2
+        counts = [ 0 ]   # How many of the blocks before each one it might be in
+        for block in blocks:
+            counts.append( counts[-1] + (1 if block else 0) )
+        return [ counts[ min(i + reach + 1, len(blocks)) ] > counts[ max(i - reach, 0) ] for i in range(len(blocks)) ]
+
+    def viableRanges ( self, searchClauses, contentLength ):
+        """
+        Work out which parts of the content an AND window's clauses (anchor first) need to look at, returning
+        them as a list of ( start, end ) character ranges, and how many blocks that leaves out.  Returns None
+        for the ranges if there's nothing to leave out.
+        """
+        anchors = self.getClauseBlocks( searchClauses[0] )
+        for clause in searchClauses[1:]:
+            near    = self.spread( self.getClauseBlocks(clause) )
+            anchors = [ isAnchor and isNear for isAnchor, isNear in zip(anchors, near) ]
+        needed = self.spread(anchors)
+
+        skipped = needed.count(False)
+        if skipped == 0:
+            return None, 0
+        ranges = []
+        for i in range(len(needed)):
+            if not needed[i]:
+                continue
+            end = self.starts[i+1] if i + 1 < len(self.starts) else contentLength
+            if ranges and ranges[-1][1] == self.starts[i]:
+                ranges[-1] = ( ranges[-1][0], end )
+            else:
+                ranges.append( (self.starts[i], end) )
+        return ranges, skipped
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class BlockSkippingMatcher:
+    """
+    Stands in for a clause matcher (regex or otherwise), with the same search() signature, but only finds the
+    matches that start in the given character ranges -- the ones a BlockFilter says the window needs.  Anything
+    else it would have found, no bracket that could make a hit would have used anyway.
+
+    We don't even look at the text in between:  we only let the matcher search a little past the end of each
+    range (reach, which is more than any match's literal part), and check what it finds against the full text.
+    Anything that really matches inside the range has a match there that fits inside that, so we can't miss it.
+    """
+
+    def __init__ ( self, matcher, ranges, reach ):
+        self.matcher     = matcher
+        self.rangeStarts = [ start for start, end in ranges ]
+        self.rangeEnds   = [ end for start, end in ranges ]
+        self.reach       = reach
+        self.isRegex     = hasattr( matcher, "match" )
+
+    def __getattr__ ( self, name ):
+        return getattr( self.matcher, name )   # (So the prefilter's counts still add up)
+
+    def search ( self, text, pos = 0, endpos = None ):
+        if endpos is None or endpos > len(text):
+            endpos = len(text)
+
+        while True:
+            i = bisect_right( self.rangeEnds, pos )   # The first range that doesn't end at or before pos
+            if i >= len(self.rangeEnds):
+                return None
+            pos      = max( pos, self.rangeStarts[i] )
+            rangeEnd = self.rangeEnds[i]
+            if pos >= endpos:
+                return None
+
+            match = self.matcher.search( text, pos, min(rangeEnd + self.reach, endpos) )
+            if match is None or match.start() >= rangeEnd:
+                pos = rangeEnd
+                continue
+            if self.isRegex:
+                full = self.matcher.match( text, match.start(), endpos )
+            else:
+                full = self.matcher.search( text, match.start(), endpos )
+                if full is not None and full.start() != match.start():
+                    full = None
+            if full is not None:
+                return full
+            pos = match.start() + 1
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class TermVocabulary:
+    """
+    Every distinct word in the content (lowercased, as the clause regexes see it), with a trigram index over
+    them, for fuzzy terms.  A word's trigrams are taken with two padding characters at each end, so even the
+    first and last letters count.  One edit can't spoil more than three of a word's trigrams, so a word within
+    k edits of another has to share all but 3k of its trigrams -- and counting those up from the postings
+    narrows the vocabulary down to a few candidates, which we check properly with an edit distance.
+
+    None of that depends on how big the content is, only on how many different words it has.  (A word that's
+    too short to have trigrams to spare just gets checked against every word of about the right length.)
+    """
+
+    padding = "\x00\x00"
+
+    def __init__ ( self, folded ):
+        self.words    = sorted( set( PositionalIndex.tokenPattern.findall(folded) ) )
+        self.trigrams = {}   # Trigram --> array of the ids (indexes in words) of the words that have it
+        self.clauses  = {}   # ( Clause regex, fuzzy words ) --> SearchMatcher with the words we found added in
+        for wordId in range(len(self.words)):
+            for trigram in self.trigramsOf( self.words[wordId] ):
+                self.trigrams.setdefault( trigram, array('l') ).append( wordId )
+
+    def trigramsOf ( self, word ):
+        """
+        The distinct trigrams of a word, padding and all.
+        """
+        padded = self.padding + word + self.padding
+        return set( [ padded[i:i+3] for i in range(len(padded) - 2) ] )
+
+    def lookup ( self, word, distance ):
+        """
+        Return the content's words within distance edits of a word (leaving out the word itself), closest first,
+        and no more than MAX_FUZZY_TERMS of them.
+        """
+        trigrams = self.trigramsOf(word)
+        needed   = len(trigrams) - 3 * distance
+        if needed > 0:
+            counts = {}
+            for trigram in trigrams:
+                for wordId in self.trigrams.get( trigram, () ):
+                    counts[wordId] = counts.get(wordId, 0) + 1
+            candidates = [ self.words[wordId] for wordId, count in counts.iteritems() if count >= needed ]
+        else:
+            candidates = self.words
+
+        similar = []
+        for candidate in candidates:
+            if candidate != word and abs( len(candidate) - len(word) ) <= distance:
+                edits = self.editDistance( word, candidate, distance )
+                if edits <= distance:
+                    similar.append( (edits, candidate) )
+        similar.sort()
+        return [ candidate for edits, candidate in similar[:MAX_FUZZY_TERMS] ]
+
+    @staticmethod
+    def editDistance ( first, second, limit ):
+        """
+        The Levenshtein distance between two words -- or limit + 1, as soon as we can tell it's more than limit.
+        """
+        previous = range( len(second) + 1 )
+        for i in range( 1, len(first) + 1 ):
+            current = [ i ] + [ 0 ] * len(second)
+            for j in range( 1, len(second) + 1 ):
+                current[j] = min( previous[j] + 1, current[j-1] + 1, previous[j-1] + (first[i-1] != second[j-1]) )
+            if min(current) > limit:
+                return limit + 1
+            previous = current
+        return previous[len(second)]
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class TermIndex:
+    """
+    The content, run through a TermAnalyzer:  every token's character offsets and term id, and the postings
+    for each id (the ordinals of the tokens that have it).  A synonym that's more than one token long in the
+    content also gets a phrase posting -- its first and last token ordinals -- under its group id, as well as
+    each of its tokens getting its own.
+    """
+
+    def __init__ ( self, text, analyzer = None ):
+        if analyzer is None:
+            analyzer = TermAnalyzer()
+        self.analyzer    = analyzer
+        self.tokenStarts = array('l')   # Character offset where each token starts
+        self.tokenEnds   = array('l')   # ... and where it ends
+        self.tokenIds    = array('l')   # ... and its term id
+        self.postings    = {}           # Term id --> array of token ordinals
+        self.phrases     = {}           # Group id --> list of ( first, last ) token ordinals
+        self.text        = text
+        self.clauseMatchers = {}        # Clause regex --> TermClauseMatcher, since they only depend on us
+
+        keys = []
+        for match in PositionalIndex.tokenPattern.finditer(text):
+            key    = analyzer.normalize( match.group() )
+            termId = analyzer.keyId(key)
+            self.postings.setdefault( termId, array('l') ).append( len(self.tokenIds) )
+            self.tokenStarts.append( match.start() )
+            self.tokenEnds.append( match.end() )
+            self.tokenIds.append( termId )
+            keys.append( key )
+
+        if analyzer.table.maxTokens > 1:
+            trie = analyzer.table.trie
+            for first in range(len(keys)):
+                node = trie.get( keys[first] )
+                if node is None or len(node[1]) == 0:   # Nothing longer starts with this token
+                    continue
+                groupId, length = analyzer.table.longestPhrase( keys, first )
+                if groupId is not None:
+                    self.phrases.setdefault( groupId, [] ).append( (first, first + length - 1) )
+
+    def getClauseMatcher ( self, searchMatcher ):
+        """
+        Return a TermClauseMatcher for a clause, reusing the one we built last time if we've seen it.
+        """
+        if searchMatcher.regex not in self.clauseMatchers:
+            self.clauseMatchers[searchMatcher.regex] = TermClauseMatcher(self, searchMatcher)
+        return self.clauseMatchers[searchMatcher.regex]
+
+    def termSpans ( self, term ):
+        """
+        Return the ( first, last ) token ordinals of everywhere a query term matches.  A run of tokens has to
+        have every token's id match, one after the other.
+        """
+        ids = self.analyzer.termIds(term)
+        if not ids:
+            return []
+        if len(ids) == 1:
+            spans = [ (ordinal, ordinal) for ordinal in self.postings.get( ids[0], [] ) ]
+            return spans + self.phrases.get( ids[0], [] )
+
+        tokenIds = self.tokenIds
+        last     = len(ids) - 1
+        return [ (ordinal, ordinal + last) for ordinal in self.postings.get( ids[0], [] )
+                 if ordinal + last < len(tokenIds) and all( tokenIds[ordinal + i] == ids[i] for i in range(1, len(ids)) ) ]
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class TermMatch(object):
+    """
+    Where a TermClauseMatcher found a clause.  It looks just enough like a regex match for a MatchStream.
+    """
+
+    __slots__ = ( "matchStart", "matchEnd" )
+
+    def __init__ ( self, matchStart, matchEnd ):
+        self.matchStart = matchStart
+        self.matchEnd   = matchEnd
+
+    def start ( self ):
+        return self.matchStart
+
+    def end ( self ):
+        return self.matchEnd
 
+# --------------------------------------------------------------------------------------------------------------------
+
+class TermClauseMatcher:
+    """
+    Stands in for a compiled clause regex, with the same search() signature, but answers from a TermIndex:  a
+    clause matches wherever any of its terms does, as the TermAnalyzer sees them.  That's not quite the regex's
+    idea of a match -- punctuation between the tokens of a term doesn't have to be the same, synonyms don't have
+    to be listed in every form, and a section symbol is as good as an "s" -- so this is an engine of its own,
+    not a faster way of getting the regex's answers.
+
+    We do report matches the way the regex would, though:  from the boundary character in front of the first
+    token (or the start of the text) to the one after the last (or the end of the text), so trimmedHit() and
+    everything after it works the same either way.  If the term starts or ends with punctuation (the parens in
+    "(a)"), and the content has the same punctuation there, the match takes it in, too.  If a term matches two
+    ways at the same token, the longer one wins.
+    """
+
+    def __init__ ( self, termIndex, searchMatcher ):
+        text    = termIndex.text
+        matches = {}   # First token ordinal --> ( match start, match end )
+        for term in searchMatcher.terms:
+            tokens   = PositionalIndex.tokenPattern.findall(term)
+            leading  = term[ : term.find(tokens[0]) ] if tokens else ""
+            trailing = term[ term.rfind(tokens[-1]) + len(tokens[-1]) : ] if tokens else ""
+            for first, last in termIndex.termSpans(term):
+                start = termIndex.tokenStarts[first]
+                end   = termIndex.tokenEnds[last]
+                if leading and text[ max(start - len(leading), 0) : start ] == leading:
+                    start -= len(leading)
+                if trailing and text[ end : end + len(trailing) ] == trailing:
+                    end += len(trailing)
+                match = ( max(start - 1, 0), min(end + 1, len(text)) )
+                if first not in matches or match[1] > matches[first][1]:
+                    matches[first] = match
+
+        self.starts = array('l')   # Where each match starts, in order
+        self.ends   = array('l')   # ... and ends
+        for start, end in sorted( matches.values() ):
+            self.starts.append( start )
+            self.ends.append( end )
+
+    def search ( self, text, pos = 0, endpos = None ):
+        """
+        Same as a compiled regex's search(), but it's just a binary search.  A match has to fit in before endpos.
+        """
+        if endpos is None or endpos > len(text):
+            endpos = len(text)
+        i = bisect_left( self.starts, pos )
+        if i < len(self.starts) and self.ends[i] <= endpos:
+            return TermMatch( self.starts[i], self.ends[i] )
+        return None
 
 # --------------------------------------------------------------------------------------------------------------------
 
-def runSearch ( searchExpression, content, isVerbose ) :
+def runSearch ( searchExpression, content, isVerbose, engine = DEFAULT_ENGINE, searcher = None ) :
     """
-    Driver to run a search for a given expression and content.
+    Driver to run a search for a given expression and content.  Unless you hand us a Searcher of your own,
+    we share one for the whole process, so repeated queries come straight out of its plan cache.
     """
+    if searcher is None:
+        searcher = getDefaultSearcher()
+    return searcher.search( searchExpression, content, isVerbose, engine )
 
-    if isVerbose:
-        print "-->%s<--" % searchExpression
-    tokenizer = Tokenizer()
-    parseList = tokenizer.tokenize( searchExpression )
-    if isVerbose:
-        print parseList
-    searchExecution = SearchExecution()
-    searchResult = searchExecution.executeSearch(parseList, content, isVerbose)
+defaultSearcher = None
 
-    return searchResult
+def getDefaultSearcher ( ):
+    """
+    Return the process-wide Searcher, creating it (and loading the synonyms) the first time through.
+    """
+    global defaultSearcher
+    if defaultSearcher is None:
+        defaultSearcher = Searcher()
+    return defaultSearcher
 
 def testExpressions ( ):
     """
@@ -602,7 +4235,378 @@ def testExpressions ( ):
         print searchResult
         print "\n======================================\n"
 
+def hitOffsets ( searchResult ):
+    """
+    Boil a SearchResult down to plain (start, end) tuples so results from different engines can be compared.
+    """
+    return [ [ (highlight.start, highlight.end) for highlight in hit ] for hit in searchResult ]
+
+def testEquivalence ( ):
+    """
+    Run all the test queries through every engine (and as one batch), and make sure they all agree with the
+    regex engine on every hit and every highlight.
+    """
+    f = open(QUERY_FILE_NAME, 'r')
+    parseStrings = f.read().splitlines()
+
+    content  = Content()
+    failures = 0
+    expected = [ hitOffsets( runSearch(test, content, False, ENGINE_REGEX) ) for test in parseStrings ]
+
+    def check ( mode, test, expectedOffsets, actualOffsets ):
+        if actualOffsets != expectedOffsets:
+            print "MISMATCH (%s) -->%s<--\n    expected %s\n    got      %s" % (mode, test, expectedOffsets, actualOffsets)
+            return 1
+        return 0
+
+    for test, expectedOffsets in zip(parseStrings, expected):
+        for engine in [ ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+            failures += check( engine, test, expectedOffsets, hitOffsets( runSearch(test, content, False, engine) ) )
+
+    # Whichever matcher the planner picks for a clause, it should find just what the clause's regex does, all the
+    # way through the text, and when a window's endpos cuts it short -- in the test file, and in a few snippets with
+    # the awkward cases at the very start and end.
+    def matchPositions ( matcher, text, endpos ):
+        positions = []
+        match     = matcher.search( text, 0, endpos )
+        while match is not None:
+            positions.append( (match.start(), match.end()) )
+            match = matcher.search( text, match.start() + 1, endpos )
+        return positions
+
+    snippets = [ "Horses, horse\n", "horsess.dog", "(a) section 2; s2 horse\n\n", "i.r.c.) code\r\ndogs", "dogs" ]
+    for backendContent in [ content ] + [ Content(snippet) for snippet in snippets ]:
+        text = backendContent.getSearchText()
+        for test in parseStrings + [ "horse OR dog OR section", "sections", "board", "FASB standards" ]:   # (FASB's a synonym, in capitals)
+            for conjunction in getDefaultSearcher().getPlan(test).conjunctions:
+                for clause in conjunction.searchClauses + conjunction.excludedClauses:
+                    expectedPositions = matchPositions( clause.matcher, text, len(text) )
+                    endposes          = [ len(text) ] + [ end - 1 for start, end in expectedPositions[:20] ]
+                    backend, matcher  = QueryPlanner().chooseMatcher( clause, backendContent )
+                    for endpos in endposes:
+                        failures += check( "backend " + backend, "%s (to %s)" % (clause.regex, endpos),
+                                           matchPositions(clause.matcher, text, endpos), matchPositions(matcher, text, endpos) )
+
+    # Fuzzy terms should find the same words whichever engine runs them (and in a batch), the trigram index
+    # shouldn't lose any word an edit distance over the whole vocabulary would find, and a mapped document (which
+    # has no vocabulary) should just get the words as they were typed.
+    fuzzyTests = [ "acounting~ standards", "acounting~2", "finacial~ information~", "dog~ AND horse", "(sectoin~2 OR irc) 168(a)" ]
+    for test in fuzzyTests:
+        expectedOffsets = hitOffsets( runSearch(test, content, False, ENGINE_REGEX) )
+        for engine in [ ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+            failures += check( "fuzzy, " + engine, test, expectedOffsets, hitOffsets( runSearch(test, content, False, engine) ) )
+    for test, searchResult in zip( fuzzyTests, getDefaultSearcher().searchBatch(fuzzyTests, Content(), False, ENGINE_REGEX) ):
+        failures += check( "fuzzy, batch", test, hitOffsets( runSearch(test, content, False, ENGINE_REGEX) ), hitOffsets(searchResult) )
+    failures += check( "fuzzy, acounting~", "", True, len( runSearch("acounting~", content, False).hits ) > 0 and len( runSearch("acounting", content, False).hits ) == 0 )
+    vocabulary = content.getVocabulary()
+    for word, distance in [ ("acounting", 1), ("standrds", 2), ("sectoin", 2), ("a", 1), ("168", 2) ]:
+        everyWord = sorted( [ (vocabulary.editDistance(word, other, distance), other) for other in vocabulary.words if other != word ] )
+        failures += check( "fuzzy, lookup", "%s~%d" % (word, distance), [ other for edits, other in everyWord if edits <= distance ][:MAX_FUZZY_TERMS],
+                           vocabulary.lookup(word, distance) )
+    corpus = Corpus([ SEARCH_FILE_NAME ])
+    failures += check( "fuzzy, mapped", "dog~ AND horse", [ hitOffsets(searchResult) for searchResult in corpus.search("dog AND horse") ],
+                       [ hitOffsets(searchResult) for searchResult in corpus.search("dog~ AND horse") ] )
+    corpus.close()
+
+    # The single-pass tokenizer should break every query up exactly the way the character-at-a-time one does,
+    # quirks and all -- on its own, or a whole list at a time -- and the plans we compile in bulk should be the
+    # ones we compile one at a time.
+    tokenizer  = Tokenizer()
+    awkward    = [ '"(a)"', '""', '"a(b"', '"', "(horse", "cow)", "((dog))", "168(a)", "sec.:", "'.'", '"dog" "', "a,b;c\td" ]
+    tokenTests = parseStrings + awkward + fuzzyTests + [ "" ]
+    fields     = lambda parseList: [ vars(token) for token in parseList.tokens ]
+    for test, parseList in zip( tokenTests, tokenizer.tokenizeAll(tokenTests + tokenTests) ):
+        failures += check( "tokenizer", test, fields( tokenizer.tokenizeByCharacter(test) ), fields( tokenizer.tokenize(test) ) )
+        failures += check( "tokenizer, bulk", test, fields( tokenizer.tokenize(test) ), fields(parseList) )
+    bulkPlans = Searcher().getPlans( tokenTests + tokenTests )
+    for test, plan in zip( tokenTests + tokenTests, bulkPlans ):
+        failures += check( "bulk plans", test, Searcher().getPlan(test).signature(), plan.signature() )
+    planSearcher = Searcher()   # (Each distinct query should be looked up in the plan cache just the once)
+    planSearcher.getPlans( [ "dog", "horse" ] )
+    planSearcher.getPlans( [ "dog", "horse", "dog" ] )
+    failures += check( "bulk plans, cache hits", "dog, horse", (2, 2), (planSearcher.planCache.hits, planSearcher.planCache.misses) )
+
+    # Skipping the blocks a BlockFilter rules out shouldn't lose a single hit, however many we ask for -- in the
+    # test file, or in a long one where the words we look for are few and far between, so most blocks get
+    # skipped (and some hits straddle them).
+    fillers = [ "the", "filing", "of", "statement", "under", "section", "cows", "and", "accounting", "standards" ]
+    words   = [ fillers[(i * 7 + i / 13) % len(fillers)] for i in range(60000) ]
+    for i in range(0, len(words), 1777):
+        words[i] = "Dogs,"
+    for i in range(250, len(words), 2333):
+        words[i] = "(horse)"
+    for text, tests in [ (content.content, parseStrings), (" ".join(words), [ "dog AND horse", "dog horse cows", "horse OR dog", "dog NOT horse", "section dogs" ]) ]:
+        blockContent = Content( text )
+        everyBlock   = Content( text, None, False )
+        for test in tests:
+            for engine in [ ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+                failures += check( "block filter, " + engine, test, hitOffsets( getDefaultSearcher().search(test, everyBlock, False, engine, None) ),
+                                   hitOffsets( getDefaultSearcher().search(test, blockContent, False, engine, None) ) )
+
+    regexContent = Content()   # (The regex engine is the plain scan, so it shouldn't even build a BlockFilter)
+    runSearch( "dog AND horse", regexContent, False, ENGINE_REGEX )
+    failures += check( "block filter, regex", "dog AND horse", None, regexContent.blockFilter )
+
+    # The index should give the same answers when it comes out of an IndexFile, and the file should go stale
+    # as soon as the content changes.
+    indexPath = os.path.join( tempfile.mkdtemp(), os.path.basename(SEARCH_FILE_NAME) + INDEX_SUFFIX )
+    mapped    = Content( None, indexPath )
+    for test, expectedOffsets in zip(parseStrings, expected):
+        failures += check( "index file", test, expectedOffsets, hitOffsets( runSearch(test, mapped, False, ENGINE_INDEX) ) )
+    mapped.index.close()
+    failures += check( "index file, reopened", "", True, IndexFile.open(indexPath, mapped.content) is not None )
+    failures += check( "index file, stale", "", True, IndexFile.open(indexPath, mapped.content + " ") is None )
+    os.remove(indexPath)
+    os.rmdir( os.path.dirname(indexPath) )
+
+    # Paging through all the hits, a few at a time, should give the same hits as asking for all of them at once
+    # (including the queries with more than one window), and a cursor shouldn't carry on some other search.
+    for test in parseStrings + [ "(dog AND horse) OR attorney", "forgot OR (m AND a)", "accounting OR standards" ]:
+        for engine in [ ENGINE_REGEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+            offsets = []
+            cursor  = None
+            while True:
+                page = getDefaultSearcher().searchPage( test, content, 3, cursor, engine )
+                offsets.extend( hitOffsets(page) )
+                cursor = page.cursor
+                if cursor is None:
+                    break
+            failures += check( "pages, " + engine, test, hitOffsets( getDefaultSearcher().search(test, content, False, engine, None) ), offsets )
+    # Asking for no hits should get none, however we search.
+    emptyPage = getDefaultSearcher().searchPage( "horse", content, 0 )
+    corpus    = Corpus([ SEARCH_FILE_NAME ])
+    parallel  = ParallelSearcher( corpus, 2, [ "horse" ] )
+    segmented = SegmentedSearcher( Content(), 2, 4096, [ "horse" ] )
+    failures += check( "no hits", "horse", [ 0, 0, 0, 0, 0, 0, None ],
+                       [ len( getDefaultSearcher().search("horse", content, False, engine, 0).hits ) for engine in [ ENGINE_REGEX, ENGINE_AUTO ] ] +
+                       [ len( list( getDefaultSearcher().searchStream("horse", open(SEARCH_FILE_NAME, 'r'), 4096, 0) ) ),
+                         len( parallel.search("horse", 0) ), len( segmented.search("horse", 0).hits ), len(emptyPage.hits), emptyPage.cursor ] )
+    parallel.close()
+    segmented.close()
+    corpus.close()
+    try:
+        getDefaultSearcher().searchPage( "horse", content, 3, getDefaultSearcher().searchPage("accounting", content, 3).cursor )
+        failures += check( "pages, wrong cursor", "horse", "ValueError", "no error" )
+    except ValueError:
+        pass
+
+    # Answers out of a ResultCache should be just the same as running the search (however many hits we ask for),
+    # and a document that changes shouldn't be answered from its old hits.
+    resultCache = ResultCache( 4, tempfile.mkdtemp() )
+    searcher    = Searcher( PLAN_CACHE_SIZE, False, None, resultCache )
+    for maxHits in [ MAX_HITS, 2, None, MAX_HITS ]:
+        countsBefore = ( resultCache.hits, resultCache.misses )
+        for test in parseStrings:
+            offsets = hitOffsets( searcher.search(test, content, False, DEFAULT_ENGINE, maxHits) )
+            failures += check( "result cache, %s hits" % maxHits, test, hitOffsets( getDefaultSearcher().search(test, content, False, DEFAULT_ENGINE, maxHits) ), offsets )
+    # (The last pass should have come straight out of the cache -- mostly out of the spilled entries -- since the
+    # pass before it found all the hits for every query.)
+    failures += check( "result cache, answered", "", ( countsBefore[0] + len(parseStrings), countsBefore[1] ), ( resultCache.hits, resultCache.misses ) )
+    documentPath = os.path.join( resultCache.spillDirectory, "document.txt" )
+    for text in [ "dogs and horses", "cows and horses", "dogs and horses, twice" ]:
+        f = open(documentPath, "w")
+        f.write(text)
+        f.close()
+        os.utime( documentPath, (time.time(), time.time() + len(text)) )   # (So the modification time is sure to change)
+        corpus = Corpus([ documentPath ])
+        failures += check( "result cache, changed", text, len( runSearch("dog", Content(text), False).hits ), len( searcher.search("dog", corpus.getContent(documentPath)).hits ) )
+        corpus.close()
+    for fileName in os.listdir(resultCache.spillDirectory):
+        os.remove( os.path.join(resultCache.spillDirectory, fileName) )
+    os.rmdir(resultCache.spillDirectory)
+
+    # An AND of ORs multiplies out into lots of windows, but only so many.
+    grouped = lambda groups: " AND ".join( [ "((a%d b%d) OR (c%d d%d))" % (i, i, i, i) for i in range(groups) ] )
+    failures += check( "windows", grouped(6), MAX_CONJUNCTIONS, len( Searcher().getPlan(grouped(6)).conjunctions ) )
+    try:
+        Searcher().getPlan( grouped(14) )
+        failures += check( "windows", grouped(14), "ValueError", "no error" )
+    except ValueError:
+        pass
+
+    # A synonym that isn't all lowercase ("FASB") is still matched without regard to case, so the engines that
+    # look for literal text in the case-folded content have to fold it, too.
+    for test in [ "board", "FASB standards", "board OR horse" ]:
+        expectedOffsets = hitOffsets( runSearch(test, content, False, ENGINE_REGEX) )
+        for engine in [ ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+            failures += check( "mixed case, " + engine, test, expectedOffsets, hitOffsets( runSearch(test, content, False, engine) ) )
+    # ... and so does the planner, or it'd think the clause never turns up, and anchor on it.  Its estimate comes from
+    # the prefilter's candidates, so it should be at least as many as the clause's actual matches.
+    clause   = getDefaultSearcher().getPlan("board").searchClauses[0]
+    actual   = len( matchPositions( clause.matcher, content.content, len(content.content) ) )
+    estimate = QueryPlanner().estimateMatches( clause, content )
+    failures += check( "mixed case, planner", "board", True, actual > 0 and estimate >= actual )
+
+    # A few boolean queries with more than one window, which the stream and segmented searches won't take.
+    for test in [ "(dog AND horse) OR attorney", "section NOT horse", "dog AND NOT (cow OR attorney)", "forgot OR (m AND a)" ]:
+        expectedOffsets = hitOffsets( runSearch(test, content, False, ENGINE_REGEX) )
+        for engine in [ ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+            failures += check( engine, test, expectedOffsets, hitOffsets( runSearch(test, content, False, engine) ) )
+
+    # A batch should give every query the same hits on its own would, whichever engine runs it, however many hits
+    # we ask for, and on a mapped document, too.
+    batchTests = parseStrings + [ "(dog AND horse) OR attorney", "section NOT horse", "dog AND NOT (cow OR attorney)" ]
+    corpus     = Corpus([ SEARCH_FILE_NAME ])
+    for engine in [ ENGINE_REGEX, ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+        for batchContent in [ Content(), corpus.getContent(SEARCH_FILE_NAME) ]:
+            for maxHits in [ MAX_HITS, None ]:
+                batchResults = getDefaultSearcher().searchBatch( batchTests, batchContent, False, engine, maxHits )
+                for test, searchResult in zip(batchTests, batchResults):
+                    failures += check( "batch, %s, %s hits" % (engine, maxHits), test,
+                                       hitOffsets( getDefaultSearcher().search(test, content, False, ENGINE_REGEX, maxHits) ), hitOffsets(searchResult) )
+    corpus.close()
+
+    # Streaming in small chunks should find the same hits, as long as it goes in the same clause order ...
+    for test, expectedOffsets in zip(parseStrings, expected):
+        clausePlan = runSearch(test, content, False).clausePlan
+        stream     = open(SEARCH_FILE_NAME, 'r')
+        offsets    = [ [ (highlight.start, highlight.end) for highlight in hit.highlights ]
+                       for hit in getDefaultSearcher().searchStream( test, stream, 4096, MAX_HITS, clausePlan ) ]
+        failures += check( "stream", test, expectedOffsets, offsets )
+
+    # ... and so should searching the file as a memory-mapped Corpus (which has no index, so the index engine
+    # just runs the regexes).
+    corpus = Corpus([ SEARCH_FILE_NAME ])
+    for test, expectedOffsets in zip(parseStrings, expected):
+        offsets = [ hitOffsets(searchResult) for searchResult in corpus.search(test) ]
+        failures += check( "corpus", test, expectedOffsets, (offsets or [[]])[0] )
+        failures += check( "corpus, " + ENGINE_INDEX, test, expectedOffsets,
+                           hitOffsets( getDefaultSearcher().search(test, corpus.getContent(SEARCH_FILE_NAME), False, ENGINE_INDEX) ) )
+
+    # ... and searching a corpus in parallel should give the same results as searching it one document at a time.
+    corpus   = Corpus([ SEARCH_FILE_NAME, QUERY_FILE_NAME, SYNONYM_FILE_NAME ])
+    parallel = ParallelSearcher( corpus, 2, parseStrings )
+    for test in parseStrings:
+        sequential = [ (searchResult.documentId, hitOffsets(searchResult)) for searchResult in corpus.search(test, False, None, None) ]
+        inParallel = [ (searchResult.documentId, hitOffsets(searchResult)) for searchResult in parallel.search(test, None) ]
+        limited    = sum( [ hitOffsets(searchResult) for searchResult in parallel.search(test, 3) ], [] )
+        sequentialLimit = sum( [ offsets for documentId, offsets in sequential ], [] )[:3]
+        failures += check( "parallel", test, sequential, inParallel ) + check( "parallel, 3 hits", test, sequentialLimit, limited )
+    parallel.close()
+    corpus.close()
+
+    # ... and so should splitting the file into (small) segments, and scanning them in parallel, whether it's in
+    # memory or mapped.
+    corpus = Corpus([ SEARCH_FILE_NAME ])
+    for mode, segmentContent in [ ("segmented", Content()), ("segmented, mapped", corpus.getContent(SEARCH_FILE_NAME)) ]:
+        segmented = SegmentedSearcher( segmentContent, 2, 4096, parseStrings )
+        for test, expectedOffsets in zip(parseStrings, expected):
+            failures += check( mode, test, expectedOffsets, hitOffsets( segmented.search(test) ) )
+        segmented.close()
+    corpus.close()
+
+    # Ranking shouldn't depend on the engine, and skipping the windows that can't make the cut shouldn't change
+    # which ones do.
+    corpus = Corpus([ SEARCH_FILE_NAME, QUERY_FILE_NAME, SYNONYM_FILE_NAME ])
+    for test in parseStrings:
+        ranked = [ (hit.documentId, hit.score, [ (highlight.start, highlight.end) for highlight in hit.highlights ]) for hit in corpus.searchRanked(test, 3, False, None, False) ]
+        pruned = [ (hit.documentId, hit.score, [ (highlight.start, highlight.end) for highlight in hit.highlights ]) for hit in corpus.searchRanked(test, 3) ]
+        failures += check( "ranked", test, ranked, pruned )
+        expectedOffsets = hitOffsets( getDefaultSearcher().searchRanked(test, content, 3, False, ENGINE_REGEX) )
+        for engine in [ ENGINE_INDEX, ENGINE_PREFILTER, ENGINE_AUTO ]:
+            failures += check( "ranked, " + engine, test, expectedOffsets, hitOffsets( getDefaultSearcher().searchRanked(test, content, 3, False, engine) ) )
+    corpus.close()
+
+    # The index and the terms engine should fold the content's tokens together in just the same way.
+    tokens = PositionalIndex.tokenPattern.findall( content.content + " s ss S sss \xc2\xa7168 s168 p2 \xc2\xb62" )
+    failures += check( "term keys", "", TermAnalyzer.tokenKeys(" ".join(tokens)), [ PositionalIndex.termKey(token) for token in tokens ] )
+
+    # The terms engine matches analyzed terms, not regexes, so it's allowed to disagree -- but it'd better not
+    # be about anything but punctuation and synonyms.  Take a look at any it lists.
+    differing = [ test for test, expectedOffsets in zip(parseStrings, expected)
+                  if hitOffsets( runSearch(test, content, False, ENGINE_TERMS) ) != expectedOffsets ]
+    print "terms engine differs on %d queries: %s" % ( len(differing), ", ".join(differing) )
+
+    print "%d queries, %d mismatches" % (len(parseStrings), failures)
+
+def corpusSearch ( directory, searchExpression, isParallel = False ):
+    """
+    Search every document in a directory (optionally with a ParallelSearcher), printing the hits for each one.
+    """
+    corpus = Corpus(directory)
+    if isParallel:
+        parallel = ParallelSearcher( corpus, None, [ searchExpression ] )
+        searchResults = parallel.search( searchExpression )
+        parallel.close()
+    else:
+        searchResults = corpus.search( searchExpression )
+    for searchResult in searchResults:
+        print "\n=== %s ===" % searchResult.documentId
+        print searchResult
+    corpus.close()
+
+def segmentedSearch ( searchExpression, fileName = None ):
+    """
+    Search one (big) file with a SegmentedSearcher, printing all the hits.
+    """
+    corpus    = Corpus([ fileName or SEARCH_FILE_NAME ])
+    segmented = SegmentedSearcher( corpus.getContent(fileName or SEARCH_FILE_NAME), None, None, [ searchExpression ] )
+    print segmented.search( searchExpression, None )
+    segmented.close()
+    corpus.close()
+
+def rankedSearch ( searchExpression, directory = None ):
+    """
+    Print the best MAX_HITS hits for a query, from the test file or (with their scores) from a whole directory.
+    """
+    if directory is None:
+        print getDefaultSearcher().searchRanked( searchExpression, Content() )
+        return
+    corpus = Corpus(directory)
+    for rankedHit in corpus.searchRanked( searchExpression ):
+        print "\n=== %s (%.3f) ===" % (rankedHit.documentId, rankedHit.score)
+        print rankedHit.kwic()
+    corpus.close()
+
+def buildIndex ( fileName = None ):
+    """
+    Make sure a file has an up-to-date IndexFile next to it (building it if it's missing or stale), and show
+    how long opening it takes.
+    """
+    fileName  = fileName or SEARCH_FILE_NAME
+    indexPath = fileName + INDEX_SUFFIX
+    text      = open(fileName, 'r').read()
+    started   = time.time()
+    index     = IndexFile.open( indexPath, text )
+    if index is None:
+        print "%s is missing or stale, building it" % indexPath
+        index = loadIndex( text, indexPath )
+        print "built in %.1fms" % ( (time.time() - started) * 1000 )
+        started = time.time()
+        index.close()
+        index = IndexFile.open( indexPath, text )
+    print "opened in %.1fms:  %d tokens, %d keys, %d bytes" % ( (time.time() - started) * 1000, len(index.tokenStarts),
+                                                                 index.postings.keyCount, os.path.getsize(indexPath) )
+    index.close()
+
+def streamSearch ( searchExpression, fileName = None ):
+    """
+    Stream a search over a file (or stdin), printing each hit as soon as we find it.
+    """
+    if fileName is None:
+        source = sys.stdin
+    else:
+        source = open(fileName, 'r')
+    for hit in getDefaultSearcher().searchStream( searchExpression, source ):
+        print "\n---\n" + hit.kwic
+
 
-# If we're just running this file, then run the test expressions.
+# If we're just running this file, then run the test expressions (or "compare" to check the engines against each other,
+# "stream <query> [file]" to stream a search over a file or stdin, "segmented <query> [file]" to search one big file in
+# parallel, "ranked <query> [directory]" for the best hits rather than the first ones, "index [file]" to build (or check)
+# a file's IndexFile, or "corpus <directory> <query>" -- or "parallel <directory> <query>" -- to search a directory).
 if __name__ == '__main__':
-    testExpressions()
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        testEquivalence()
+    elif len(sys.argv) > 2 and sys.argv[1] == "stream":
+        streamSearch( sys.argv[2], (sys.argv[3:] or [None])[0] )
+    elif len(sys.argv) > 2 and sys.argv[1] == "segmented":
+        segmentedSearch( sys.argv[2], (sys.argv[3:] or [None])[0] )
+    elif len(sys.argv) > 1 and sys.argv[1] == "index":
+        buildIndex( (sys.argv[2:] or [None])[0] )
+    elif len(sys.argv) > 2 and sys.argv[1] == "ranked":
+        rankedSearch( sys.argv[2], (sys.argv[3:] or [None])[0] )
+    elif len(sys.argv) > 3 and sys.argv[1] in ("corpus", "parallel"):
+        corpusSearch( sys.argv[2], sys.argv[3], sys.argv[1] == "parallel" )
+    else:
+        testExpressions()
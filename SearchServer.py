@@ -0,0 +1,529 @@
+#!/usr/bin/python
+#
+# A resident query server for Search.py.
+#
+# Every run of Search.py pays for starting the interpreter, reading the content and the synonyms, and compiling its
+# queries, before it searches anything.  This keeps all of that warm:  we load the Content (and its prefilter, or
+# index) and the synonyms once, then fork a pool of worker processes that inherit them, and each worker keeps its own
+# Searcher -- and so its own plan cache -- for as long as the server runs.
+#
+#   python SearchServer.py [--port 7474 | --unix /tmp/search.sock] [--file searchtest.txt] [--index]
+#                          [--processes N] [--max-pending 64] [--deadline 2000] [--result-cache 512]
+#   python SearchServer.py --self-test
+#
+# The protocol is JSON lines:  one request object a line, one response object a line.  A request is
+#
+#   { "id": 1, "query": "dog AND horse", "engine": "prefilter", "maxHits": 8, "kwic": true, "deadlineMs": 500 }
+#
+# (everything but the query is optional, and the counts have to be whole numbers that aren't negative), or
+# { "id": 2, "op": "stats" } for the latency metrics.  The response has the same id, and either the "hits" (a list of
+# [start, end] highlights for each hit) and their "kwics", or an "error".
+# Each worker keeps a ResultCache too, and "cached" says whether the hits came out of it.  To page through the hits
+# instead, ask for a "pageSize":  the response has a "cursor" to send back (with the same query) for the next page, or
+# null once there aren't any more.
+# A connection can have any number of requests outstanding, and the responses come back as they finish, not
+# necessarily in order -- that's what the ids are for.
+#
+# Python 2 doesn't have asyncio, so the event loop is asyncore (with asynchat for the line framing).  The matching is
+# CPU-bound, so it all happens in the worker pool; the pool's results come back on a thread of its own, which queues
+# them and writes a byte down a pipe to wake the event loop up, so only the loop ever touches a socket.
+
+import asynchat
+import asyncore
+import collections
+import json
+import multiprocessing
+import optparse
+import os
+import socket
+import sys
+import threading
+import time
+
+import Search
+
+DEFAULT_PORT        = 7474
+DEFAULT_DEADLINE_MS = 2000   # How long does a request get, unless it asks for something else?
+MAX_PENDING         =   64   # How many requests can be queued or running at once, before we start turning them away?
+SERVE_TICK          = 0.05   # How often (in seconds) does the event loop check for requests that are past their deadline?
+LATENCY_SAMPLES     = 1024   # How many of the most recent latencies do we keep for the percentiles?
+
+ENGINES = [ Search.ENGINE_REGEX, Search.ENGINE_INDEX, Search.ENGINE_PREFILTER, Search.ENGINE_AUTO, Search.ENGINE_TERMS ]
+
+# --------------------------------------------------------------------------------------------------------------------
+
+# Each worker process's view of the world.  The content is set in the server before the pool forks, so the workers
+# all share the parent's copy (and its prefilter and index) rather than loading their own.
+serverContent  = None
+workerSearcher = None
+
+def initServerWorker ( resultCacheSize ):
+    """
+    Get a worker process ready:  it gets its own Searcher, and so its own plan cache (and result cache, unless
+    its size is 0), which stays warm for as long as the server runs.
+    """
+    global workerSearcher
+    resultCache = None
+    if resultCacheSize > 0:
+        resultCache = Search.ResultCache(resultCacheSize)
+    workerSearcher = Search.Searcher( Search.PLAN_CACHE_SIZE, False, None, resultCache )
+
+def runQueryTask ( task ):
+    """
+    Run one request in a worker, returning the response (less its id and latency, which the server fills in).
+    If it's already past its deadline by the time we get to it, we don't bother.
+    """
+    query, engine, maxHits, isKwic, deadline, pageSize, cursor = task
+    if time.time() > deadline:
+        return { "error": "deadline exceeded" }
+    started = time.time()
+    try:
+        if pageSize is not None:
+            searchResult = workerSearcher.searchPage( query, serverContent, pageSize, cursor, engine )
+            response = { "hits": Search.hitOffsets(searchResult), "cursor": searchResult.cursor }
+        else:
+            cacheHits    = workerSearcher.resultCache.hits if workerSearcher.resultCache is not None else 0
+            searchResult = workerSearcher.search( query, serverContent, False, engine, maxHits )
+            response = { "hits": Search.hitOffsets(searchResult) }
+            response["cached"] = workerSearcher.resultCache is not None and workerSearcher.resultCache.hits > cacheHits
+        if isKwic:
+            response["kwics"] = [ kwic.decode("utf-8", "replace") for kwic in searchResult.kwics() ]
+    except Exception, e:
+        return { "error": "%s: %s" % (e.__class__.__name__, e) }
+    response["searchMs"] = (time.time() - started) * 1000
+    return response
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class LatencyMetrics:
+    """
+    Keeps track of how the server's doing:  how many requests it's answered, turned away, or let run past their
+    deadline, and the latencies (from the request arriving to its response going out) of the most recent ones.
+    """
+
+    def __init__ ( self ):
+        self.completed = 0
+        self.errors    = 0
+        self.rejected  = 0   # Turned away, because there were already MAX_PENDING
+        self.expired   = 0   # Ran out of time
+        self.latencies = collections.deque( maxlen = LATENCY_SAMPLES )   # In milliseconds
+
+    def record ( self, latency, isError ):
+        self.completed += 1
+        if isError:
+            self.errors += 1
+        self.latencies.append( latency )
+
+    def percentile ( self, fraction ):
+        """
+        The latency that the given fraction of the recent requests came in under (nearest rank).
+        """
+        if len(self.latencies) == 0:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[ min( int(fraction * len(ordered)), len(ordered) - 1 ) ]
+
+    def summary ( self ):
+        return { "completed": self.completed, "errors": self.errors, "rejected": self.rejected, "expired": self.expired,
+                 "latencyMs": { "p50": self.percentile(0.50), "p95": self.percentile(0.95), "p99": self.percentile(0.99) } }
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class PendingRequest:
+    """
+    A request that's been handed to the worker pool, and hasn't been answered yet.
+    """
+
+    def __init__ ( self, connection, requestId, deadline ):
+        self.connection = connection
+        self.requestId  = requestId
+        self.received   = time.time()
+        self.deadline   = deadline
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class Wakeup(asyncore.file_dispatcher):
+    """
+    The read end of the self-pipe.  The pool's result thread writes a byte to the other end whenever it's
+    queued a result, which wakes the event loop up to send it.
+    """
+
+    def __init__ ( self, server ):
+        self.server = server
+        self.reader, self.writer = os.pipe()
+        asyncore.file_dispatcher.__init__( self, self.reader, server.socketMap )
+        os.close(self.reader)   # file_dispatcher has its own copy
+
+    def wake ( self ):
+        os.write( self.writer, "x" )
+
+    def writable ( self ):
+        return False
+
+    def handle_read ( self ):
+        self.recv(4096)
+        self.server.sendCompleted()
+
+    def close ( self ):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.writer)
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class QueryConnection(asynchat.async_chat):
+    """
+    One client's connection:  we split what it sends us into lines, and hand each one to the server.
+    """
+
+    def __init__ ( self, sock, server ):
+        asynchat.async_chat.__init__( self, sock, server.socketMap )
+        self.server = server
+        self.buffer = []
+        self.set_terminator("\n")
+
+    def collect_incoming_data ( self, data ):
+        self.buffer.append(data)
+
+    def found_terminator ( self ):
+        line = "".join(self.buffer).strip()
+        self.buffer = []
+        if len(line) > 0:
+            self.server.handleRequest( self, line )
+
+    def reply ( self, response ):
+        if self.connected:
+            self.push( json.dumps(response) + "\n" )
+
+    def handle_close ( self ):
+        self.close()
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class QueryServer(asyncore.dispatcher):
+    """
+    Listens on a TCP port (give us a (host, port) pair) or a Unix socket (give us a path), and answers JSON-lines
+    queries against one Content from a pool of worker processes.
+
+    We only let maxPending requests be queued or running at once:  past that, a request gets a "busy" error straight
+    away, rather than piling up behind the rest.  Every request has a deadline (deadlineMs, or the server's default),
+    and if it hasn't been answered by then, it gets a "deadline exceeded" error instead -- a worker that gets to it
+    late skips it, and a result that turns up late is thrown away.
+    """
+
+    def __init__ ( self, address, content, processes = None, maxPending = MAX_PENDING, deadlineMs = DEFAULT_DEADLINE_MS,
+                   resultCacheSize = Search.RESULT_CACHE_SIZE ):
+        global serverContent
+        self.socketMap  = {}   # Our own map, so we can share a process (and its asyncore) with other things
+        asyncore.dispatcher.__init__( self, None, self.socketMap )
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.create_socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        else:
+            self.create_socket( socket.AF_INET, socket.SOCK_STREAM )
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(64)
+        self.address = self.socket.getsockname()   # (So you can ask for port 0, and find out which one you got.)
+
+        self.maxPending = maxPending
+        self.deadlineMs = deadlineMs
+        self.pending    = {}                    # Sequence number --> PendingRequest
+        self.sequence   = 0
+        self.completed  = collections.deque()   # ( sequence number, response ) pairs from the pool, waiting to go out
+        self.metrics    = LatencyMetrics()
+        self.isRunning  = False
+        self.wakeup     = Wakeup(self)
+
+        # Warm everything up before the pool forks, so the workers inherit it all.
+        Search.getSynonymTable()
+        content.getPrefilter()
+        content.getFingerprint()
+        serverContent = content
+        self.pool = multiprocessing.Pool( processes, initServerWorker, (resultCacheSize,) )
+
+    def handle_accept ( self ):
+        pair = self.accept()
+        if pair is not None:
+            QueryConnection( pair[0], self )
+
+    def handleRequest ( self, connection, line ):
+        """
+        Parse a request line, and either answer it on the spot (a stats request, or a bad one), or send it off
+        to the pool.
+        """
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request has to be an object")
+        except ValueError, e:
+            connection.reply( { "id": None, "error": "bad request: %s" % e } )
+            return
+
+        requestId = request.get("id")
+        if request.get("op", "query") == "stats":
+            summary = self.metrics.summary()
+            summary["id"]      = requestId
+            summary["pending"] = len(self.pending)
+            connection.reply( summary )
+            return
+
+        query  = request.get("query")
+        engine = request.get("engine", Search.DEFAULT_ENGINE)
+        if not isinstance(query, basestring) or engine not in ENGINES:
+            connection.reply( { "id": requestId, "error": "bad request: need a query, and an engine from %s" % ", ".join(ENGINES) } )
+            return
+        if len(self.pending) >= self.maxPending:
+            self.metrics.rejected += 1
+            connection.reply( { "id": requestId, "error": "busy" } )
+            return
+
+        try:
+            deadlineMs = self.requestCount( request, "deadlineMs", self.deadlineMs )
+            maxHits    = self.requestCount( request, "maxHits", Search.MAX_HITS )
+            pageSize   = self.requestCount( request, "pageSize", None, 1 )
+        except ValueError, e:
+            connection.reply( { "id": requestId, "error": "bad request: %s" % e } )
+            return
+
+        deadline = time.time() + deadlineMs / 1000.0
+        self.sequence += 1
+        sequence = self.sequence
+        self.pending[sequence] = PendingRequest( connection, requestId, deadline )
+        task = ( query.encode("utf-8"), engine, maxHits, request.get("kwic", True), deadline, pageSize, request.get("cursor") )
+        self.pool.apply_async( runQueryTask, (task,), callback = lambda response: self.queueCompleted(sequence, response) )
+
+    def requestCount ( self, request, name, default, minimum = 0 ):
+        """
+        Return one of a request's counts (its deadline, or how many hits it wants), or the default if it didn't
+        give one.  Anything but a whole number, at least the minimum, is a ValueError.
+        """
+        value = request.get(name)
+        if value is None:
+            return default
+        if isinstance(value, bool) or not isinstance(value, (int, long)) or value < minimum:
+            raise ValueError( "%s has to be a whole number, at least %d" % (name, minimum) )
+        return value
+
+    def queueCompleted ( self, sequence, response ):
+        """
+        Called on the pool's result thread:  queue the response, and wake up the event loop to send it.
+        """
+        self.completed.append( (sequence, response) )
+        self.wakeup.wake()
+
+    def sendCompleted ( self ):
+        """
+        Send the responses the pool has finished since we last looked.
+        """
+        while len(self.completed) > 0:
+            sequence, response = self.completed.popleft()
+            self.answer( sequence, response )
+
+    def answer ( self, sequence, response ):
+        pending = self.pending.pop( sequence, None )
+        if pending is None:   # Already told them it expired
+            return
+        latency = (time.time() - pending.received) * 1000
+        response["id"]        = pending.requestId
+        response["latencyMs"] = latency
+        self.metrics.record( latency, "error" in response )
+        pending.connection.reply( response )
+
+    def expireOverdue ( self ):
+        """
+        Answer every request that's past its deadline with an error.
+        """
+        now = time.time()
+        for sequence, pending in self.pending.items():
+            if now > pending.deadline:
+                self.metrics.expired += 1
+                self.answer( sequence, { "error": "deadline exceeded" } )
+
+    def serve ( self ):
+        """
+        Run the event loop until somebody calls stop().
+        """
+        self.isRunning = True
+        while self.isRunning:
+            asyncore.loop( SERVE_TICK, False, self.socketMap, 1 )
+            self.sendCompleted()
+            self.expireOverdue()
+
+    def stop ( self ):
+        self.isRunning = False
+        self.wakeup.wake()
+
+    def close ( self ):
+        """
+        Shut down the pool and every connection, and the listening socket.
+        """
+        self.pool.terminate()
+        self.pool.join()
+        for dispatcher in self.socketMap.values():
+            if dispatcher is not self:
+                dispatcher.close()
+        asyncore.dispatcher.close(self)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+def serveInThread ( server ):
+    """
+    Run a server's event loop on a thread of its own (say, to test it with a QueryClient in the same process),
+    returning the thread.  Stop it with server.stop().
+    """
+    thread = threading.Thread( target = server.serve )
+    thread.daemon = True
+    thread.start()
+    return thread
+
+# --------------------------------------------------------------------------------------------------------------------
+
+class QueryClient:
+    """
+    A plain blocking client for a QueryServer.  send() lets you have several requests outstanding at once;
+    receive() waits for the response to a particular one (holding on to any others that turn up first).
+    """
+
+    def __init__ ( self, address ):
+        if isinstance(address, str):
+            self.socket = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        else:
+            self.socket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.socket.connect(address)
+        self.reader    = self.socket.makefile("r")
+        self.nextId    = 0
+        self.responses = {}   # Request id --> response that came in while we were waiting for another one
+
+    def send ( self, request ):
+        """
+        Send a request (giving it an id, if it doesn't have one), returning its id.
+        """
+        if "id" not in request:
+            self.nextId += 1
+            request = dict( request, id = self.nextId )
+        self.socket.sendall( json.dumps(request) + "\n" )
+        return request["id"]
+
+    def receive ( self, requestId ):
+        while requestId not in self.responses:
+            line = self.reader.readline()
+            if len(line) == 0:
+                raise IOError("the server closed the connection")
+            response = json.loads(line)
+            self.responses[ response.get("id") ] = response
+        return self.responses.pop(requestId)
+
+    def query ( self, query, **options ):
+        """
+        Run one query, and wait for its response.  Any options (engine, maxHits, kwic, deadlineMs) go along
+        with it.
+        """
+        options["query"] = query
+        return self.receive( self.send(options) )
+
+    def stats ( self ):
+        return self.receive( self.send( { "op": "stats" } ) )
+
+    def close ( self ):
+        self.reader.close()
+        self.socket.close()
+
+# --------------------------------------------------------------------------------------------------------------------
+
+def selfTest ( ):
+    """
+    Start a server on a spare port, in this process, and check that everything the queries file asks for comes
+    back just as Search.py would have found it -- with all the requests in flight at once -- then check the
+    busy and deadline errors, and print the metrics.
+    """
+    content = Search.Content()
+    server  = QueryServer( ("127.0.0.1", 0), content, 2 )
+    thread  = serveInThread(server)
+    client  = QueryClient( server.address )
+    queries = open(Search.QUERY_FILE_NAME, 'r').read().splitlines()
+    failures = 0
+
+    requestIds = [ client.send( { "query": query.decode("utf-8", "replace"), "kwic": False } ) for query in queries ]
+    for query, requestId in zip(queries, requestIds):
+        expected = [ [ list(highlight) for highlight in hit ] for hit in Search.hitOffsets( Search.runSearch(query, content, False) ) ]
+        response = client.receive(requestId)
+        if response.get("hits") != expected:
+            print "MISMATCH -->%s<--\n    expected %s\n    got      %s" % (query, expected, response)
+            failures += 1
+
+    pages  = []
+    cursor = None
+    while True:
+        response = client.query( "accounting standards", pageSize = 5, cursor = cursor, kwic = False )
+        pages.extend( response["hits"] )
+        cursor = response["cursor"]
+        if cursor is None:
+            break
+    expected = [ [ list(highlight) for highlight in hit ] for hit in Search.hitOffsets( Search.getDefaultSearcher().search("accounting standards", content, False, Search.DEFAULT_ENGINE, None) ) ]
+    if pages != expected:
+        print "MISMATCH: paging through the hits gave %d of %d" % (len(pages), len(expected))
+        failures += 1
+
+    if client.query( "dog", engine = "nonsense" ).get("error") is None:
+        print "MISMATCH: a bad engine should be an error"
+        failures += 1
+    if client.query( "dog", deadlineMs = 0 ).get("error") != "deadline exceeded":
+        print "MISMATCH: a request that's already late should be an error"
+        failures += 1
+    for options in [ { "deadlineMs": "500" }, { "deadlineMs": -1 }, { "maxHits": 2.5 }, { "maxHits": True }, { "pageSize": 0 } ]:
+        if not client.query( "dog", **options ).get("error", "").startswith("bad request"):
+            print "MISMATCH: %s should be a bad request" % json.dumps(options)
+            failures += 1
+    if "hits" not in client.query( "dog", deadlineMs = None, maxHits = None ):
+        print "MISMATCH: a null deadlineMs or maxHits should get the default"
+        failures += 1
+    if client.query( "dog", maxHits = 0 ).get("hits") != []:
+        print "MISMATCH: a request for no hits should get none"
+        failures += 1
+
+    server.maxPending = 0
+    if client.query( "dog" ).get("error") != "busy":
+        print "MISMATCH: a full server should turn requests away"
+        failures += 1
+
+    print json.dumps( client.stats(), sort_keys = True )
+    client.close()
+    server.stop()
+    thread.join()
+    server.close()
+    print "%d queries, %d mismatches" % (len(queries), failures)
+    return failures
+
+def main ( arguments ):
+    parser = optparse.OptionParser( usage = "python SearchServer.py [options]" )
+    parser.add_option( "--port",        default = DEFAULT_PORT, type = "int", help = "TCP port to listen on, on localhost [%default]" )
+    parser.add_option( "--unix",        default = None, help = "listen on this Unix socket instead" )
+    parser.add_option( "--file",        default = Search.SEARCH_FILE_NAME, help = "the file to search [%default]" )
+    parser.add_option( "--index",       default = False, action = "store_true", help = "load (or build) the file's IndexFile, for the index engine" )
+    parser.add_option( "--processes",   default = None, type = "int", help = "worker processes [one per CPU]" )
+    parser.add_option( "--max-pending", default = MAX_PENDING, type = "int", dest = "maxPending", help = "requests queued or running before we're busy [%default]" )
+    parser.add_option( "--deadline",    default = DEFAULT_DEADLINE_MS, type = "int", help = "default request deadline, in milliseconds [%default]" )
+    parser.add_option( "--result-cache", default = Search.RESULT_CACHE_SIZE, type = "int", dest = "resultCacheSize", help = "searches each worker caches the hits of, or 0 for none [%default]" )
+    parser.add_option( "--self-test",   default = False, action = "store_true", dest = "selfTest", help = "check the server against Search.py, and exit" )
+    options, leftovers = parser.parse_args(arguments)
+
+    if options.selfTest:
+        return min( selfTest(), 1 )
+
+    content = Search.Content( open(options.file, 'r').read(), options.file + Search.INDEX_SUFFIX if options.index else None )
+    if options.index:
+        content.getIndex()
+    server = QueryServer( options.unix or ("127.0.0.1", options.port), content, options.processes, options.maxPending, options.deadline,
+                          options.resultCacheSize )
+    print >> sys.stderr, "listening on %s" % (server.address,)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main(sys.argv[1:]) )